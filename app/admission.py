@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Any, List, Optional, Tuple
+
+from app.metrics import ADMISSION_WAIT_SECONDS, record
+
+# Admission control in front of the synchronous endpoints. Each content type gets a lane with a
+# bounded number of documents in flight; the rest wait in a priority queue where documents that
+# a cheap keyword pre-classification flags as urgent go first. A request whose estimated wait
+# exceeds ADMISSION_MAX_WAIT is refused with 503 and Retry-After instead of slowing everyone down.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+# In-flight documents per content type, e.g. "pdf_base64=4,email=16"; other types get ADMISSION_DEFAULT_LIMIT
+ADMISSION_LIMITS = os.getenv("ADMISSION_LIMITS", "pdf_base64=8")
+ADMISSION_DEFAULT_LIMIT = int(os.getenv("ADMISSION_DEFAULT_LIMIT", "32"))
+# Latency budget (seconds) for waiting in a lane's queue
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "5"))
+# Characters of a document the pre-classification looks at
+ADMISSION_PRECLASSIFY_CHARS = int(os.getenv("ADMISSION_PRECLASSIFY_CHARS", "4000"))
+
+URGENT, NORMAL = 0, 1
+PRIORITY_NAMES = {URGENT: "urgent", NORMAL: "normal"}
+# Weight of the newest service time in a lane's moving average
+SERVICE_TIME_SMOOTHING = 0.2
+WAIT_SAMPLES = 1000
+
+
+class Overloaded(Exception):
+    """Raised when a lane's estimated queueing delay exceeds the latency budget"""
+
+    def __init__(self, content_type: str, retry_after: float):
+        super().__init__(f"{content_type} queue is over its {ADMISSION_MAX_WAIT:g}s latency budget")
+        self.content_type = content_type
+        self.retry_after = retry_after
+
+
+def parse_limits(spec: str) -> Dict[str, int]:
+    limits = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        if name.strip() and value.strip():
+            limits[name.strip()] = max(int(value), 1)
+    return limits
+
+
+_limits = parse_limits(ADMISSION_LIMITS)
+
+
+def lane_limit(content_type: str) -> int:
+    return _limits.get(content_type, ADMISSION_DEFAULT_LIMIT)
+
+
+def priority(content_type: str, content: str) -> int:
+    """URGENT when the keyword rules rate the start of the document as high urgency"""
+    # Base64 PDFs carry no readable text before extraction
+    if content_type == "pdf_base64" or not content:
+        return NORMAL
+    from app.agents.classifier_agent import analyze_intent
+
+    return URGENT if analyze_intent(content[:ADMISSION_PRECLASSIFY_CHARS])["urgency"] == "high" else NORMAL
+
+
+class _Lane:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        # (priority, arrival, future); futures of cancelled waiters stay until popped
+        self.waiting: List[Tuple[int, int, asyncio.Future]] = []
+        self.service_seconds: Optional[float] = None
+        self.admitted = 0
+        self.rejected = 0
+        self.waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+
+    def queued(self, at_most: int = NORMAL) -> int:
+        return sum(1 for level, _, future in self.waiting if level <= at_most and not future.done())
+
+    def estimated_wait(self, level: int) -> float:
+        """Expected queueing delay of a new arrival at `level`: the waiters it cannot overtake,
+        drained `limit` at a time at the lane's average service time"""
+        if self.in_flight < self.limit and not self.queued():
+            return 0.0
+        return (self.queued(level) + 1) / self.limit * (self.service_seconds or 0.0)
+
+    def release(self) -> None:
+        # The slot passes straight to the most urgent live waiter
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def observe_service(self, seconds: float) -> None:
+        if self.service_seconds is None:
+            self.service_seconds = seconds
+        else:
+            self.service_seconds += SERVICE_TIME_SMOOTHING * (seconds - self.service_seconds)
+
+
+class _Controller:
+    def __init__(self):
+        self.lanes: Dict[str, _Lane] = {}
+        self.arrivals = itertools.count()
+
+    def lane(self, content_type: str) -> _Lane:
+        lane = self.lanes.get(content_type)
+        if lane is None:
+            lane = self.lanes[content_type] = _Lane(lane_limit(content_type))
+        return lane
+
+
+_controllers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _Controller]" = weakref.WeakKeyDictionary()
+
+
+def _controller() -> _Controller:
+    loop = asyncio.get_running_loop()
+    controller = _controllers.get(loop)
+    if controller is None:
+        controller = _controllers[loop] = _Controller()
+    return controller
+
+
+@asynccontextmanager
+async def admit(content_type: str, level: int = NORMAL) -> AsyncIterator[None]:
+    """Hold one of the lane's in-flight slots for the body; raises Overloaded instead of queueing
+    past the latency budget"""
+    if not ADMISSION_ENABLED:
+        yield
+        return
+    controller = _controller()
+    lane = controller.lane(content_type)
+    start = time.perf_counter()
+    if lane.in_flight < lane.limit and not lane.queued():
+        lane.in_flight += 1
+    else:
+        estimate = lane.estimated_wait(level)
+        if estimate > ADMISSION_MAX_WAIT:
+            lane.rejected += 1
+            raise Overloaded(content_type, estimate)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(lane.waiting, (level, next(controller.arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Cancelled after being handed a slot: give it to the next waiter
+            if future.done() and not future.cancelled():
+                lane.release()
+            raise
+    waited = time.perf_counter() - start
+    lane.admitted += 1
+    lane.waits.append(waited)
+    record(ADMISSION_WAIT_SECONDS, (content_type, PRIORITY_NAMES[level]), "admission_wait", waited)
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        lane.observe_service(time.perf_counter() - start)
+        lane.release()
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)], 6)
+
+
+def admission_stats() -> Dict[str, Any]:
+    """Queue depths, in-flight counts and recent wait times per lane of the running loop"""
+    lanes = {}
+    for content_type, lane in sorted(_controller().lanes.items()):
+        waits = list(lane.waits)
+        lanes[content_type] = {
+            "limit": lane.limit,
+            "in_flight": lane.in_flight,
+            "queued": lane.queued(),
+            "queued_urgent": lane.queued(URGENT),
+            "admitted": lane.admitted,
+            "rejected": lane.rejected,
+            "service_seconds": None if lane.service_seconds is None else round(lane.service_seconds, 6),
+            "estimated_wait_seconds": round(lane.estimated_wait(NORMAL), 6),
+            "wait_seconds_p50": _percentile(waits, 0.5),
+            "wait_seconds_p99": _percentile(waits, 0.99),
+        }
+    return {"enabled": ADMISSION_ENABLED, "max_wait_seconds": ADMISSION_MAX_WAIT, "lanes": lanes}
@@ -1,20 +1,28 @@
-import google.generativeai as genai
-from app.memory.shared_memory import store_data
 import os
 from dotenv import load_dotenv
 import pathlib
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import re
+from app.agents.keywords import CLASSIFIER_INDICATORS, KeywordHits, scan
 
 # Load environment variables from .env file
 env_path = pathlib.Path(__file__).parents[2] / '.env'
 load_dotenv(env_path)
 
-# Configure Gemini
-api_key = os.getenv("GOOGLE_API_KEY")
-if not api_key:
-    raise ValueError("GOOGLE_API_KEY not found in environment variables. Please check your .env file.")
-genai.configure(api_key=api_key)
+# google.generativeai pulls in grpc and protobuf; it is imported and configured on first use
+_genai = None
+
+def get_genai():
+    """Return the configured Gemini module, importing it on first call"""
+    global _genai
+    if _genai is None:
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise ValueError("GOOGLE_API_KEY not found in environment variables. Please check your .env file.")
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        _genai = genai
+    return _genai
 
 def clean_response(response_text: str) -> str:
     """Remove markdown formatting and extract the dictionary."""
@@ -41,9 +49,18 @@ def detect_format(content: str) -> str:
     
     return 'Unknown'
 
-def analyze_intent(content: str) -> Dict[str, Any]:
+# The intent with the most distinct indicators wins; confidence, then rule order, break ties
+INTENT_RULES = (
+    ("RFQ", "rfq", 0.9),
+    ("Invoice", "invoice", 0.9),
+    ("Complaint", "complaint", 0.8),
+    ("Regulation", "regulation", 0.85),
+)
+
+def analyze_intent(content: str, hits: Optional[KeywordHits] = None) -> Dict[str, Any]:
     """Analyze the content to determine specific intent and extract key information"""
-    content_lower = content.lower()
+    if hits is None:
+        hits = scan(content)
     
     # Initialize intent analysis
     intent = {
@@ -51,67 +68,67 @@ def analyze_intent(content: str) -> Dict[str, Any]:
         "confidence": 0.0,
         "subtype": None,
         "urgency": "normal",
-        "key_entities": []
+        "key_entities": [],
+        "candidates": {}
     }
     
-    # RFQ Detection
-    rfq_indicators = ['request for quote', 'rfq', 'price inquiry', 'quotation request']
-    if any(indicator in content_lower for indicator in rfq_indicators):
-        intent["primary_type"] = "RFQ"
-        intent["confidence"] = 0.9
+    # Score every rule instead of letting later rules overwrite earlier ones, so an RFQ
+    # that mentions "payment" stays an RFQ
+    evidence = {}
+    for intent_type, indicators, confidence in INTENT_RULES:
+        matched = sum(1 for keyword in CLASSIFIER_INDICATORS[indicators] if hits.count(keyword))
+        if matched:
+            evidence[intent_type] = (confidence, matched)
+    if not evidence:
+        return intent
+
+    order = [rule[0] for rule in INTENT_RULES]
+    primary = max(evidence, key=lambda name: (evidence[name][1], evidence[name][0], -order.index(name)))
+    total_matched = sum(matched for _, matched in evidence.values())
+    intent["primary_type"] = primary
+    # Competing intents lower the confidence by the winner's share of the evidence
+    intent["confidence"] = round(evidence[primary][0] * evidence[primary][1] / total_matched, 3)
+    intent["candidates"] = {name: confidence for name, (confidence, _) in evidence.items()}
+
+    # Extract entities for every intent that matched
+    if "RFQ" in evidence:
         # Extract product mentions
-        products = re.findall(r'product[s]?\s+([A-Za-z0-9-]+)', content)
-        if products:
-            intent["key_entities"].extend(products)
-    
-    # Invoice Detection
-    invoice_indicators = ['invoice', 'bill', 'payment', 'amount due']
-    if any(indicator in content_lower for indicator in invoice_indicators):
-        intent["primary_type"] = "Invoice"
-        intent["confidence"] = 0.9
+        intent["key_entities"].extend(re.findall(r'product[s]?\s+([A-Za-z0-9-]+)', content))
+    if "Invoice" in evidence:
         # Extract amount mentions
-        amounts = re.findall(r'\$?\d+(?:,\d{3})*(?:\.\d{2})?', content)
-        if amounts:
-            intent["key_entities"].extend(amounts)
-    
-    # Complaint Detection
-    complaint_indicators = ['complaint', 'issue', 'problem', 'dissatisfied', 'unhappy']
-    if any(indicator in content_lower for indicator in complaint_indicators):
-        intent["primary_type"] = "Complaint"
-        intent["confidence"] = 0.8
-        # Determine severity
-        severe_words = ['urgent', 'immediate', 'serious', 'critical']
-        if any(word in content_lower for word in severe_words):
+        intent["key_entities"].extend(re.findall(r'\$?\d+(?:,\d{3})*(?:\.\d{2})?', content))
+    # Determine severity
+    if "Complaint" in evidence and hits.any(CLASSIFIER_INDICATORS["severe"]):
+        intent["urgency"] = "high"
+        if primary == "Complaint":
             intent["subtype"] = "severe"
-            intent["urgency"] = "high"
-    
-    # Regulation/Policy Detection
-    regulation_indicators = ['regulation', 'policy', 'compliance', 'directive', 'law']
-    if any(indicator in content_lower for indicator in regulation_indicators):
-        intent["primary_type"] = "Regulation"
-        intent["confidence"] = 0.85
+    if primary == "Regulation":
         # Try to identify specific regulation types
-        policy_types = ['safety', 'environmental', 'financial', 'data protection']
-        for policy in policy_types:
-            if policy in content_lower:
+        for policy in CLASSIFIER_INDICATORS["policy_types"]:
+            if hits.count(policy):
                 intent["subtype"] = policy
     
     return intent
 
-def classify_input(raw_text: str) -> Dict[str, Any]:
-    """Classify input content with enhanced metadata"""
+def classify_input(raw_text: str, hits: Optional[KeywordHits] = None) -> Dict[str, Any]:
+    """Classify input content with enhanced metadata; `hits` is a scan of raw_text made earlier"""
     # Detect format
     doc_format = detect_format(raw_text)
     
+    # Find every indicator in one pass and share the hits
+    if hits is None:
+        hits = scan(raw_text)
+
     # Analyze intent
-    intent_analysis = analyze_intent(raw_text)
+    intent_analysis = analyze_intent(raw_text, hits)
     
     # Additional metadata
     metadata = {
         "timestamp": "",  # Will be added by shared_memory
         "content_length": len(raw_text),
-        "has_attachments": "attachment" in raw_text.lower(),
-        "confidence_score": intent_analysis["confidence"]
+        "has_attachments": hits.any(CLASSIFIER_INDICATORS["attachment"]),
+        "confidence_score": intent_analysis["confidence"],
+        "intent_candidates": intent_analysis["candidates"]
     }
     
     result = {
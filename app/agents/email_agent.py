@@ -1,31 +1,140 @@
-import re
 from bs4 import BeautifulSoup
+import binascii
 import json
+import pathlib
+import re
+import tempfile
 from datetime import datetime
 import email
 from email import policy
-from email.parser import BytesParser
+from email.message import EmailMessage
+from email.parser import BytesParser, BytesFeedParser
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+from app.agents.keywords import EMAIL_INDICATORS, KeywordHits, scan
+from app.memory.storage_format import RawJSON, remember_raw_json
+
+_decoder = json.JSONDecoder()
+# Characters that change the state of the brace scan
+_JSON_TOKENS = re.compile(r'[{}"\\\n]')
+# How a JSON object starts; spans that start otherwise are not worth a decode attempt
+_JSON_OBJECT_START = re.compile(r'\{\s*["}]')
+# Levels below a span that is not JSON searched for objects; bounds the work on text that keeps
+# failing to decode to this many passes over it
+JSON_SCAN_MAX_DEPTH = 32
+
+# A balanced {...} span: start, end and the spans directly inside it
+_Span = Tuple[int, int, List[Any]]
+
+def _collect_json(
+    text: str, span: _Span, objects: List[Dict[str, Any]], limit: Optional[int],
+    texts: Optional[List[str]], depth: int = 0,
+) -> bool:
+    """Decode a span, or failing that the spans inside it; True once `limit` objects are found"""
+    start, end, inner = span
+    if _JSON_OBJECT_START.match(text, start):
+        source = text[start:end]
+        try:
+            objects.append(_decoder.decode(source))
+        except (json.JSONDecodeError, RecursionError):
+            pass
+        else:
+            if texts is not None:
+                texts.append(source)
+            return limit is not None and len(objects) >= limit
+    # Not an object itself (or nested too deep to decode), but it may hold some
+    if depth >= JSON_SCAN_MAX_DEPTH:
+        return False
+    return any(_collect_json(text, span, objects, limit, texts, depth + 1) for span in inner)
+
+def find_json_objects(
+    text: str, limit: Optional[int] = None, texts: Optional[List[str]] = None,
+) -> List[Dict[str, Any]]:
+    """Find every JSON object embedded in text, in one left-to-right pass.
+
+    Braces are matched outside of strings, and only a balanced span is decoded: the outermost
+    one first, then the spans inside it if it is not JSON. A found object is never rescanned, and
+    text that never closes its braces is never decoded at all. The text of each object found is
+    appended to `texts`, if given.
+    """
+    objects: List[Dict[str, Any]] = []
+    # Open braces, each with the spans closed directly inside it
+    stack: List[Tuple[int, List[_Span]]] = []
+    in_string = False
+    escaped = -1
+    for match in _JSON_TOKENS.finditer(text):
+        pos, char = match.start(), match.group()
+        if pos == escaped:
+            continue
+        if in_string:
+            if char == '\\':
+                escaped = pos + 1
+            elif char == '"':
+                in_string = False
+            elif char == '\n':
+                # A line break cannot be inside a JSON string, so that quote did not open one
+                in_string = False
+        elif char == '{':
+            stack.append((pos, []))
+        elif not stack:
+            # Quotes and stray braces in the surrounding prose
+            continue
+        elif char == '"':
+            in_string = True
+        elif char == '}':
+            start, inner = stack.pop()
+            span = (start, pos + 1, inner)
+            if stack:
+                stack[-1][1].append(span)
+            elif _collect_json(text, span, objects, limit, texts):
+                return objects
+    # Objects inside braces that were never closed, in order
+    for _, inner in stack:
+        for span in inner:
+            if _collect_json(text, span, objects, limit, texts):
+                return objects
+    return objects
 
 def extract_json_from_text(text):
-    """Extract JSON content from text if present"""
-    try:
-        # Look for JSON-like content between curly braces
-        json_match = re.search(r'\{.*\}', text)
-        if json_match:
-            json_str = json_match.group(0)
-            return json.loads(json_str)
-    except json.JSONDecodeError:
-        return None
-    return None
+    """Extract the first JSON object embedded in text, if any"""
+    objects = find_json_objects(text, limit=1)
+    return objects[0] if objects else None
 
-def parse_email(email_content, raw=False):
+def html_to_text(html: str) -> str:
+    return BeautifulSoup(html, 'html.parser').get_text()
+
+def _looks_like_html(text: str) -> bool:
+    return "<html" in text[:2048].lower()
+
+# Chunk size for feeding uploads to the parser and for decoding attachments to disk
+EMAIL_CHUNK_SIZE = 1024 * 1024
+
+def message_from_text(email_content: str, raw: bool = False) -> EmailMessage:
     if raw:
         # Parse raw email content
-        msg = BytesParser(policy=policy.default).parsebytes(email_content.encode())
-    else:
-        # Parse string email content
-        msg = email.message_from_string(email_content, policy=policy.default)
+        return BytesParser(policy=policy.default).parsebytes(email_content.encode())
+    # Parse string email content
+    return email.message_from_string(email_content, policy=policy.default)
+
+def parse_email(email_content, raw=False):
+    return parse_email_message(message_from_text(email_content, raw))
+
+def read_email_message(stream: BinaryIO, hasher=None) -> EmailMessage:
+    """Parse a message/rfc822 byte stream chunk by chunk, optionally hashing it on the way"""
+    parser = BytesFeedParser(policy=policy.default)
+    while True:
+        chunk = stream.read(EMAIL_CHUNK_SIZE)
+        if not chunk:
+            break
+        if hasher is not None:
+            hasher.update(chunk)
+        parser.feed(chunk)
+    return parser.close()
+
+def parse_email_message(msg: EmailMessage) -> Dict[str, Any]:
+    return analyze_email(read_email_parts(msg))
 
+def read_email_parts(msg: EmailMessage) -> Dict[str, Any]:
+    """Headers, body text, HTML flag and attachment list of a message; HTML is converted to text here, once"""
     # Extract basic email metadata
     metadata = {
         "subject": msg.get("subject", ""),
@@ -39,52 +148,144 @@ def parse_email(email_content, raw=False):
     }
 
     # Initialize body content
-    text_content = ""
+    text_parts = []
     html_content = None
     attachments = []
 
-    # Process email parts
+    # Process email parts; each HTML body is converted to text exactly once
     for part in msg.walk():
         content_type = part.get_content_type()
         if content_type == "text/plain":
-            text_content += part.get_content()
+            body = part.get_content()
+            # HTML pasted without a Content-Type header arrives as text/plain
+            if _looks_like_html(body):
+                html_content = body
+                body = html_to_text(body)
+            text_parts.append(body)
         elif content_type == "text/html":
             html_content = part.get_content()
             # Convert HTML to text for analysis
-            soup = BeautifulSoup(html_content, 'html.parser')
-            text_content += soup.get_text()
+            text_parts.append(html_to_text(html_content))
         elif part.get_filename():  # Handle attachments
             attachments.append({
                 "filename": part.get_filename(),
-                "content_type": content_type
+                "content_type": content_type,
+                "kind": attachment_kind(part)
             })
 
+    return {
+        "metadata": metadata,
+        "text": "".join(text_parts),
+        "html": html_content is not None,
+        "attachments": attachments,
+    }
+
+def analyze_email(
+    parts: Dict[str, Any], hits: Optional[KeywordHits] = None, raw_json: Optional[RawJSON] = None,
+) -> Dict[str, Any]:
+    """Intent, urgency and embedded JSON of a message read by read_email_parts; the embedded JSON
+    is recorded in `raw_json` with its text"""
+    text_content = parts["text"]
     # Analyze content for intent
-    urgency = "High" if any(word in text_content.lower() for word in ["urgent", "asap", "emergency"]) else "Normal"
+    if hits is None:
+        hits = scan(text_content)
+    urgency = "High" if hits.any(EMAIL_INDICATORS["urgency"]) else "Normal"
     
     # Determine intent based on content
     intent = "General Inquiry"
-    if "request for quote" in text_content.lower() or "rfq" in text_content.lower():
+    if hits.any(EMAIL_INDICATORS["rfq"]):
         intent = "RFQ"
-    elif "complaint" in text_content.lower() or "dissatisfied" in text_content.lower():
+    elif hits.any(EMAIL_INDICATORS["complaint"]):
         intent = "Complaint"
-    elif "invoice" in text_content.lower() or "payment" in text_content.lower():
+    elif hits.any(EMAIL_INDICATORS["invoice"]):
         intent = "Invoice"
 
-    # Check for embedded JSON
-    embedded_json = extract_json_from_text(text_content)
+    # Check for embedded JSON; the first object is the document's payload
+    texts: List[str] = []
+    json_objects = find_json_objects(text_content, texts=texts)
+    embedded_json = json_objects[0] if json_objects else None
+    if embedded_json is not None:
+        remember_raw_json(raw_json, embedded_json, texts[0])
 
     return {
-        "metadata": metadata,
+        "metadata": parts["metadata"],
         "content": {
             "text": text_content,
-            "html": html_content is not None,
-            "attachments": attachments
+            "html": parts["html"],
+            "attachments": parts["attachments"]
         },
         "analysis": {
             "intent": intent,
             "urgency": urgency,
-            "has_embedded_json": embedded_json is not None
+            "has_embedded_json": embedded_json is not None,
+            "embedded_json_count": len(json_objects)
         },
         "embedded_json": embedded_json
     }
+
+def attachment_kind(part: EmailMessage) -> Optional[str]:
+    """"pdf" or "json" for attachments the other agents can process, else None"""
+    content_type = part.get_content_type()
+    filename = (part.get_filename() or "").lower()
+    if content_type == "application/pdf" or filename.endswith(".pdf"):
+        return "pdf"
+    if content_type == "application/json" or filename.endswith(".json"):
+        return "json"
+    return None
+
+def iter_attachments(msg: EmailMessage) -> Iterator[Tuple[int, EmailMessage]]:
+    """(position, part) of each attachment, numbered as in parse_email's attachment list"""
+    position = 0
+    for part in msg.walk():
+        if part.get_content_type() in ("text/plain", "text/html") or not part.get_filename():
+            continue
+        yield position, part
+        position += 1
+
+def _reads_private_payload() -> bool:
+    # email.message.Message keeps the undecoded body in its private _payload attribute; check
+    # once that it still does, against the public API, before relying on it
+    probe = EmailMessage()
+    probe.set_payload("QUJD")
+    return getattr(probe, "_payload", None) == probe.get_payload() == "QUJD"
+
+_PRIVATE_PAYLOAD = _reads_private_payload()
+
+def _encoded_payload(part: EmailMessage) -> Any:
+    """The body of a part as it appears in the message, without decoding it.
+
+    get_payload() encodes the whole text once to look for surrogates, a copy of the entire
+    attachment; _payload is the same object without that copy. If the check above fails, the
+    public API is used instead.
+    """
+    if _PRIVATE_PAYLOAD:
+        return part._payload
+    return part.get_payload()
+
+def decode_attachment(part: EmailMessage, spool_threshold: int) -> Union[bytes, pathlib.Path]:
+    """Decode an attachment's payload on demand.
+
+    Base64 payloads larger than spool_threshold are decoded chunk by chunk into a temporary
+    file (the caller deletes it), so the decoded bytes never sit in memory next to the
+    encoded text the message already holds.
+    """
+    payload = _encoded_payload(part)
+    if (
+        part.get("content-transfer-encoding", "").lower() != "base64"
+        or not isinstance(payload, str)
+        or not payload.isascii()
+        or len(payload) * 3 // 4 <= spool_threshold
+    ):
+        return part.get_payload(decode=True) or b""
+    with tempfile.NamedTemporaryFile(suffix=".attachment", delete=False) as spooled:
+        pending = ""
+        # Slices of the payload, so at most one chunk of it is ever copied
+        for start in range(0, len(payload), EMAIL_CHUNK_SIZE):
+            pending += "".join(payload[start:start + EMAIL_CHUNK_SIZE].split())
+            # Decode whole 4-character groups; the remainder waits for the next chunk
+            cut = len(pending) - len(pending) % 4
+            spooled.write(binascii.a2b_base64(pending[:cut]))
+            pending = pending[cut:]
+        if pending:
+            spooled.write(binascii.a2b_base64(pending))
+    return pathlib.Path(spooled.name)
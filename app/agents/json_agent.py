@@ -1,4 +1,8 @@
-from typing import Dict, Any, List
+import json
+import os
+import re
+from json.decoder import scanstring
+from typing import Dict, Any, List, Callable, Iterator, Optional, Tuple, Union
 from datetime import datetime
 
 class SchemaValidator:
@@ -43,56 +47,209 @@ class SchemaValidator:
             return any(isinstance(value, t) for t in expected_type)
         return isinstance(value, expected_type)
 
-def parse_json(json_payload: Dict[str, Any]) -> Dict[str, Any]:
+# Validators compiled once per schema: required fields as a tuple, and one
+# (field, accepted types, error prefix) check per typed field
+Validator = Callable[[Dict[str, Any]], Tuple[List[str], List[str]]]
+
+def compile_schema(schema: Dict[str, Any]) -> Validator:
+    required = tuple(schema["required"])
+    checks = tuple(
+        (field, expected if isinstance(expected, tuple) else (expected,), f"{field}: expected {expected}, got ")
+        for field, expected in schema["types"].items()
+    )
+
+    def validate(payload: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+        missing = [field for field in required if field not in payload]
+        type_errors = []
+        for field, types, prefix in checks:
+            if field in payload and not isinstance(payload[field], types):
+                type_errors.append(f"{prefix}{type(payload[field])}")
+        return missing, type_errors
+
+    return validate
+
+VALIDATORS: Dict[str, Validator] = {name: compile_schema(schema) for name, schema in SchemaValidator.SCHEMAS.items()}
+
+# JSON content at least this large is validated with validate_json_stream instead of being parsed whole
+JSON_STREAM_MIN_BYTES = int(os.getenv("JSON_STREAM_MIN_BYTES", str(1024 * 1024)))
+
+class ItemsSummary:
+    """Running count and amount total of line items, fed one item at a time"""
+
+    def __init__(self):
+        self.count = 0
+        self.amount_total = 0.0
+        self.non_object = 0
+        self.invalid_amount = 0
+
+    def add(self, item: Any) -> None:
+        self.count += 1
+        if not isinstance(item, dict):
+            self.non_object += 1
+            return
+        amount = item.get("amount", 0)
+        if isinstance(amount, (int, float)) and not isinstance(amount, bool):
+            self.amount_total += amount
+        else:
+            self.invalid_amount += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"count": self.count, "amount_total": round(self.amount_total, 2)}
+
+def _detect_type(payload: Dict[str, Any]) -> str:
+    if "invoice_number" in payload:
+        return "invoice"
+    elif "rfq_number" in payload:
+        return "rfq"
+    elif "complaint" in payload or "reference" in payload:
+        return "complaint"
+    return "unknown"
+
+def _analyze(payload: Dict[str, Any], items: Optional[ItemsSummary], processed_data: Dict[str, Any]) -> Dict[str, Any]:
     # Initialize response structure
     result = {
         "valid": True,
-        "document_type": "unknown",
+        "document_type": _detect_type(payload),
         "missing_fields": [],
         "type_errors": [],
         "anomalies": [],
-        "processed_data": {},
+        "processed_data": processed_data,
         "metadata": {
             "timestamp": datetime.utcnow().isoformat(),
             "schema_version": "1.0"
         }
     }
 
-    # Detect document type
-    if "invoice_number" in json_payload:
-        result["document_type"] = "invoice"
-    elif "rfq_number" in json_payload:
-        result["document_type"] = "rfq"
-    elif "complaint" in json_payload or "reference" in json_payload:
-        result["document_type"] = "complaint"
-
     # Validate against schema if document type is known
-    if result["document_type"] in SchemaValidator.SCHEMAS:
-        schema = SchemaValidator.SCHEMAS[result["document_type"]]
-        
-        # Check required fields
-        for field in schema["required"]:
-            if field not in json_payload:
-                result["missing_fields"].append(field)
-                result["valid"] = False
-
-        # Validate types
-        for field, value in json_payload.items():
-            if field in schema["types"]:
-                expected_type = schema["types"][field]
-                if not SchemaValidator.validate_type(value, expected_type):
-                    result["type_errors"].append(f"{field}: expected {expected_type}, got {type(value)}")
-                    result["valid"] = False
+    validator = VALIDATORS.get(result["document_type"])
+    if validator is not None:
+        result["missing_fields"], result["type_errors"] = validator(payload)
+        result["valid"] = not result["missing_fields"] and not result["type_errors"]
+
+    if items is not None:
+        result["items_summary"] = items.as_dict()
+        if items.non_object:
+            result["anomalies"].append(f"{items.non_object} item(s) are not objects")
 
     # Check for anomalies
-    if result["document_type"] == "invoice":
+    if result["document_type"] == "invoice" and items is not None and "total" in payload:
         # Verify amounts
-        if "items" in json_payload and "total" in json_payload:
-            items_total = sum(item.get("amount", 0) for item in json_payload["items"])
-            if abs(items_total - json_payload["total"]) > 0.01:  # Allow small float difference
-                result["anomalies"].append("Total amount doesn't match sum of items")
+        if items.invalid_amount:
+            result["anomalies"].append(f"{items.invalid_amount} item(s) have a non-numeric amount")
+        total = payload["total"]
+        if isinstance(total, (int, float)) and abs(items.amount_total - total) > 0.01:  # Allow small float difference
+            result["anomalies"].append("Total amount doesn't match sum of items")
+
+    return result
+
+def parse_json(json_payload: Dict[str, Any]) -> Dict[str, Any]:
+    if not isinstance(json_payload, dict):
+        result = _analyze({}, None, json_payload)
+        result["valid"] = False
+        result["anomalies"].append("Payload is not a JSON object")
+        return result
+
+    items = None
+    if isinstance(json_payload.get("items"), list):
+        items = ItemsSummary()
+        for item in json_payload["items"]:
+            items.add(item)
 
     # Store processed data
-    result["processed_data"] = json_payload
+    return _analyze(json_payload, items, json_payload)
+
+class _Cursor:
+    """Position in a JSON text; values are decoded one at a time with raw_decode"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def peek(self) -> str:
+        match = _WHITESPACE.match(self.text, self.pos)
+        self.pos = match.end()
+        if self.pos >= len(self.text):
+            raise json.JSONDecodeError("Unexpected end of JSON", self.text, self.pos)
+        return self.text[self.pos]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self.text, self.pos)
+        self.pos += 1
 
+    def value(self) -> Any:
+        self.peek()
+        value, self.pos = _decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def key(self) -> str:
+        self.expect('"')
+        key, self.pos = scanstring(self.text, self.pos)
+        return key
+
+    def elements(self) -> Iterator[None]:
+        """Step through an array; the caller consumes one element per iteration"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+def _stream_document(cursor: _Cursor) -> Dict[str, Any]:
+    fields: Dict[str, Any] = {}
+    items = None
+    cursor.expect("{")
+    if cursor.peek() == "}":
+        cursor.pos += 1
+        return _analyze(fields, None, fields)
+    while True:
+        key = cursor.key()
+        cursor.expect(":")
+        if key == "items" and cursor.peek() == "[":
+            # Line items are decoded, counted and dropped one at a time
+            items = ItemsSummary()
+            for _ in cursor.elements():
+                items.add(cursor.value())
+        else:
+            fields[key] = cursor.value()
+        if cursor.peek() == "}":
+            cursor.pos += 1
+            break
+        cursor.expect(",")
+    # The items were checked while streaming; the schema only needs to see that they were a list
+    payload = {**fields, "items": []} if items is not None else fields
+    return _analyze(payload, items, fields)
+
+def validate_json_stream(raw: Union[str, bytes]) -> Dict[str, Any]:
+    """Validate a JSON document, or an array of documents, without building the items in memory.
+
+    Each document's line items are summed and checked as they are decoded; processed_data holds
+    the other top-level fields. Raises json.JSONDecodeError on malformed input.
+    """
+    cursor = _Cursor(raw.decode() if isinstance(raw, (bytes, bytearray)) else raw)
+    if cursor.peek() == "[":
+        documents = []
+        for _ in cursor.elements():
+            if cursor.peek() == "{":
+                documents.append(_stream_document(cursor))
+            else:
+                documents.append(parse_json(cursor.value()))
+        result = {
+            "valid": all(document["valid"] for document in documents),
+            "document_type": "batch",
+            "count": len(documents),
+            "documents": documents,
+        }
+    else:
+        result = _stream_document(cursor)
+    if _WHITESPACE.match(cursor.text, cursor.pos).end() != len(cursor.text):
+        raise json.JSONDecodeError("Extra data", cursor.text, cursor.pos)
     return result
@@ -0,0 +1,131 @@
+import re
+from typing import Dict, Any, Iterable, List
+
+# Indicator lists used by the classifier, PDF and email agents. Every term is compiled into
+# one shared matcher, so adding terms does not add passes over the document.
+CLASSIFIER_INDICATORS = {
+    "rfq": ['request for quote', 'rfq', 'price inquiry', 'quotation request'],
+    "invoice": ['invoice', 'bill', 'payment', 'amount due'],
+    "complaint": ['complaint', 'issue', 'problem', 'dissatisfied', 'unhappy'],
+    "severe": ['urgent', 'immediate', 'serious', 'critical'],
+    "regulation": ['regulation', 'policy', 'compliance', 'directive', 'law'],
+    "policy_types": ['safety', 'environmental', 'financial', 'data protection'],
+    "attachment": ['attachment'],
+}
+
+PDF_TYPE_INDICATORS = {
+    "invoice": {
+        "terms": ["invoice", "bill", "payment", "amount due", "total amount"],
+        "confidence": 0.8
+    },
+    "rfq": {
+        "terms": ["quotation", "quote", "rfq", "price request", "pricing"],
+        "confidence": 0.8
+    },
+    "complaint": {
+        "terms": ["complaint", "dissatisfaction", "issue", "problem", "unsatisfactory"],
+        "confidence": 0.7
+    },
+    "regulation": {
+        "terms": ["regulation", "policy", "compliance", "directive", "guidelines"],
+        "confidence": 0.9
+    }
+}
+
+EMAIL_INDICATORS = {
+    "urgency": ["urgent", "asap", "emergency"],
+    "rfq": ["request for quote", "rfq"],
+    "complaint": ["complaint", "dissatisfied"],
+    "invoice": ["invoice", "payment"],
+}
+
+
+class KeywordHits:
+    """Offsets of every keyword found in a text (offsets index the lowercased text)"""
+
+    def __init__(self, offsets: Dict[str, List[int]]):
+        self.offsets = offsets
+
+    def count(self, keyword: str) -> int:
+        return len(self.offsets.get(keyword, ()))
+
+    def any(self, keywords: Iterable[str]) -> bool:
+        return any(keyword in self.offsets for keyword in keywords)
+
+    @property
+    def counts(self) -> Dict[str, int]:
+        return {keyword: len(found) for keyword, found in self.offsets.items()}
+
+
+class KeywordMatcher:
+    """Finds any number of keywords in a single linear pass.
+
+    The keywords are compiled into one trie-shaped regex, so each text position is tested
+    against a shared prefix tree rather than against every keyword in turn.
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        self.keywords = sorted({keyword.lower() for keyword in keywords if keyword})
+        trie: Dict[str, Any] = {}
+        for keyword in self.keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = True
+        self._pattern = re.compile(self._trie_pattern(trie))
+        # The regex reports the longest keyword starting at a position; shorter keywords
+        # starting there are necessarily prefixes of it
+        self._prefixes = {
+            keyword: [other for other in self.keywords if keyword.startswith(other)]
+            for keyword in self.keywords
+        }
+
+    @classmethod
+    def _trie_pattern(cls, node: Dict[str, Any]) -> str:
+        branches = [re.escape(char) + cls._trie_pattern(child) for char, child in node.items() if char != ""]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Optional greedy group: prefer the longer keyword, fall back to the one ending here
+        return f"(?:{body})?" if "" in node else body
+
+    def scan(self, text: str) -> KeywordHits:
+        return self.scan_lowered(text.lower())
+
+    def scan_lowered(self, text_lower: str) -> KeywordHits:
+        """scan() for text the caller has already lowercased"""
+        offsets: Dict[str, List[int]] = {}
+        if not text_lower or not self.keywords:
+            return KeywordHits(offsets)
+        search = self._pattern.search
+        pos = 0
+        # Restart one character after each match start so overlapping keywords
+        # ("total amount" / "amount due") are all reported
+        while True:
+            match = search(text_lower, pos)
+            if match is None:
+                break
+            start = match.start()
+            for keyword in self._prefixes[match.group(0)]:
+                offsets.setdefault(keyword, []).append(start)
+            pos = start + 1
+        return KeywordHits(offsets)
+
+
+def _all_terms() -> List[str]:
+    terms = [term for group in CLASSIFIER_INDICATORS.values() for term in group]
+    terms += [term for info in PDF_TYPE_INDICATORS.values() for term in info["terms"]]
+    terms += [term for group in EMAIL_INDICATORS.values() for term in group]
+    return terms
+
+
+MATCHER = KeywordMatcher(_all_terms())
+
+
+def scan(text: str) -> KeywordHits:
+    """Scan text once with the matcher shared by all agents"""
+    return MATCHER.scan(text)
+
+
+def scan_lowered(text_lower: str) -> KeywordHits:
+    return MATCHER.scan_lowered(text_lower)
@@ -0,0 +1,216 @@
+import abc
+import asyncio
+import hashlib
+import json
+import os
+import time
+import weakref
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from cachetools import LRUCache
+
+from app.agents.classifier_agent import INTENT_RULES, clean_response, get_genai
+
+# Optional LLM tier behind the keyword rules. It only sees documents whose rule confidence is
+# below LLM_CONFIDENCE_THRESHOLD. Documents arriving within LLM_BATCH_WINDOW_MS of each other
+# share one prompt. Any failure or timeout keeps the rule result.
+LLM_CLASSIFIER = os.getenv("LLM_CLASSIFIER", "")  # "" (off), "gemini" or "stub"
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+LLM_CONFIDENCE_THRESHOLD = float(os.getenv("LLM_CONFIDENCE_THRESHOLD", "0.6"))
+LLM_BATCH_WINDOW_MS = float(os.getenv("LLM_BATCH_WINDOW_MS", "20"))
+LLM_BATCH_MAX = int(os.getenv("LLM_BATCH_MAX", "8"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "5"))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "4096"))
+# Only the start of a document goes into the prompt
+LLM_MAX_CHARS = int(os.getenv("LLM_MAX_CHARS", "4000"))
+LLM_STUB_LATENCY_MS = float(os.getenv("LLM_STUB_LATENCY_MS", "0"))
+
+INTENTS = [rule[0] for rule in INTENT_RULES] + ["unknown"]
+
+LLMResult = Dict[str, Any]
+
+
+class LLMBackend(abc.ABC):
+    """Classifies a batch of documents with one model call; returns one {"intent", "confidence"} per text"""
+
+    name = "llm"
+
+    @abc.abstractmethod
+    async def classify_batch(self, texts: List[str]) -> List[LLMResult]:
+        ...
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, model: str = LLM_MODEL):
+        self.model = model
+        self._client = None
+
+    def build_prompt(self, texts: List[str]) -> str:
+        documents = "\n\n".join(f"### Document {number}\n{text}" for number, text in enumerate(texts))
+        return (
+            f"Classify each business document as one of: {', '.join(INTENTS)}.\n"
+            f"Answer with only a JSON array of {len(texts)} objects in document order, each "
+            '{"intent": <label>, "confidence": <0..1>}.\n\n' + documents
+        )
+
+    async def classify_batch(self, texts: List[str]) -> List[LLMResult]:
+        if self._client is None:
+            self._client = get_genai().GenerativeModel(self.model)
+        response = await self._client.generate_content_async(self.build_prompt(texts))
+        results = json.loads(clean_response(response.text))
+        if not isinstance(results, list) or len(results) != len(texts):
+            raise ValueError("LLM returned a malformed batch")
+        return results
+
+
+class StubBackend(LLMBackend):
+    """Local stand-in for tests and load tests: answers with `responder` after an optional delay"""
+
+    name = "stub"
+
+    def __init__(self, responder: Optional[Callable[[str], LLMResult]] = None, latency_ms: float = LLM_STUB_LATENCY_MS):
+        self.responder = responder or (lambda text: {"intent": "unknown", "confidence": 0.0})
+        self.latency_ms = latency_ms
+        self.batches: List[List[str]] = []
+
+    async def classify_batch(self, texts: List[str]) -> List[LLMResult]:
+        self.batches.append(list(texts))
+        if self.latency_ms:
+            await asyncio.sleep(self.latency_ms / 1000)
+        return [self.responder(text) for text in texts]
+
+
+class _Batcher:
+    """Coalesces concurrent requests on one event loop into batched backend calls"""
+
+    def __init__(self, backend: LLMBackend):
+        self.backend = backend
+        self._semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        self._waiting: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Identical documents already waiting or in flight share one slot in the batch
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def submit(self, key: str, text: str) -> asyncio.Future:
+        future = self._inflight.get(key)
+        if future is not None:
+            return future
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        self._waiting.append((text, future))
+        if len(self._waiting) >= LLM_BATCH_MAX:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(LLM_BATCH_WINDOW_MS / 1000, self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._waiting = self._waiting, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(batch))
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            async with self._semaphore:
+                results = await asyncio.wait_for(
+                    self.backend.classify_batch([text for text, _ in batch]), timeout=LLM_TIMEOUT
+                )
+        except Exception as e:
+            # Timeouts and model errors fall back to the rule result
+            _stats["timeouts" if isinstance(e, asyncio.TimeoutError) else "errors"] += 1
+            results = [None] * len(batch)
+        _stats["batches"] += 1
+        _stats["batched_documents"] += len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+_backend: Optional[LLMBackend] = None
+_batchers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _Batcher]" = weakref.WeakKeyDictionary()
+_cache: LRUCache = LRUCache(maxsize=LLM_CACHE_SIZE)
+_stats = {"calls": 0, "cache_hits": 0, "batches": 0, "batched_documents": 0, "timeouts": 0, "errors": 0}
+
+
+def set_backend(backend: Optional[LLMBackend]) -> None:
+    """Install a backend (None disables the LLM tier); clears the response cache"""
+    global _backend
+    _backend = backend
+    _batchers.clear()
+    _cache.clear()
+
+
+def get_backend() -> Optional[LLMBackend]:
+    global _backend
+    if _backend is None and LLM_CLASSIFIER:
+        _backend = GeminiBackend() if LLM_CLASSIFIER == "gemini" else StubBackend()
+    return _backend
+
+
+def _batcher(backend: LLMBackend) -> _Batcher:
+    loop = asyncio.get_running_loop()
+    batcher = _batchers.get(loop)
+    if batcher is None or batcher.backend is not backend:
+        batcher = _batchers[loop] = _Batcher(backend)
+    return batcher
+
+
+def _valid(result: Any) -> bool:
+    return (
+        isinstance(result, dict)
+        and result.get("intent") in INTENTS
+        and isinstance(result.get("confidence"), (int, float))
+    )
+
+
+def needs_refinement(classification: Dict[str, Any]) -> bool:
+    return get_backend() is not None and classification["metadata"]["confidence_score"] < LLM_CONFIDENCE_THRESHOLD
+
+
+async def refine_classification(text: str, classification: Dict[str, Any]) -> Dict[str, Any]:
+    """Ask the LLM tier about a low-confidence rule classification; keeps the rule result on any failure"""
+    if not needs_refinement(classification):
+        return classification
+    backend = get_backend()
+    metadata = classification["metadata"]
+
+    prompt_text = text[:LLM_MAX_CHARS]
+    key = hashlib.sha256(f"{backend.name}\0{getattr(backend, 'model', '')}\0{prompt_text}".encode()).hexdigest()
+    _stats["calls"] += 1
+    result = _cache.get(key)
+    if result is not None:
+        _stats["cache_hits"] += 1
+    else:
+        start = time.perf_counter()
+        # Shielded: a cancelled request must not cancel the answer other documents are waiting for
+        result = await asyncio.shield(_batcher(backend).submit(key, prompt_text))
+        if _valid(result):
+            _cache[key] = result
+        metadata["llm_latency_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+    if not _valid(result):
+        metadata["classified_by"] = "rules"
+        metadata["llm_fallback"] = True
+        return classification
+    if result["intent"] == "unknown" or result["confidence"] <= metadata["confidence_score"]:
+        metadata["classified_by"] = "rules"
+        return classification
+    metadata["classified_by"] = backend.name
+    metadata["rule_intent"] = classification["intent"]
+    metadata["confidence_score"] = float(result["confidence"])
+    if result["intent"] != classification["intent"]:
+        classification["subtype"] = None
+    classification["intent"] = result["intent"]
+    return classification
+
+
+def llm_stats() -> Dict[str, Any]:
+    return {**_stats, "backend": _backend.name if _backend else LLM_CLASSIFIER or None, "cache_entries": len(_cache)}
@@ -1,15 +1,113 @@
+import asyncio
 import io
-from pdfminer.high_level import extract_text_to_fp
+import mmap
+import os
+import pathlib
+import tempfile
+import time
+from contextlib import contextmanager
+from pdfminer.converter import TextConverter
 from pdfminer.layout import LAParams
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdftypes import resolve1
 import base64
-from typing import Dict, Any, Union
+from typing import Dict, Any, Union, Iterator, BinaryIO, Optional, Tuple
+from app.agents.keywords import PDF_TYPE_INDICATORS, KeywordHits, scan
+from app.executor import run_cpu_bound, run_io_bound, PDF_POOL_SIZE, TaskTimeoutError
 
-def extract_text_from_pdf(pdf_content: str) -> Dict[str, Any]:
-    """Extract text from a base64 encoded PDF content"""
+# Documents at least this large (bytes) are split into page ranges across the process pool
+PDF_PARALLEL_MIN_BYTES = int(os.getenv("PDF_PARALLEL_MIN_BYTES", str(2 * 1024 * 1024)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# "classify_first" mode extracts this many pages at a time until a document type is found
+PDF_CLASSIFY_FIRST_PAGES = int(os.getenv("PDF_CLASSIFY_FIRST_PAGES", "2"))
+# Hard budgets per document; 0 disables them
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "0"))
+PDF_TIME_BUDGET = float(os.getenv("PDF_TIME_BUDGET", "0"))
+
+PDF_EXTRACTION_MODES = ("full", "classify_first")
+
+# base64 text from JSON callers, raw bytes from uploads, or a path to a spooled upload
+PdfSource = Union[str, bytes, bytearray, memoryview, "os.PathLike[str]"]
+
+@contextmanager
+def _open_pdf_source(pdf_content: Union[bytes, bytearray, memoryview, "os.PathLike[str]"]) -> Iterator[BinaryIO]:
+    """Expose raw PDF bytes or a PDF file as a seekable binary file without copying it"""
+    if isinstance(pdf_content, os.PathLike):
+        with open(pdf_content, 'rb') as pdf_file:
+            if os.fstat(pdf_file.fileno()).st_size == 0:
+                yield io.BytesIO(b"")
+                return
+            # Map the spooled file so pdfminer reads it straight from the page cache
+            with mmap.mmap(pdf_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                yield mapped
+    else:
+        # BytesIO shares the buffer of an immutable bytes object until it is written to
+        yield io.BytesIO(pdf_content)
+
+def _decode_pdf_source(pdf_content: PdfSource) -> Union[bytes, bytearray, memoryview, "os.PathLike[str]"]:
+    # Only JSON callers send base64; decode it once
+    if isinstance(pdf_content, str):
+        return base64.b64decode(pdf_content)
+    return pdf_content
+
+def _extract_page_range(
+    pdf_file: BinaryIO,
+    first_page: int = 0,
+    max_pages: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[str, int, bool]:
+    """Extract text page by page; returns (text, pages extracted, stopped by deadline).
+
+    Pages are separated by form feeds, exactly as pdfminer's extract_text_to_fp writes them.
+    """
+    rsrcmgr = PDFResourceManager()
+    output = io.StringIO()
+    device = TextConverter(rsrcmgr, output, laparams=LAParams())
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    document = PDFDocument(PDFParser(pdf_file))
+    pages = 0
+    timed_out = False
     try:
-        # Validate base64 content
+        for page_number, page in enumerate(PDFPage.create_pages(document)):
+            if page_number < first_page:
+                continue
+            if max_pages is not None and pages >= max_pages:
+                break
+            # Checked between pages, so one pathological page can still overrun the budget
+            if deadline is not None and time.time() >= deadline:
+                timed_out = True
+                break
+            interpreter.process_page(page)
+            pages += 1
+    finally:
+        device.close()
+    return output.getvalue(), pages, timed_out
+
+def count_pdf_pages(pdf_content: PdfSource) -> int:
+    """Read the page count from the page tree without extracting any text; 0 if it is not a PDF"""
+    with _open_pdf_source(_decode_pdf_source(pdf_content)) as pdf_file:
+        if pdf_file.read(4) != b'%PDF':
+            return 0
+        pdf_file.seek(0)
+        document = PDFDocument(PDFParser(pdf_file))
         try:
-            pdf_bytes = base64.b64decode(pdf_content)
+            return int(resolve1(resolve1(document.catalog["Pages"])["Count"]))
+        except (KeyError, TypeError, ValueError):
+            return sum(1 for _ in PDFPage.create_pages(document))
+
+def extract_pdf_page_range(
+    pdf_content: PdfSource,
+    first_page: int = 0,
+    max_pages: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Extract a range of pages; an empty range is not an error. Runs in a worker process."""
+    try:
+        try:
+            pdf_content = _decode_pdf_source(pdf_content)
         except Exception as e:
             return {
                 "success": False,
@@ -17,33 +115,33 @@ def extract_text_from_pdf(pdf_content: str) -> Dict[str, Any]:
                 "error": f"Invalid base64 content: {str(e)}"
             }
 
-        # Check for PDF signature
-        if not pdf_bytes.startswith(b'%PDF'):
-            # If not a real PDF, just treat it as text for testing
-            return {
-                "success": True,
-                "text": base64.b64decode(pdf_content).decode('utf-8'),
-                "error": None
-            }
+        with _open_pdf_source(pdf_content) as pdf_file:
+            # Check for PDF signature
+            if pdf_file.read(4) != b'%PDF':
+                # If not a real PDF, just treat it as text for testing
+                pdf_file.seek(0)
+                return {
+                    "success": True,
+                    "text": pdf_file.read().decode('utf-8') if first_page == 0 else "",
+                    "error": None,
+                    "pages_extracted": 1 if first_page == 0 else 0,
+                    "timed_out": False
+                }
 
-        output = io.StringIO()
-        with io.BytesIO(pdf_bytes) as pdf_file:
+            pdf_file.seek(0)
             # Extract text with PDFMiner
-            extract_text_to_fp(pdf_file, output, laparams=LAParams())
-            text = output.getvalue()
+            text, pages, timed_out = _extract_page_range(pdf_file, first_page, max_pages, deadline)
 
-        if not text:
-            return {
-                "success": False,
-                "text": None,
-                "error": "No text could be extracted from the PDF"
-            }
-        
         return {
             "success": True,
             "text": text,
-            "error": None
+            "error": None,
+            "pages_extracted": pages,
+            "timed_out": timed_out
         }
+    except TaskTimeoutError:
+        # The worker's alarm: let run_cpu_bound's caller answer 504 rather than report a bad PDF
+        raise
     except Exception as e:
         return {
             "success": False,
@@ -51,7 +149,156 @@ def extract_text_from_pdf(pdf_content: str) -> Dict[str, Any]:
             "error": f"PDF processing error: {str(e)}"
         }
 
-def analyze_pdf_content(text: str) -> Dict[str, Any]:
+def extract_text_from_pdf(pdf_content: PdfSource) -> Dict[str, Any]:
+    """Extract text from a base64 encoded PDF, raw PDF bytes or a path to a PDF file"""
+    extraction = extract_pdf_page_range(pdf_content)
+    if extraction["success"] and not extraction["text"]:
+        return {
+            "success": False,
+            "text": None,
+            "error": "No text could be extracted from the PDF"
+        }
+    return {
+        "success": extraction["success"],
+        "text": extraction["text"],
+        "error": extraction["error"]
+    }
+
+def _source_size(pdf_content: PdfSource) -> int:
+    if isinstance(pdf_content, os.PathLike):
+        return os.path.getsize(pdf_content)
+    if isinstance(pdf_content, str):
+        return len(pdf_content) * 3 // 4
+    return len(pdf_content)
+
+def _spool_pdf(pdf_content: PdfSource) -> pathlib.Path:
+    """Write the PDF once to a temp file so each worker maps it instead of receiving a pickled copy"""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as spooled:
+        spooled.write(_decode_pdf_source(pdf_content))
+    return pathlib.Path(spooled.name)
+
+def _finish_extraction(text: str, pages: int, total_pages: Optional[int], mode: str, truncated: bool) -> Dict[str, Any]:
+    if not text:
+        return {
+            "success": False,
+            "text": None,
+            "error": "No text could be extracted from the PDF"
+        }
+    return {
+        "success": True,
+        "text": text,
+        "error": None,
+        "extraction": {
+            "mode": mode,
+            "pages_extracted": pages,
+            "total_pages": total_pages,
+            "truncated": truncated
+        }
+    }
+
+async def extract_text_paged(pdf_content: PdfSource, mode: str = "full") -> Dict[str, Any]:
+    """Page-level extraction engine used by the API.
+
+    "full" extracts every page (up to PDF_MAX_PAGES), splitting large documents into page ranges
+    that run in parallel on the process pool and are merged back in page order. "classify_first"
+    extracts PDF_CLASSIFY_FIRST_PAGES pages at a time and stops as soon as a document type is
+    detected. Both honour PDF_TIME_BUDGET.
+    """
+    if mode not in PDF_EXTRACTION_MODES:
+        raise ValueError(f"Unknown PDF extraction mode: {mode}")
+    deadline = time.time() + PDF_TIME_BUDGET if PDF_TIME_BUDGET > 0 else None
+    max_pages = PDF_MAX_PAGES or None
+
+    if mode == "classify_first":
+        return await _extract_classify_first(pdf_content, max_pages, deadline)
+
+    if PDF_POOL_SIZE > 1 and _source_size(pdf_content) >= PDF_PARALLEL_MIN_BYTES:
+        return await _extract_parallel(pdf_content, max_pages, deadline)
+    # Small documents (or no process pool to fan out to) are extracted by a single task
+    return await _extract_single(pdf_content, max_pages, deadline)
+
+async def _extract_classify_first(pdf_content: PdfSource, max_pages: Optional[int], deadline: Optional[float]) -> Dict[str, Any]:
+    spooled = None
+    try:
+        if PDF_POOL_SIZE > 0 and not isinstance(pdf_content, os.PathLike):
+            # Each step is a separate task; send them all the path rather than a pickled copy each
+            try:
+                pdf_content = spooled = await run_io_bound(_spool_pdf, pdf_content)
+            except ValueError:
+                # Bad base64: left to the worker, which reports it like any other bad PDF
+                pass
+        chunks = []
+        pages = 0
+        while True:
+            batch = PDF_CLASSIFY_FIRST_PAGES if max_pages is None else min(PDF_CLASSIFY_FIRST_PAGES, max_pages - pages)
+            chunk = await run_cpu_bound(extract_pdf_page_range, pdf_content, pages, batch, deadline)
+            if not chunk["success"]:
+                return chunk
+            chunks.append(chunk["text"])
+            pages += chunk["pages_extracted"]
+            text = "".join(chunks)
+            end_of_document = chunk["pages_extracted"] < batch and not chunk["timed_out"]
+            if end_of_document:
+                return _finish_extraction(text, pages, pages, "classify_first", False)
+            # Either way the text stops short of the end of the document
+            budget_spent = chunk["timed_out"] or (max_pages is not None and pages >= max_pages)
+            if budget_spent or detect_pdf_type(text)[0] != "unknown":
+                return _finish_extraction(text, pages, None, "classify_first", True)
+    finally:
+        if spooled is not None:
+            spooled.unlink(missing_ok=True)
+
+async def _extract_single(pdf_content: PdfSource, max_pages: Optional[int], deadline: Optional[float]) -> Dict[str, Any]:
+    extraction = await run_cpu_bound(extract_pdf_page_range, pdf_content, 0, max_pages, deadline)
+    if not extraction["success"]:
+        return extraction
+    truncated = extraction["timed_out"] or (max_pages is not None and extraction["pages_extracted"] >= max_pages)
+    return _finish_extraction(extraction["text"], extraction["pages_extracted"], None, "full", truncated)
+
+async def _extract_parallel(pdf_content: PdfSource, max_pages: Optional[int], deadline: Optional[float]) -> Dict[str, Any]:
+    spooled = None
+    try:
+        if not isinstance(pdf_content, os.PathLike):
+            pdf_content = spooled = await run_io_bound(_spool_pdf, pdf_content)
+        total_pages = await run_cpu_bound(count_pdf_pages, pdf_content)
+        limit = total_pages if max_pages is None else min(total_pages, max_pages)
+        if limit <= PDF_PAGES_PER_TASK:
+            # Not a PDF, or too few pages to be worth splitting
+            return await _extract_single(pdf_content, max_pages, deadline)
+        ranges = [(first, min(PDF_PAGES_PER_TASK, limit - first)) for first in range(0, limit, PDF_PAGES_PER_TASK)]
+        chunks = await asyncio.gather(*(
+            run_cpu_bound(extract_pdf_page_range, pdf_content, first, count, deadline)
+            for first, count in ranges
+        ))
+    finally:
+        if spooled is not None:
+            spooled.unlink(missing_ok=True)
+
+    for chunk in chunks:
+        if not chunk["success"]:
+            return chunk
+    # A range cut short by the deadline leaves a gap, so keep only the contiguous prefix
+    text_parts = []
+    pages = 0
+    truncated = limit < total_pages
+    for chunk, (first, count) in zip(chunks, ranges):
+        text_parts.append(chunk["text"])
+        pages += chunk["pages_extracted"]
+        if chunk["pages_extracted"] < count:
+            truncated = True
+            break
+    return _finish_extraction("".join(text_parts), pages, total_pages, "full", truncated)
+
+def detect_pdf_type(text: str, hits: Optional[KeywordHits] = None) -> Tuple[str, float]:
+    """Return the first document type whose indicators appear in the text, with its confidence"""
+    if hits is None:
+        hits = scan(text)
+    for dtype, info in PDF_TYPE_INDICATORS.items():
+        if hits.any(info["terms"]):
+            return dtype, info["confidence"]
+    return "unknown", 0.0
+
+def analyze_pdf_content(text: str, hits: Optional[KeywordHits] = None) -> Dict[str, Any]:
     """Analyze the extracted text to determine document type and extract key information"""
     if not text:
         return {
@@ -63,38 +310,8 @@ def analyze_pdf_content(text: str) -> Dict[str, Any]:
             }
         }
 
-    text_lower = text.lower()
-    
     # Document type detection
-    doc_type = "unknown"
-    confidence = 0.0
-    
-    # Define document type indicators with confidence scores
-    type_indicators = {
-        "invoice": {
-            "terms": ["invoice", "bill", "payment", "amount due", "total amount"],
-            "confidence": 0.8
-        },
-        "rfq": {
-            "terms": ["quotation", "quote", "rfq", "price request", "pricing"],
-            "confidence": 0.8
-        },
-        "complaint": {
-            "terms": ["complaint", "dissatisfaction", "issue", "problem", "unsatisfactory"],
-            "confidence": 0.7
-        },
-        "regulation": {
-            "terms": ["regulation", "policy", "compliance", "directive", "guidelines"],
-            "confidence": 0.9
-        }
-    }
-
-    # Detect document type
-    for dtype, info in type_indicators.items():
-        if any(term in text_lower for term in info["terms"]):
-            doc_type = dtype
-            confidence = info["confidence"]
-            break
+    doc_type, confidence = detect_pdf_type(text, hits)
 
     return {
         "document_type": doc_type,
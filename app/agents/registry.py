@@ -0,0 +1,52 @@
+import importlib
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+# Pipeline handlers keyed by content type. A handler declares the modules it needs instead of
+# importing them at the top of app.main, so pdfminer, bs4 and friends are only loaded by the
+# first document that needs them (or by warm_up()).
+AgentHandler = Callable[..., Awaitable[None]]
+
+# Content types to load at startup: "" (none), "all", or a comma-separated list like "pdf_base64,email"
+AGENT_WARMUP = os.getenv("AGENT_WARMUP", "")
+
+_handlers: Dict[str, AgentHandler] = {}
+_modules: Dict[str, Tuple[str, ...]] = {}
+
+
+def register(content_type: str, *modules: str) -> Callable[[AgentHandler], AgentHandler]:
+    """Decorator registering the handler for a content type and the modules it imports lazily"""
+    def decorator(handler: AgentHandler) -> AgentHandler:
+        _handlers[content_type] = handler
+        _modules[content_type] = modules
+        return handler
+    return decorator
+
+
+def get_handler(content_type: str) -> Optional[AgentHandler]:
+    return _handlers.get(content_type)
+
+
+def registered_types() -> Tuple[str, ...]:
+    return tuple(_handlers)
+
+
+def warm_up(content_types: Optional[Iterable[str]] = None) -> Dict[str, float]:
+    """Import the modules behind the given content types (all by default); returns seconds per module"""
+    timings: Dict[str, float] = {}
+    for content_type in registered_types() if content_types is None else content_types:
+        for module in _modules.get(content_type, ()):
+            if module in timings:
+                continue
+            start = time.perf_counter()
+            importlib.import_module(module)
+            timings[module] = time.perf_counter() - start
+    return timings
+
+
+def warmup_types(setting: str = AGENT_WARMUP) -> Optional[Tuple[str, ...]]:
+    """Parse AGENT_WARMUP: None means every registered type, an empty tuple means none"""
+    if setting.strip() == "all":
+        return None
+    return tuple(name.strip() for name in setting.split(",") if name.strip())
@@ -0,0 +1,151 @@
+import random
+from email.message import EmailMessage
+from typing import Dict, Any, List, Sequence
+
+# Synthetic documents for the benchmarks. Everything is generated from a seeded RNG, so two
+# runs (and the baseline they are compared against) see byte-identical inputs.
+
+_WORDS = (
+    "the supplier shipment order delivery quality team product units warehouse contract schedule "
+    "customer account review pricing request invoice payment support issue regional office service "
+    "meeting report update quantity discount approval terms renewal compliance policy safety"
+).split()
+
+_INTENT_SENTENCES = {
+    "rfq": "We would like a quotation request for {n} units, please send your request for quote.",
+    "invoice": "Please find the invoice attached, the amount due is {n}.00 and payment is expected in 30 days.",
+    "complaint": "This is a formal complaint, the problem with order {n} is serious and we are dissatisfied.",
+    "regulation": "The new regulation on data protection requires compliance with directive {n}.",
+}
+
+
+def filler(rng: random.Random, words: int) -> str:
+    """Sentences of neutral filler words"""
+    sentences = []
+    while words > 0:
+        length = min(words, rng.randint(6, 16))
+        sentences.append(" ".join(rng.choice(_WORDS) for _ in range(length)).capitalize() + ".")
+        words -= length
+    return " ".join(sentences)
+
+
+def make_body(rng: random.Random, intent: str, words: int) -> str:
+    sentence = _INTENT_SENTENCES[intent].format(n=rng.randint(10, 9999))
+    return f"{sentence}\n\n{filler(rng, words)}\n\nBest regards,\nBench Sender"
+
+
+def make_email(rng: random.Random, kind: str = "plain", intent: str = "rfq", words: int = 200,
+               attachments: Sequence[bytes] = ()) -> str:
+    """An RFC 5322 message: kind is "plain", "html" or "multipart" (text + html + attachments)"""
+    msg = EmailMessage()
+    msg["From"] = "buyer@example.com"
+    msg["To"] = "sales@example.com"
+    msg["Subject"] = f"{intent.upper()} {rng.randint(1000, 9999)}"
+    msg["Message-ID"] = f"<bench-{rng.getrandbits(64):x}@example.com>"
+    body = make_body(rng, intent, words)
+    html = "<html><body>" + "".join(f"<p>{para}</p>" for para in body.split("\n\n")) + "</body></html>"
+    if kind == "plain":
+        msg.set_content(body)
+    elif kind == "html":
+        msg.set_content(html, subtype="html")
+    elif kind == "multipart":
+        msg.set_content(body)
+        msg.add_alternative(html, subtype="html")
+        for number, payload in enumerate(attachments, start=1):
+            msg.add_attachment(payload, maintype="application", subtype="pdf", filename=f"attachment_{number}.pdf")
+    else:
+        raise ValueError(f"Unknown email kind: {kind}")
+    # The generator would otherwise pick random MIME boundaries
+    for part in msg.walk():
+        if part.is_multipart():
+            part.set_boundary(f"==bench-{rng.getrandbits(64):x}==")
+    return msg.as_string()
+
+
+def make_invoice(rng: random.Random, items: int) -> Dict[str, Any]:
+    lines = [
+        {"sku": f"SKU-{rng.randint(1000, 9999)}", "quantity": rng.randint(1, 50), "amount": round(rng.uniform(1, 500), 2)}
+        for _ in range(items)
+    ]
+    total = round(sum(line["amount"] for line in lines), 2)
+    return {
+        "invoice_number": f"INV-{rng.randint(10000, 99999)}",
+        "date": "2024-01-15",
+        "amount": total,
+        "customer": {"name": "Acme Corp", "id": f"CUST-{rng.randint(100, 999)}"},
+        "items": lines,
+        "tax": round(total * 0.2, 2),
+        "total": total,
+    }
+
+
+def make_rfq(rng: random.Random, items: int) -> Dict[str, Any]:
+    return {
+        "rfq_number": f"RFQ-{rng.randint(10000, 99999)}",
+        "date": "2024-01-15",
+        "deadline": "2024-02-15",
+        "customer": {"name": "Globex", "id": f"CUST-{rng.randint(100, 999)}"},
+        "items": [
+            {"sku": f"SKU-{rng.randint(1000, 9999)}", "quantity": rng.randint(1, 500), "notes": filler(rng, 8)}
+            for _ in range(items)
+        ],
+    }
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: Sequence[str]) -> bytes:
+    """Build a real PDF with one page per string; each line of a string is one line of Helvetica text"""
+    objects: List[Any] = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = " T* ".join(f"({_pdf_escape(line)}) Tj" for line in text.split("\n"))
+        stream = f"BT /F1 12 Tf 14 TL 72 720 Td {lines} ET".encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >> "
+            b"/Contents %d 0 R >>" % (len(objects))
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def make_pdf_document(rng: random.Random, intent: str = "invoice", pages: int = 4, lines_per_page: int = 40) -> bytes:
+    """A multi-page PDF whose first page carries the intent, followed by pages of filler text"""
+    texts = []
+    for page in range(pages):
+        lines = [filler(rng, 10) for _ in range(lines_per_page)]
+        if page == 0:
+            lines[0] = _INTENT_SENTENCES[intent].format(n=rng.randint(10, 9999))
+        texts.append("\n".join(lines))
+    return make_pdf(texts)
+
+
+def build_corpus(seed: int = 0, scale: int = 1) -> Dict[str, Dict[str, Any]]:
+    """Inputs for every benchmark, keyed by benchmark tier; `scale` multiplies document sizes"""
+    rng = random.Random(seed)
+    small_pdf = make_pdf_document(rng, "invoice", pages=1, lines_per_page=10)
+    return {
+        "email_plain": {"email": make_email(rng, "plain", "rfq", 150 * scale)},
+        "email_html": {"email": make_email(rng, "html", "complaint", 600 * scale)},
+        "email_multipart": {"email": make_email(rng, "multipart", "invoice", 600 * scale, [small_pdf, small_pdf])},
+        "json_invoice_10": {"json": make_invoice(rng, 10 * scale)},
+        "json_invoice_1000": {"json": make_invoice(rng, 1000 * scale)},
+        "json_rfq_5000": {"json": make_rfq(rng, 5000 * scale)},
+        "pdf_1_page": {"pdf": small_pdf},
+        "pdf_8_pages": {"pdf": make_pdf_document(rng, "rfq", pages=8 * scale)},
+        "pdf_40_pages": {"pdf": make_pdf_document(rng, "regulation", pages=40 * scale)},
+    }
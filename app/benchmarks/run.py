@@ -0,0 +1,270 @@
+import argparse
+import asyncio
+import base64
+import gc
+import json
+import os
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from app.benchmarks.corpus import build_corpus
+
+BENCH_BASELINE = os.getenv("BENCH_BASELINE", str(pathlib.Path(__file__).with_name("baseline.json")))
+# A run fails when a benchmark's p50 or p95 is this much slower than the baseline (0.2 = 20%)
+BENCH_REGRESSION_THRESHOLD = float(os.getenv("BENCH_REGRESSION_THRESHOLD", "0.2"))
+BENCH_ITERATIONS = int(os.getenv("BENCH_ITERATIONS", "30"))
+BENCH_WARMUP = int(os.getenv("BENCH_WARMUP", "3"))
+# Timings below this are noise on a shared machine and are never reported as regressions
+BENCH_MIN_REGRESSION_MS = float(os.getenv("BENCH_MIN_REGRESSION_MS", "0.5"))
+
+# Metrics compared against the baseline, with the smallest change that counts. p99 of a few dozen
+# samples is too noisy to gate on; rss_mb is only reported by the startup benchmarks.
+GATED_METRICS = {"p50_ms": BENCH_MIN_REGRESSION_MS, "p95_ms": BENCH_MIN_REGRESSION_MS, "rss_mb": 1.0}
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    """Nearest-rank percentile of already-sorted samples"""
+    if not samples:
+        return 0.0
+    rank = max(1, -(-len(samples) * pct // 100))
+    return samples[int(rank) - 1]
+
+
+def measure(fn: Callable[[], Any], iterations: int = BENCH_ITERATIONS, warmup: int = BENCH_WARMUP) -> Dict[str, float]:
+    """Time `iterations` calls of fn after `warmup` untimed ones; latencies are in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+            gc.collect()
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return summarize(samples)
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Throughput and latency percentiles of a list of millisecond timings"""
+    samples = sorted(samples)
+    total_s = sum(samples) / 1000
+    return {
+        "iterations": len(samples),
+        "throughput_per_s": len(samples) / total_s if total_s else 0.0,
+        "mean_ms": statistics.fmean(samples),
+        "p50_ms": percentile(samples, 50),
+        "p95_ms": percentile(samples, 95),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": samples[-1],
+    }
+
+
+def agent_benchmarks(corpus: Dict[str, Dict[str, Any]]) -> Dict[str, Callable[[], Any]]:
+    """One zero-argument callable per agent and input tier"""
+    from app.agents.classifier_agent import classify_input
+    from app.agents.email_agent import parse_email
+    from app.agents.json_agent import parse_json
+    from app.agents.pdf_agent import extract_text_from_pdf
+
+    benches: Dict[str, Callable[[], Any]] = {}
+    for tier, case in corpus.items():
+        if "email" in case:
+            benches[f"classify_input[{tier}]"] = lambda text=case["email"]: classify_input(text)
+            benches[f"parse_email[{tier}]"] = lambda text=case["email"]: parse_email(text)
+        elif "json" in case:
+            text = json.dumps(case["json"])
+            benches[f"classify_input[{tier}]"] = lambda text=text: classify_input(text)
+            benches[f"parse_json[{tier}]"] = lambda payload=case["json"]: parse_json(payload)
+        elif "pdf" in case:
+            benches[f"extract_text_from_pdf[{tier}]"] = lambda pdf=case["pdf"]: extract_text_from_pdf(pdf)
+    return benches
+
+
+def end_to_end_benchmarks(corpus: Dict[str, Dict[str, Any]]) -> Dict[str, Callable[[], Any]]:
+    """POST /process/ through the TestClient, with the result cache off so every call does the work"""
+    from fastapi.testclient import TestClient
+    import app.memory.result_cache as result_cache
+    from app.main import app
+
+    result_cache.RESULT_CACHE_ENABLED = False
+    client = TestClient(app)
+
+    def post(body: Dict[str, Any]) -> None:
+        response = client.post("/process/", json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"/process/ returned {response.status_code}: {response.text[:200]}")
+
+    benches: Dict[str, Callable[[], Any]] = {}
+    for tier, case in corpus.items():
+        body = {"id": f"bench_{tier}"}
+        if "email" in case:
+            body.update(content=case["email"], content_type="email")
+        elif "json" in case:
+            body.update(content="", json=case["json"])
+        elif "pdf" in case:
+            body.update(content=base64.b64encode(case["pdf"]).decode(), content_type="pdf_base64")
+        benches[f"process[{tier}]"] = lambda body=body: post(body)
+    return benches
+
+
+def storage_benchmarks(corpus: Dict[str, Dict[str, Any]], include_redis: bool = True) -> Dict[str, Callable[[], Any]]:
+    """The record API and store_document/get_document_data on every storage backend, with the same
+    email analysis record"""
+    from app.agents.email_agent import parse_email
+    from app.memory import shared_memory
+    from app.memory.backends import MemoryBackend, SQLiteBackend
+
+    record = parse_email(corpus["email_html"]["email"])
+    backends = {
+        "memory": MemoryBackend(),
+        "sqlite": SQLiteBackend(str(pathlib.Path(tempfile.mkdtemp(prefix="bench_storage_")) / "records.db")),
+    }
+    if include_redis:
+        backends["redis"] = shared_memory.RedisBackend()
+
+    def on(backend, fn: Callable[[], Any]) -> Callable[[], Any]:
+        def run() -> Any:
+            previous = shared_memory.set_storage_backend(backend)
+            try:
+                return fn()
+            finally:
+                shared_memory.set_storage_backend(previous)
+        return run
+
+    # One loop for every call, so the Redis pool opened by the first is reused
+    loop = asyncio.new_event_loop()
+    benches: Dict[str, Callable[[], Any]] = {}
+    for name, backend in backends.items():
+        key = f"bench_storage_{name}"
+        entries = [("email", record, "email_agent")]
+        on(backend, lambda key=key: shared_memory.store_data(key, record, "email_agent"))()
+        benches[f"store_data[{name}]"] = on(backend, lambda key=key: shared_memory.store_data(key, record, "email_agent"))
+        benches[f"get_data[{name}]"] = on(backend, lambda key=key: shared_memory.get_data(key))
+        benches[f"update_data[{name}]"] = on(backend, lambda key=key: shared_memory.update_data(key, {"reviewed": True}))
+        on(backend, lambda key=key, entries=entries: loop.run_until_complete(shared_memory.store_document(key, entries)))()
+        benches[f"store_document[{name}]"] = on(
+            backend, lambda key=key, entries=entries: loop.run_until_complete(shared_memory.store_document(key, entries))
+        )
+        benches[f"get_document[{name}]"] = on(
+            backend, lambda key=key: loop.run_until_complete(shared_memory.get_document_data(key))
+        )
+    return benches
+
+
+def run_benchmarks(
+    names: Optional[List[str]] = None,
+    iterations: int = BENCH_ITERATIONS,
+    warmup: int = BENCH_WARMUP,
+    scale: int = 1,
+    end_to_end: bool = True,
+) -> Dict[str, Dict[str, float]]:
+    """Run every benchmark whose name contains one of `names` (all of them by default)"""
+    from app.memory.backends import STORAGE_BACKEND
+
+    corpus = build_corpus(scale=scale)
+    benches = agent_benchmarks(corpus)
+    # Redis is only benchmarked alongside /process/, which needs it anyway on the Redis backend
+    benches.update(storage_benchmarks(corpus, include_redis=end_to_end and STORAGE_BACKEND == "redis"))
+    if end_to_end:
+        benches.update(end_to_end_benchmarks(corpus))
+    results = {}
+    for name, fn in benches.items():
+        if names and not any(pattern in name for pattern in names):
+            continue
+        results[name] = measure(fn, iterations, warmup)
+    return results
+
+
+def save_baseline(results: Dict[str, Dict[str, float]], path: str = BENCH_BASELINE) -> None:
+    pathlib.Path(path).write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+
+
+def load_baseline(path: str = BENCH_BASELINE) -> Optional[Dict[str, Dict[str, float]]]:
+    try:
+        return json.loads(pathlib.Path(path).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float = BENCH_REGRESSION_THRESHOLD,
+) -> List[Tuple[str, str, float, float]]:
+    """(benchmark, metric, baseline value, current value) for every gated metric slower than allowed"""
+    regressions = []
+    for name, stats in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric, noise in GATED_METRICS.items():
+            if metric not in before or metric not in stats:
+                continue
+            old, new = before[metric], stats[metric]
+            if new > old * (1 + threshold) and new - old > noise:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def format_report(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Dict[str, float]]] = None) -> str:
+    header = f"{'benchmark':<44} {'ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS MB':>7}"
+    if baseline:
+        header += f" {'p50 vs base':>12}"
+    lines = [header, "-" * len(header)]
+    for name, stats in results.items():
+        line = (f"{name:<44} {stats['throughput_per_s']:>9.1f} {stats['p50_ms']:>9.2f} "
+                f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f} {stats.get('rss_mb', ''):>7}")
+        if baseline and name in baseline and baseline[name]["p50_ms"]:
+            change = stats["p50_ms"] / baseline[name]["p50_ms"] - 1
+            line += f" {change:>+11.1%}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the agents and /process/ on a synthetic corpus")
+    parser.add_argument("names", nargs="*", help="Only run benchmarks whose name contains one of these")
+    parser.add_argument("--iterations", type=int, default=BENCH_ITERATIONS)
+    parser.add_argument("--warmup", type=int, default=BENCH_WARMUP)
+    parser.add_argument("--scale", type=int, default=1, help="Multiply document sizes")
+    parser.add_argument("--no-end-to-end", action="store_true", help="Skip /process/ (needs no Redis)")
+    parser.add_argument("--startup", action="store_true", help="Also measure cold import time and RSS")
+    parser.add_argument("--baseline", default=BENCH_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Record this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=BENCH_REGRESSION_THRESHOLD)
+    parser.add_argument("--json", action="store_true", help="Print raw results as JSON")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names, args.iterations, args.warmup, args.scale, not args.no_end_to_end)
+    if args.startup:
+        from app.benchmarks.startup import startup_benchmarks
+        results.update(startup_benchmarks())
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    print(json.dumps(results, indent=2) if args.json else format_report(results, baseline))
+
+    if args.save_baseline:
+        # A partial run only replaces the benchmarks it measured
+        save_baseline({**(load_baseline(args.baseline) or {}), **results}, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if baseline is None:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+        return
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name, metric, old, new in regressions:
+        print(f"REGRESSION {name} {metric}: {old:.2f} -> {new:.2f} ms")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
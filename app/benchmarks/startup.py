@@ -0,0 +1,63 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, Any, List
+
+from app.benchmarks.run import summarize
+
+# Cold start of a worker: each sample is a fresh interpreter importing app.main. The probe reports
+# the import time, peak RSS and which heavy dependencies ended up loaded.
+BENCH_STARTUP_RUNS = int(os.getenv("BENCH_STARTUP_RUNS", "5"))
+
+HEAVY_MODULES = ("google.generativeai", "grpc", "pdfminer", "bs4")
+
+_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - start
+if {warm_up!r}:
+    from app.agents.registry import warm_up
+    warm_up()
+    elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "ms": elapsed * 1000,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+    "heavy": [name for name in {heavy!r} if name in sys.modules],
+}}))
+"""
+
+
+def probe(warm_up: bool = False) -> Dict[str, Any]:
+    """Import app.main (and optionally every agent) in a fresh interpreter"""
+    output = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(warm_up=warm_up, heavy=HEAVY_MODULES)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def startup_benchmarks(runs: int = BENCH_STARTUP_RUNS) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for name, warm_up in (("startup[import app.main]", False), ("startup[import + warm_up]", True)):
+        samples: List[Dict[str, Any]] = [probe(warm_up) for _ in range(runs)]
+        results[name] = {
+            **summarize([sample["ms"] for sample in samples]),
+            "rss_mb": round(statistics.median(sample["rss_mb"] for sample in samples), 1),
+            "modules": samples[-1]["modules"],
+            "heavy_modules": samples[-1]["heavy"],
+        }
+    return results
+
+
+def main() -> None:
+    for name, stats in startup_benchmarks().items():
+        print(f"{name:<28} p50 {stats['p50_ms']:8.1f} ms  RSS {stats['rss_mb']:6.1f} MB  "
+              f"{stats['modules']} modules  heavy: {', '.join(stats['heavy_modules']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
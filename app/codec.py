@@ -0,0 +1,37 @@
+import json
+import os
+from typing import Any, Callable, Union
+
+# JSON encoding shared by storage, the result cache, the job queue and responses. "auto" uses
+# orjson when it is installed and falls back to the stdlib; both write compact UTF-8 bytes.
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")  # "auto", "orjson" or "json"
+
+# orjson.JSONDecodeError subclasses this, so callers catch one exception type for either codec
+JSONDecodeError = json.JSONDecodeError
+
+
+def _stdlib_dumps(value: Any) -> bytes:
+    return json.dumps(value, separators=(",", ":")).encode()
+
+
+def _load_codec(name: str):
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+        except ImportError:
+            if name == "orjson":
+                raise
+        else:
+            def orjson_dumps(value: Any) -> bytes:
+                try:
+                    return orjson.dumps(value)
+                except TypeError:
+                    # Non-string keys, integers beyond 64 bits, lone surrogates: the stdlib copes
+                    return _stdlib_dumps(value)
+            return "orjson", orjson_dumps, orjson.loads
+    return "json", _stdlib_dumps, json.loads
+
+
+CODEC_NAME, dumps, loads = _load_codec(JSON_CODEC)
+dumps: Callable[[Any], bytes]
+loads: Callable[[Union[bytes, str]], Any]
@@ -0,0 +1,172 @@
+import asyncio
+import base64
+import os
+import pathlib
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from app import codec
+from app.executor import run_io_bound
+from app.memory.storage_format import RawJSON, remember_raw_json
+
+# Everything derived from one document is an artifact of its DocumentContext, computed on first
+# use and kept for the rest of the request. Each artifact declares the artifacts it is computed
+# from, so the stages of a request form a DAG over them: a PDF is decoded once, its text
+# extracted once, lowercased and keyword-scanned once, however many stages read it. A content
+# type can override how an artifact is made; the text of an email is its decoded body, the text
+# of a PDF what extraction found, and only plain text and JSON are classified as they arrive.
+Producer = Callable[..., Awaitable[Any]]
+
+_producers: Dict[Tuple[str, Optional[str]], Tuple[Tuple[str, ...], Producer]] = {}
+
+
+def artifact(name: str, *requires: str, content_type: Optional[str] = None) -> Callable[[Producer], Producer]:
+    """Decorator registering how an artifact is made; the producer gets the context and the
+    values of `requires`, in order"""
+    def decorator(producer: Producer) -> Producer:
+        _producers[(name, content_type)] = (requires, producer)
+        return producer
+    return decorator
+
+
+class DocumentContext:
+    """Lazily computed, memoized artifacts of one document"""
+
+    def __init__(
+        self,
+        content_type: str,
+        content: str,
+        source: Any = None,
+        parsed: Any = None,
+        pdf_mode: str = "full",
+        raw_json: Optional[RawJSON] = None,
+    ):
+        self.content_type = content_type
+        self.content = content
+        # An uploaded file (raw PDF bytes, a spooled path or a parsed message) in place of `content`
+        self.source = source
+        self.pdf_mode = pdf_mode
+        # Where parsed JSON is recorded with its text, for storage to keep that text as is
+        self.raw_json = raw_json
+        self._tasks: Dict[str, "asyncio.Future[Any]"] = {}
+        if parsed is not None:
+            # `content` is its serialization
+            remember_raw_json(raw_json, parsed, content)
+            self.provide("parsed", parsed)
+
+    def _producer(self, name: str) -> Tuple[Tuple[str, ...], Producer]:
+        found = _producers.get((name, self.content_type)) or _producers.get((name, None))
+        if found is None:
+            raise KeyError(f"No artifact {name!r} for {self.content_type} documents")
+        return found
+
+    @property
+    def extracts_text(self) -> bool:
+        """Whether the text comes out of this content type's own stages rather than the content"""
+        return ("text", self.content_type) in _producers
+
+    def provide(self, name: str, value: Any) -> None:
+        """Set an artifact a stage obtained some other way"""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(value)
+        self._tasks[name] = future
+
+    async def get(self, name: str) -> Any:
+        task = self._tasks.get(name)
+        if task is None:
+            # A task, so stages asking concurrently share one computation
+            task = self._tasks[name] = asyncio.ensure_future(self._produce(name))
+        return await task
+
+    async def _produce(self, name: str) -> Any:
+        requires, producer = self._producer(name)
+        values = [await self.get(dependency) for dependency in requires]
+        return await producer(self, *values)
+
+
+def _read_text(source: Any) -> str:
+    if isinstance(source, os.PathLike):
+        return pathlib.Path(source).read_text("utf-8", "replace")
+    return bytes(source).decode("utf-8", "replace")
+
+
+@artifact("text")
+async def _content_text(context: DocumentContext) -> str:
+    # An uploaded attachment is read from its bytes or spooled file here, once
+    if context.source is not None:
+        return await run_io_bound(_read_text, context.source)
+    return context.content
+
+
+@artifact("lower", "text")
+async def _lower(context: DocumentContext, text: str) -> str:
+    return text.lower()
+
+
+@artifact("hits", "lower")
+async def _hits(context: DocumentContext, lower: str):
+    from app.agents.keywords import scan_lowered
+
+    return await run_io_bound(scan_lowered, lower)
+
+
+@artifact("words", "lower")
+async def _words(context: DocumentContext, lower: str):
+    from app.memory.near_duplicates import words
+
+    return await run_io_bound(words, lower)
+
+
+@artifact("minhash", "words")
+async def _minhash(context: DocumentContext, words):
+    from app.memory.near_duplicates import minhash_words
+
+    return await run_io_bound(minhash_words, words)
+
+
+@artifact("parsed", "text")
+async def _parsed(context: DocumentContext, text: str) -> Any:
+    parsed = codec.loads(text)
+    remember_raw_json(context.raw_json, parsed, text)
+    return parsed
+
+
+@artifact("pdf_source", content_type="pdf_base64")
+async def _pdf_source(context: DocumentContext):
+    # Base64 from JSON callers is decoded here, once, for every extraction task of the request
+    if context.source is not None:
+        return context.source
+    return await run_io_bound(base64.b64decode, context.content)
+
+
+@artifact("pdf_extraction", "pdf_source", content_type="pdf_base64")
+async def _pdf_extraction(context: DocumentContext, source) -> Dict[str, Any]:
+    from app.agents.pdf_agent import extract_text_paged
+
+    return await extract_text_paged(source, context.pdf_mode)
+
+
+@artifact("text", "pdf_extraction", content_type="pdf_base64")
+async def _pdf_text(context: DocumentContext, extraction: Dict[str, Any]) -> str:
+    return extraction["text"] or ""
+
+
+@artifact("email_parts", content_type="email")
+async def _email_parts(context: DocumentContext) -> Dict[str, Any]:
+    from app.agents.email_agent import message_from_text, read_email_parts
+
+    def read(content: str, message: Any) -> Dict[str, Any]:
+        return read_email_parts(message if message is not None else message_from_text(content))
+
+    return await run_io_bound(read, context.content, context.source)
+
+
+@artifact("text", "email_parts", content_type="email")
+async def _email_text(context: DocumentContext, parts: Dict[str, Any]) -> str:
+    return parts["text"]
+
+
+@artifact("email", "email_parts", "hits", content_type="email")
+async def _email(context: DocumentContext, parts: Dict[str, Any], hits) -> Dict[str, Any]:
+    from app.agents.email_agent import analyze_email
+
+    return await run_io_bound(analyze_email, parts, hits, context.raw_json)
@@ -0,0 +1,169 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import signal
+import weakref
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Any, Callable, Optional, Tuple
+
+# Pool sizing and per-task timeouts (seconds, 0 = no timeout), configurable through the environment.
+# PDF_POOL_SIZE=0 disables the process pool and runs PDF extraction on the thread pool.
+PDF_POOL_SIZE = int(os.getenv("PDF_POOL_SIZE", str(os.cpu_count() or 1)))
+AGENT_POOL_SIZE = int(os.getenv("AGENT_POOL_SIZE", "8"))
+PDF_TASK_TIMEOUT = float(os.getenv("PDF_TASK_TIMEOUT", "60"))
+AGENT_TASK_TIMEOUT = float(os.getenv("AGENT_TASK_TIMEOUT", "30"))
+PDF_POOL_START_METHOD = os.getenv("PDF_POOL_START_METHOD", "spawn")
+# Process-pool tasks stop themselves at their timeout; one still running this much later is stuck
+# in native code, and its pool is replaced
+PDF_TIMEOUT_GRACE = 2.0
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+_thread_pool: Optional[ThreadPoolExecutor] = None
+# Pools torn down because one of their tasks got stuck; the other tasks they fail were innocent
+_stuck_pools: "weakref.WeakSet[ProcessPoolExecutor]" = weakref.WeakSet()
+
+
+class TaskTimeoutError(Exception):
+    """Raised when a pooled task does not finish within its timeout"""
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=AGENT_POOL_SIZE, thread_name_prefix="agent")
+    return _thread_pool
+
+
+def get_process_pool() -> Executor:
+    global _process_pool
+    if PDF_POOL_SIZE <= 0:
+        return get_thread_pool()
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=PDF_POOL_SIZE,
+            mp_context=multiprocessing.get_context(PDF_POOL_START_METHOD),
+        )
+    return _process_pool
+
+
+def _budget(timeout: Optional[float], default: float) -> Optional[float]:
+    """None means the default timeout; 0 or less means none"""
+    if timeout is None:
+        timeout = default
+    return timeout if timeout > 0 else None
+
+
+def _timed_out(func: Callable[..., Any], timeout: float) -> TaskTimeoutError:
+    return TaskTimeoutError(f"{getattr(func, '__name__', 'task')} timed out after {timeout:g}s")
+
+
+def _call_with_deadline(timeout: Optional[float], func: Callable[..., Any], args: Tuple[Any, ...], kwargs: Any) -> Any:
+    """Process-pool side of a task: interrupt `func` once `timeout` elapses, freeing the worker"""
+    if timeout is None or not hasattr(signal, "setitimer"):
+        return func(*args, **kwargs)
+
+    def alarm(signum: int, frame: Any) -> None:
+        raise _timed_out(func, timeout)
+
+    # Pool workers run their tasks on the main thread, where signal handlers run
+    previous = signal.signal(signal.SIGALRM, alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _recycle_process_pool(pool: ProcessPoolExecutor) -> None:
+    """Replace `pool` for later tasks and kill its workers.
+
+    ProcessPoolExecutor cannot replace a single worker: killing one breaks the whole pool, so
+    every task running or queued in it fails with BrokenProcessPool (run_cpu_bound resubmits
+    those when the pool went down for another task's timeout).
+    """
+    global _process_pool
+    if _process_pool is pool:
+        _process_pool = None
+    # There is no public API to stop a running task; _processes maps pid -> Process
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    # Queued tasks are failed with the rest rather than cancelled, so their callers can resubmit them
+    pool.shutdown(wait=False)
+    for process in processes:
+        process.terminate()
+
+
+async def _run(pool: Executor, timeout: Optional[float], func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(pool, partial(func, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(future, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise _timed_out(func, timeout)
+
+
+async def _run_in_process(
+    pool: ProcessPoolExecutor, timeout: Optional[float], func: Callable[..., Any], args: Tuple[Any, ...], kwargs: Any,
+) -> Any:
+    loop = asyncio.get_running_loop()
+    # The worker enforces the timeout itself, so a slow PDF does not keep holding it after we give up
+    future = loop.run_in_executor(pool, partial(_call_with_deadline, timeout, func, args, kwargs))
+    try:
+        return await asyncio.wait_for(future, timeout=None if timeout is None else timeout + PDF_TIMEOUT_GRACE)
+    except asyncio.TimeoutError:
+        # Stuck where the alarm cannot interrupt it, or no SIGALRM on this platform
+        _stuck_pools.add(pool)
+        _recycle_process_pool(pool)
+        raise _timed_out(func, timeout)
+    except BrokenProcessPool:
+        # A worker died (OOM, segfault in a parser); replace the pool so later requests recover
+        _recycle_process_pool(pool)
+        raise
+
+
+async def run_cpu_bound(func: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+    """Run a CPU-bound function (e.g. pdfminer) in the process pool"""
+    timeout = _budget(timeout, PDF_TASK_TIMEOUT)
+    pool = get_process_pool()
+    if not isinstance(pool, ProcessPoolExecutor):
+        return await _run(pool, timeout, func, *args, **kwargs)
+    try:
+        return await _run_in_process(pool, timeout, func, args, kwargs)
+    except BrokenProcessPool:
+        if pool not in _stuck_pools:
+            raise
+        # Killed along with another task's stuck worker, not by its own doing: run it once more
+        return await _run_in_process(get_process_pool(), timeout, func, args, kwargs)
+
+
+async def run_io_bound(func: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+    """Run a blocking function (agents, Redis calls) in the thread pool"""
+    return await _run(get_thread_pool(), _budget(timeout, AGENT_TASK_TIMEOUT), func, *args, **kwargs)
+
+
+def _import_modules(modules: Tuple[str, ...]) -> None:
+    for module in modules:
+        importlib.import_module(module)
+
+
+def warm_process_pool(*modules: str) -> None:
+    """Start the process pool's workers and import `modules` in them ahead of the first task"""
+    if PDF_POOL_SIZE <= 0:
+        _import_modules(modules)
+        return
+    pool = get_process_pool()
+    # Workers are spawned on demand, one per task that finds no idle worker
+    wait([pool.submit(_import_modules, modules) for _ in range(PDF_POOL_SIZE)])
+
+
+def shutdown_pools(wait: bool = True) -> None:
+    global _process_pool, _thread_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait, cancel_futures=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=wait, cancel_futures=True)
+        _thread_pool = None
@@ -0,0 +1,249 @@
+import abc
+import asyncio
+import collections
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, Any, Optional, List
+
+import redis
+
+from app import codec
+from app.memory.backends import STORAGE_BACKEND
+from app.memory.shared_memory import get_async_redis
+
+# "redis" uses a Redis Stream with a consumer group; "memory" is an in-process stand-in for tests
+# and single-node deployments, and requires in-process workers. Follows STORAGE_BACKEND by default.
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "redis" if STORAGE_BACKEND == "redis" else "memory")
+JOB_STREAM = os.getenv("JOB_STREAM", "jobs:stream")
+JOB_GROUP = os.getenv("JOB_GROUP", "jobs:workers")
+JOB_DEAD_LETTER_STREAM = os.getenv("JOB_DEAD_LETTER_STREAM", "jobs:dead")
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Entries a worker claimed but has not acked for this long are taken over by another worker
+JOB_VISIBILITY_TIMEOUT_MS = int(os.getenv("JOB_VISIBILITY_TIMEOUT_MS", "300000"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", str(24 * 3600)))
+JOB_STREAM_MAXLEN = int(os.getenv("JOB_STREAM_MAXLEN", "100000"))
+
+# Job status lifecycle: queued -> running -> done | retrying -> ... -> failed (dead-lettered)
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_RETRYING = "retrying"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat()
+
+
+class JobQueue(abc.ABC):
+    """Interface shared by the queue backends.
+
+    A claimed job is a dict with entry_id, job_id, payload (the serialized request) and attempts.
+    """
+
+    @abc.abstractmethod
+    async def enqueue(self, job_id: str, doc_id: str, payload: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def claim(self, consumer: str, count: int, block_ms: int) -> List[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    async def complete(self, job: Dict[str, Any], result: Dict[str, Any]) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def fail(self, job: Dict[str, Any], error: str, retryable: bool = True) -> str:
+        """Record a failed attempt; returns the job's new status"""
+
+    @abc.abstractmethod
+    async def get_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+
+class RedisStreamJobQueue(JobQueue):
+    """Jobs on a Redis Stream read through a consumer group, so any number of workers can share it"""
+
+    def __init__(self):
+        self._groups_ready: set = set()
+
+    @staticmethod
+    def _job_key(job_id: str) -> str:
+        return f"job:{job_id}"
+
+    async def _client(self):
+        client = get_async_redis()
+        if id(client) not in self._groups_ready:
+            try:
+                await client.xgroup_create(JOB_STREAM, JOB_GROUP, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+            self._groups_ready.add(id(client))
+        return client
+
+    async def enqueue(self, job_id: str, doc_id: str, payload: str) -> None:
+        client = await self._client()
+        now = _now()
+        pipe = client.pipeline(transaction=True)
+        pipe.hset(self._job_key(job_id), mapping={
+            "status": STATUS_QUEUED, "doc_id": doc_id, "attempts": 0, "created_at": now, "updated_at": now,
+        })
+        pipe.expire(self._job_key(job_id), JOB_RESULT_TTL)
+        pipe.xadd(JOB_STREAM, {"job_id": job_id, "payload": payload}, maxlen=JOB_STREAM_MAXLEN, approximate=True)
+        await pipe.execute()
+
+    async def claim(self, consumer: str, count: int, block_ms: int) -> List[Dict[str, Any]]:
+        client = await self._client()
+        # Take over entries left pending by a worker that died before acking them
+        _, entries, *_ = await client.xautoclaim(
+            JOB_STREAM, JOB_GROUP, consumer, min_idle_time=JOB_VISIBILITY_TIMEOUT_MS, start_id="0-0", count=count
+        )
+        entries = [(entry_id, fields) for entry_id, fields in entries if fields]
+        if not entries:
+            response = await client.xreadgroup(JOB_GROUP, consumer, {JOB_STREAM: ">"}, count=count, block=block_ms)
+            entries = response[0][1] if response else []
+        if not entries:
+            return []
+
+        pipe = client.pipeline(transaction=False)
+        for entry_id, fields in entries:
+            pipe.hincrby(self._job_key(fields[b"job_id"].decode()), "attempts", 1)
+        attempts = await pipe.execute()
+
+        pipe = client.pipeline(transaction=True)
+        jobs = []
+        for (entry_id, fields), attempt in zip(entries, attempts):
+            job = {
+                "entry_id": entry_id, "job_id": fields[b"job_id"].decode(),
+                "payload": fields[b"payload"].decode(), "attempts": attempt,
+            }
+            if attempt > JOB_MAX_ATTEMPTS:
+                # Only a reclaimed entry gets here: its workers died on every attempt instead of
+                # failing it, so it would otherwise be taken over forever
+                self._dead_letter(pipe, job, f"Abandoned by its worker {JOB_MAX_ATTEMPTS} times")
+                continue
+            pipe.hset(self._job_key(job["job_id"]), mapping={"status": STATUS_RUNNING, "updated_at": _now()})
+            jobs.append(job)
+        await pipe.execute()
+        return jobs
+
+    def _dead_letter(self, pipe, job: Dict[str, Any], error: str) -> None:
+        pipe.hset(self._job_key(job["job_id"]), mapping={"status": STATUS_FAILED, "error": error, "updated_at": _now()})
+        pipe.xadd(JOB_DEAD_LETTER_STREAM, {"job_id": job["job_id"], "payload": job["payload"], "error": error},
+                  maxlen=JOB_STREAM_MAXLEN, approximate=True)
+        pipe.xack(JOB_STREAM, JOB_GROUP, job["entry_id"])
+
+    async def complete(self, job: Dict[str, Any], result: Dict[str, Any]) -> None:
+        client = await self._client()
+        pipe = client.pipeline(transaction=True)
+        pipe.hset(self._job_key(job["job_id"]), mapping={
+            "status": STATUS_DONE, "result": codec.dumps(result), "updated_at": _now(),
+        })
+        pipe.hdel(self._job_key(job["job_id"]), "error")
+        pipe.expire(self._job_key(job["job_id"]), JOB_RESULT_TTL)
+        pipe.xack(JOB_STREAM, JOB_GROUP, job["entry_id"])
+        await pipe.execute()
+
+    async def fail(self, job: Dict[str, Any], error: str, retryable: bool = True) -> str:
+        client = await self._client()
+        status = STATUS_RETRYING if retryable and job["attempts"] < JOB_MAX_ATTEMPTS else STATUS_FAILED
+        pipe = client.pipeline(transaction=True)
+        if status == STATUS_RETRYING:
+            pipe.hset(self._job_key(job["job_id"]), mapping={"status": status, "error": error, "updated_at": _now()})
+            # Re-enqueue as a fresh entry so the retry is picked up immediately by any worker
+            pipe.xadd(JOB_STREAM, {"job_id": job["job_id"], "payload": job["payload"]},
+                      maxlen=JOB_STREAM_MAXLEN, approximate=True)
+            pipe.xack(JOB_STREAM, JOB_GROUP, job["entry_id"])
+        else:
+            self._dead_letter(pipe, job, error)
+        await pipe.execute()
+        return status
+
+    async def get_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        client = await self._client()
+        fields = await client.hgetall(self._job_key(job_id))
+        if not fields:
+            return None
+        job = {key.decode(): value.decode() for key, value in fields.items()}
+        job["attempts"] = int(job.get("attempts", 0))
+        if "result" in job:
+            job["result"] = codec.loads(job["result"])
+        return {"job_id": job_id, **job}
+
+
+class InMemoryJobQueue(JobQueue):
+    """Single-process stand-in with the same retry and dead-letter semantics"""
+
+    def __init__(self):
+        self._pending: collections.deque = collections.deque()
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self.dead_letters: List[Dict[str, Any]] = []
+        self._available: Optional[asyncio.Condition] = None
+        self._next_entry = 0
+
+    def _condition(self) -> asyncio.Condition:
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+
+    async def _push(self, job_id: str, payload: str) -> None:
+        self._next_entry += 1
+        self._pending.append({"entry_id": self._next_entry, "job_id": job_id, "payload": payload})
+        async with self._condition():
+            self._condition().notify()
+
+    async def enqueue(self, job_id: str, doc_id: str, payload: str) -> None:
+        now = _now()
+        self._jobs[job_id] = {"status": STATUS_QUEUED, "doc_id": doc_id, "attempts": 0, "created_at": now, "updated_at": now}
+        await self._push(job_id, payload)
+
+    async def claim(self, consumer: str, count: int, block_ms: int) -> List[Dict[str, Any]]:
+        if not self._pending:
+            try:
+                async with self._condition():
+                    await asyncio.wait_for(self._condition().wait_for(lambda: self._pending), timeout=block_ms / 1000)
+            except asyncio.TimeoutError:
+                return []
+        jobs = []
+        while self._pending and len(jobs) < count:
+            job = self._pending.popleft()
+            state = self._jobs[job["job_id"]]
+            state["attempts"] += 1
+            state.update(status=STATUS_RUNNING, updated_at=_now())
+            jobs.append({**job, "attempts": state["attempts"]})
+        return jobs
+
+    async def complete(self, job: Dict[str, Any], result: Dict[str, Any]) -> None:
+        state = self._jobs[job["job_id"]]
+        state.pop("error", None)
+        state.update(status=STATUS_DONE, result=result, updated_at=_now())
+
+    async def fail(self, job: Dict[str, Any], error: str, retryable: bool = True) -> str:
+        status = STATUS_RETRYING if retryable and job["attempts"] < JOB_MAX_ATTEMPTS else STATUS_FAILED
+        self._jobs[job["job_id"]].update(status=status, error=error, updated_at=_now())
+        if status == STATUS_RETRYING:
+            await self._push(job["job_id"], job["payload"])
+        else:
+            self.dead_letters.append({"job_id": job["job_id"], "payload": job["payload"], "error": error})
+        return status
+
+    async def get_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        state = self._jobs.get(job_id)
+        return {"job_id": job_id, **state} if state is not None else None
+
+
+_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = InMemoryJobQueue() if JOB_QUEUE_BACKEND == "memory" else RedisStreamJobQueue()
+    return _queue
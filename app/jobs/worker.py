@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import os
+import socket
+from typing import Dict, Any, Optional
+
+from fastapi import HTTPException
+
+from app.jobs.queue import JobQueue, get_job_queue
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+JOB_BLOCK_MS = int(os.getenv("JOB_BLOCK_MS", "1000"))
+
+
+async def handle_job(queue: JobQueue, job: Dict[str, Any]) -> str:
+    """Run one queued request through the pipeline and record the outcome"""
+    # Imported here so `python -m app.jobs.worker` and the API share one pipeline without a cycle
+    from app.main import ProcessRequest, process_document
+
+    try:
+        request = ProcessRequest.model_validate_json(job["payload"])
+        result = await process_document(request)
+    except HTTPException as he:
+        # 4xx means the document itself is bad; retrying cannot help
+        return await queue.fail(job, f"{he.status_code}: {he.detail}", retryable=he.status_code >= 500)
+    except Exception as e:
+        return await queue.fail(job, str(e), retryable=True)
+    await queue.complete(job, result)
+    return "done"
+
+
+async def run_worker(
+    queue: Optional[JobQueue] = None,
+    consumer: Optional[str] = None,
+    concurrency: int = JOB_WORKER_CONCURRENCY,
+) -> None:
+    """Claim and process jobs until cancelled, with at most `concurrency` in flight"""
+    queue = queue or get_job_queue()
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    in_flight: set = set()
+    try:
+        while True:
+            in_flight = {task for task in in_flight if not task.done()}
+            free = concurrency - len(in_flight)
+            if free <= 0:
+                await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            for job in await queue.claim(consumer, free, JOB_BLOCK_MS):
+                in_flight.add(asyncio.create_task(handle_job(queue, job)))
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Process queued documents from the Redis job stream")
+    parser.add_argument("--consumer", help="Consumer name within the group (default: host-pid)")
+    parser.add_argument("--concurrency", type=int, default=JOB_WORKER_CONCURRENCY)
+    args = parser.parse_args()
+    try:
+        asyncio.run(run_worker(consumer=args.consumer, concurrency=args.concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,83 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Body
-from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any, Union
-import json
-import base64
-from bs4 import BeautifulSoup
-
-# Import your agent functions and shared memory utilities
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Body, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import Optional, Dict, Any, Union, List, Tuple, AsyncIterator, BinaryIO, Literal, TYPE_CHECKING
+from contextlib import asynccontextmanager
+from datetime import datetime
+import anyio
+import asyncio
+import binascii
+import hashlib
+import math
+import os
+import pathlib
+import tempfile
+
+from app import codec
+from app.context import DocumentContext
+
+# Import your agent functions and shared memory utilities; the agents behind each content type
+# are registered below and imported on first use
 from app.agents.classifier_agent import classify_input
-from app.agents.json_agent import parse_json
-from app.agents.email_agent import parse_email
-from app.agents.pdf_agent import extract_text_from_pdf, analyze_pdf_content
-from app.memory.shared_memory import store_data, get_data, get_processing_history
+from app.agents.llm_classifier import needs_refinement, refine_classification, llm_stats
+from app.agents.registry import register, get_handler, warm_up, warmup_types
+from app.memory.shared_memory import (
+    store_document, get_document_data, get_document_history, delete_document, processing_history_from, query_documents,
+    search_documents, find_near_duplicate, get_document_field,
+)
+from app.memory.near_duplicates import (
+    minhash, NEAR_DUPLICATE_ENABLED, NEAR_DUPLICATE_SKIP_THRESHOLD, NEAR_DUPLICATE_PDF_PAGES,
+)
+from app.memory.result_cache import content_hash, content_hasher, get_cached, put_cached, cache_stats
+from app.memory.storage_format import RawJSON
+from app.jobs.queue import get_job_queue, new_job_id, JOB_QUEUE_BACKEND
+from app.jobs.worker import run_worker
+from app.admission import admit, priority, admission_stats, Overloaded
+from app.executor import run_io_bound, run_cpu_bound, shutdown_pools, warm_process_pool, TaskTimeoutError
+from app.metrics import stage, render_metrics, ServerTimingMiddleware
+
+if TYPE_CHECKING:
+    from email.message import EmailMessage
+    from app.agents.pdf_agent import PdfSource
+
+    Upload = Union[PdfSource, EmailMessage]
+
+class CodecJSONResponse(JSONResponse):
+    """JSONResponse serialized with the shared codec (orjson when installed)"""
+
+    def render(self, content: Any) -> bytes:
+        return codec.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Optionally pay the agents' import cost before the first request instead of during it
+    content_types = warmup_types()
+    if content_types != ():
+        await run_io_bound(warm_up, content_types)
+        if content_types is None or "pdf_base64" in content_types:
+            await run_io_bound(warm_process_pool, "app.agents.pdf_agent")
+    # The in-memory queue has no external consumers, so it always needs in-process workers
+    worker_count = JOB_INPROCESS_WORKERS or (1 if JOB_QUEUE_BACKEND == "memory" else 0)
+    workers = [asyncio.create_task(run_worker(consumer=f"inprocess-{n}")) for n in range(worker_count)]
+    yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    shutdown_pools()
 
-app = FastAPI()
+# Job workers to run inside the API process (separate workers run `python -m app.jobs.worker`)
+JOB_INPROCESS_WORKERS = int(os.getenv("JOB_INPROCESS_WORKERS", "0"))
+
+app = FastAPI(lifespan=lifespan, default_response_class=CodecJSONResponse)
+app.add_middleware(ServerTimingMiddleware)
+
+# Upper bound on documents processed concurrently within one /process/batch request
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+# Uploads above this size are spooled to a named file that the PDF worker maps, instead of being read into memory
+UPLOAD_SPOOL_THRESHOLD = int(os.getenv("UPLOAD_SPOOL_THRESHOLD", str(8 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# PDF and JSON attachments of an uploaded message beyond this many are listed but not processed
+EMAIL_MAX_ATTACHMENTS = int(os.getenv("EMAIL_MAX_ATTACHMENTS", "20"))
 
 class ProcessRequest(BaseModel):
     id: str
@@ -20,118 +85,562 @@ class ProcessRequest(BaseModel):
     content_type: Optional[str] = Field(None, description="Type of content: 'text', 'email', 'json', or 'pdf_base64'")
     json: Optional[Dict[str, Any]] = None
     metadata: Optional[Dict[str, Any]] = None
+    pdf_mode: Literal["full", "classify_first"] = Field("full", description="'full' extracts every page, 'classify_first' stops once the document type is known")
 
-@app.post("/process/")
-async def process_input(
-    request: ProcessRequest = Body(...),
-):
+async def _run_pipeline(
+    request: ProcessRequest,
+    writes: List[Tuple[str, Dict[str, Any], str]],
+    raw_json: RawJSON,
+    upload: Optional["Upload"] = None,
+    cache_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Run the agents for one request; (suffix, data, source) writes are queued on `writes` for the caller to flush,
+    and parsed JSON payloads are recorded in `raw_json` with their text.
+
+    `upload` carries an uploaded file instead of `request.content`: raw PDF or JSON bytes or a spooled
+    file path (never base64), or a parsed email message. PDF and email handlers classify the extracted text.
+    """
+    doc_id = request.id
+    content_type = _content_type(request)
+    label = _metrics_label(content_type)
+    metadata = request.metadata or {}
+    
+    # Handle webhook payload with separate JSON field: it arrives parsed, so it is serialized once
+    # (for the cache key and the classifier) and the JSON agent works on the parsed object
+    if request.json:
+        content = codec.dumps(request.json).decode()
+    else:
+        content = request.content
+
+    # Store metadata
+    writes.append(("metadata", metadata, "client_metadata"))
+
+    # Byte-identical documents reuse the stored analysis and are only linked to the new id
+    with stage("cache_lookup", label):
+        if cache_key is None:
+            cache_key = await run_io_bound(content_hash, _cache_tag(content_type, request.pdf_mode), content)
+        cached = await get_cached(cache_key)
+    if cached is not None:
+        entries = [tuple(entry) for entry in cached["entries"]]
+        writes.extend(entries)
+        return {**_cached_result(cached, entries), "cached": True}
+    agent_writes_start = len(writes)
+
+    result = {"status": "processed"}
+    context = DocumentContext(content_type, content, source=upload, parsed=request.json,
+                              pdf_mode=request.pdf_mode, raw_json=raw_json)
+    pipeline = _Pipeline(request, context, label, writes, result)
+
+    if not context.extracts_text:
+        # A close match of an earlier document can lend its classification. PDFs and emails are
+        # compared and classified by their handler, on their text once it is extracted.
+        match = await pipeline.check_near_duplicate()
+        classification = await _reused_classification(match)
+        if classification is None:
+            classification = await _classify(context, label)
+        pipeline.add("classification", classification, "classifier_agent", "classification")
+
+    # Process based on the content type
+    handler = get_handler(content_type)
+    if handler is not None:
+        await handler(pipeline, upload)
+
+    with stage("cache_store", label):
+        await put_cached(cache_key, _cache_entry(writes[agent_writes_start:], result))
+    return result
+
+def _cache_entry(entries: List[Tuple[str, Dict[str, Any], str]], result: Dict[str, Any]) -> Dict[str, Any]:
+    # Agent results appear both in the writes and in the response; store each one once and link
+    # the response keys to their write
+    positions = {id(data): position for position, (_, data, _) in enumerate(entries)}
+    links = {key: positions[id(value)] for key, value in result.items() if id(value) in positions}
+    return {
+        "entries": entries,
+        # A later identical document is an exact duplicate, reported as "cached" instead
+        "result": {key: value for key, value in result.items() if key not in links and key != "near_duplicate_of"},
+        "links": links,
+    }
+
+def _cached_result(cached: Dict[str, Any], entries: List[Tuple]) -> Dict[str, Any]:
+    result = dict(cached["result"])
+    for key, position in cached.get("links", {}).items():
+        result[key] = entries[position][1]
+    return result
+
+
+async def _reused_classification(match: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # Above the skip threshold the neighbour's classification stands in for classify and the LLM
+    if match is None or not NEAR_DUPLICATE_SKIP_THRESHOLD or match["similarity"] < NEAR_DUPLICATE_SKIP_THRESHOLD:
+        return None
+    record = await get_document_field(match["id"], "classification")
+    if record is None:
+        return None
+    classification = record["data"]
+    classification.setdefault("metadata", {})["reused_from"] = match["id"]
+    return classification
+
+async def _classify(context: DocumentContext, label: str) -> Dict[str, Any]:
+    """Classify the document's text, sharing its keyword scan with the other stages"""
+    with stage("classify", label):
+        text = await context.get("text")
+        classification = await run_io_bound(classify_input, text, await context.get("hits"))
+    # Low-confidence rule results go to the optional LLM tier
+    if needs_refinement(classification):
+        with stage("llm_classify", label):
+            classification = await refine_classification(text, classification)
+    return classification
+
+def _content_type(request: ProcessRequest) -> str:
+    # A webhook payload in the separate JSON field is always processed as JSON
+    return "json" if request.json else request.content_type or "text"
+
+def _metrics_label(content_type: str) -> str:
+    # content_type is client-supplied; keep the metric label set bounded
+    return content_type if content_type in ("text", "email", "json", "pdf_base64") else "other"
+
+class _Pipeline:
+    """State one request's agent handler works on"""
+
+    def __init__(self, request: ProcessRequest, context: DocumentContext, label: str,
+                 writes: List[Tuple[str, Dict[str, Any], str]], result: Dict[str, Any]):
+        self.request = request
+        self.context = context
+        self.label = label
+        self.writes = writes
+        self.result = result
+
+    def add(self, suffix: str, data: Dict[str, Any], source: str, result_key: str) -> None:
+        self.writes.append((suffix, data, source))
+        self.result[result_key] = data
+
+    async def check_near_duplicate(self, text: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Look the document's text (or `text`) up among earlier documents; its signature is stored with it"""
+        if not NEAR_DUPLICATE_ENABLED:
+            return None
+        with stage("near_duplicate", self.label):
+            if text is None:
+                signature = await self.context.get("minhash")
+            else:
+                signature = await run_io_bound(minhash, text)
+            match = await find_near_duplicate(self.request.id, signature)
+        self.writes.append(("minhash", {"values": signature}, "near_duplicates"))
+        if match is not None:
+            self.result["near_duplicate_of"] = match
+        return match
+
+@register("pdf_base64", "app.agents.pdf_agent")
+async def _process_pdf(pipeline: _Pipeline, pdf_source: Optional["PdfSource"]) -> None:
+    from app.agents.pdf_agent import extract_pdf_page_range, analyze_pdf_content
+
+    request = pipeline.request
+    context = pipeline.context
     try:
-        doc_id = request.id
-        content_type = request.content_type or "text"
-        metadata = request.metadata or {}
-        
-        # Handle webhook payload with separate JSON field
-        if request.json:
-            content = json.dumps(request.json)
-            content_type = "json"
+        # Raw bytes from uploads; base64 from JSON callers, decoded once for every extraction task
+        source = await context.get("pdf_source")
+    except binascii.Error as e:
+        raise HTTPException(status_code=400, detail=f"PDF processing failed: Invalid base64 content: {e}")
+    match = None
+    checked = False
+    if NEAR_DUPLICATE_ENABLED and NEAR_DUPLICATE_SKIP_THRESHOLD and request.pdf_mode == "full":
+        # Compare the first pages before paying for the whole document
+        with stage("pdf_extract", pipeline.label):
+            probe = await run_cpu_bound(extract_pdf_page_range, source, 0, NEAR_DUPLICATE_PDF_PAGES)
+        if probe["success"]:
+            checked = True
+            match = await pipeline.check_near_duplicate(probe["text"])
+            classification = await _reused_classification(match)
+            if classification is not None:
+                pipeline.add("classification", classification, "classifier_agent", "classification")
+                pdf_analysis = analyze_pdf_content(probe["text"])
+                pdf_analysis["metadata"]["extraction"] = {
+                    "mode": request.pdf_mode, "pages_extracted": probe["pages_extracted"],
+                    "truncated": True, "skipped": "near_duplicate",
+                }
+                pipeline.add("pdf", pdf_analysis, "pdf_agent", "pdf_analysis")
+                return
+
+    # pdfminer is CPU-bound; pages are extracted on the process pool, off the event loop
+    with stage("pdf_extract", pipeline.label):
+        pdf_extraction = await context.get("pdf_extraction")
+    if not pdf_extraction["success"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"PDF processing failed: {pdf_extraction['error']}"
+        )
+
+    if not checked:
+        # Pages end with a form feed; signatures cover the same first pages as the probe above
+        first_pages = " ".join(pdf_extraction["text"].split("\x0c")[:NEAR_DUPLICATE_PDF_PAGES])
+        match = await pipeline.check_near_duplicate(first_pages)
+    classification = await _reused_classification(match)
+    if classification is None:
+        # Classified on the extracted text, never on the base64
+        classification = await _classify(context, pipeline.label)
+        classification["format"] = "PDF"
+    pipeline.add("classification", classification, "classifier_agent", "classification")
+
+    with stage("pdf_analyze", pipeline.label):
+        pdf_analysis = analyze_pdf_content(pdf_extraction["text"], await context.get("hits"))
+    pdf_analysis["metadata"]["extraction"] = pdf_extraction["extraction"]
+    pipeline.add("pdf", pdf_analysis, "pdf_agent", "pdf_analysis")
+
+@register("email", "app.agents.email_agent", "app.agents.json_agent", "bs4")
+async def _process_email(pipeline: _Pipeline, message: Optional["EmailMessage"]) -> None:
+    from app.agents.json_agent import parse_json
+
+    context = pipeline.context
+    # The message is read and its HTML converted to text once; that body text is what gets
+    # compared, classified and analysed, whether the message was posted or uploaded
+    with stage("email_parse", pipeline.label):
+        await context.get("email_parts")
+    classification = await _reused_classification(await pipeline.check_near_duplicate())
+    if classification is None:
+        classification = await _classify(context, pipeline.label)
+        classification["format"] = "Email"
+    pipeline.add("classification", classification, "classifier_agent", "classification")
+
+    with stage("email_parse", pipeline.label):
+        email_data = await context.get("email")
+    pipeline.add("email", email_data, "email_agent", "email_analysis")
+
+    json_data = email_data["embedded_json"]
+    if json_data is not None:
+        with stage("json_validate", pipeline.label):
+            json_analysis = await run_io_bound(parse_json, json_data)
+        pipeline.add("embedded_json", json_analysis, "json_agent", "json_analysis")
+
+@register("json", "app.agents.json_agent")
+async def _process_json(pipeline: _Pipeline, upload: Optional["PdfSource"]) -> None:
+    from app.agents.json_agent import parse_json, validate_json_stream, JSON_STREAM_MIN_BYTES
+
+    # The request's content, or the text of an attachment read from `upload`
+    content = await pipeline.context.get("text")
+    try:
+        if pipeline.request.json is not None:
+            # Webhook payloads arrive already parsed
+            with stage("json_validate", pipeline.label):
+                json_analysis = await run_io_bound(parse_json, await pipeline.context.get("parsed"))
+        elif len(content) >= JSON_STREAM_MIN_BYTES or content.lstrip().startswith("["):
+            # Large payloads and arrays of documents are validated item by item, never built whole
+            with stage("json_validate", pipeline.label):
+                json_analysis = await run_io_bound(validate_json_stream, content)
         else:
-            content = request.content
-
-        # Store metadata
-        store_data(f"{doc_id}_metadata", metadata, source="client_metadata")
-
-        # Classify the input
-        classification = classify_input(content)
-        store_data(f"{doc_id}_classification", classification, source="classifier_agent")
-
-        # Process based on the content type
-        result = {"status": "processed", "classification": classification}
-
-        if content_type == "pdf_base64":
-            pdf_extraction = extract_text_from_pdf(content)
-            if not pdf_extraction["success"]:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"PDF processing failed: {pdf_extraction['error']}"
-                )
-            
-            pdf_analysis = analyze_pdf_content(pdf_extraction["text"])
-            store_data(f"{doc_id}_pdf", pdf_analysis, source="pdf_agent")
-            result["pdf_analysis"] = pdf_analysis
-
-        elif content_type == "email":
-            # Handle HTML content in email
-            if "<html" in content.lower():
-                soup = BeautifulSoup(content, 'html.parser')
-                content = soup.get_text()
-                
-            email_data = parse_email(content)
-            store_data(f"{doc_id}_email", email_data, source="email_agent")
-            result["email_analysis"] = email_data
-            
-            # Check for embedded JSON in email
-            try:
-                json_start = content.find('{')
-                json_end = content.rfind('}')
-                if json_start != -1 and json_end != -1:
-                    json_str = content[json_start:json_end + 1]
-                    json_data = json.loads(json_str)
-                    json_analysis = parse_json(json_data)
-                    store_data(f"{doc_id}_embedded_json", json_analysis, source="json_agent")
-                    result["json_analysis"] = json_analysis
-            except json.JSONDecodeError:
-                pass  # No valid JSON found in email
-
-        elif content_type == "json":
-            try:
-                if isinstance(content, str):
-                    json_content = json.loads(content)
-                else:
-                    json_content = content
-                json_analysis = parse_json(json_content)
-                store_data(f"{doc_id}_json", json_analysis, source="json_agent")
-                result["json_analysis"] = json_analysis
-            except json.JSONDecodeError:
-                raise HTTPException(status_code=400, detail="Invalid JSON content")
-
-        return result
+            with stage("json_decode", pipeline.label):
+                json_content = await pipeline.context.get("parsed")
+            with stage("json_validate", pipeline.label):
+                json_analysis = await run_io_bound(parse_json, json_content)
+        pipeline.add("json", json_analysis, "json_agent", "json_analysis")
+    except codec.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON content")
+
+def _cache_tag(content_type: str, pdf_mode: str) -> str:
+    # Early-exit extraction produces a different analysis, so it gets its own cache entries
+    return content_type if pdf_mode == "full" else f"{content_type}:{pdf_mode}"
+
+def _retention_class(writes: List[Tuple[str, Dict[str, Any], str]]) -> Optional[str]:
+    # Documents are retained according to their classified intent
+    for suffix, data, _ in writes:
+        if suffix == "classification":
+            return data.get("intent")
+    return None
+
+def _search_text(writes: List[Tuple[str, Dict[str, Any], str]]) -> Optional[str]:
+    # The extracted text of PDFs and emails goes into the full-text index
+    texts = []
+    for suffix, data, _ in writes:
+        if suffix == "pdf" and data.get("content"):
+            texts.append(data["content"])
+        elif suffix == "email" and data.get("content", {}).get("text"):
+            texts.append(data["content"]["text"])
+    return "\n".join(texts) or None
+
+async def process_document(
+    request: ProcessRequest,
+    upload: Optional["Upload"] = None,
+    cache_key: Optional[str] = None,
+) -> Dict[str, Any]:
+    writes: List[Tuple[str, Dict[str, Any], str]] = []
+    # Parsed payloads with the JSON text they came from, so storage does not serialize them again
+    raw_json: RawJSON = {}
+    try:
+        try:
+            return await _run_pipeline(request, writes, raw_json, upload, cache_key)
+        finally:
+            # Persist everything this request produced into the document hash in one atomic round trip
+            if writes:
+                with stage("persist", _metrics_label(_content_type(request))):
+                    await store_document(request.id, writes, retention_class=_retention_class(writes),
+                                         search_text=_search_text(writes), raw_json=raw_json)
 
     except HTTPException as he:
         raise he
+    except TaskTimeoutError as te:
+        raise HTTPException(status_code=504, detail=str(te))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@asynccontextmanager
+async def _admission(content_type: str, text: str) -> AsyncIterator[None]:
+    """Wait for an in-flight slot of the content type's lane, urgent documents first"""
+    label = _metrics_label(content_type)
+    try:
+        async with admit(label, priority(label, text)):
+            yield
+    except Overloaded as overloaded:
+        raise HTTPException(
+            status_code=503,
+            detail=str(overloaded),
+            headers={"Retry-After": str(max(1, math.ceil(overloaded.retry_after)))},
+        )
+
+@app.post("/process/")
+async def process_input(
+    request: ProcessRequest = Body(...),
+    mode: Literal["sync", "async"] = Query("sync", description="'async' queues the document and returns a job id"),
+):
+    if mode == "async":
+        job_id = new_job_id()
+        await get_job_queue().enqueue(job_id, request.id, request.model_dump_json())
+        return CodecJSONResponse(
+            status_code=202,
+            content={"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"},
+        )
+    async with _admission(_content_type(request), request.content):
+        result = await process_document(request)
+    # Returned as a response so FastAPI does not walk the result with jsonable_encoder first
+    return CodecJSONResponse(result)
+
+async def _iter_ndjson(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Yield complete lines from a chunked body, holding at most one partial line"""
+    buffer = bytearray()
+    async for chunk in stream:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            yield bytes(buffer[start:end])
+            start = end + 1
+        del buffer[:start]
+    if buffer:
+        yield bytes(buffer)
+
+async def _process_batch_line(line_number: int, line: bytes) -> bytes:
+    doc_id = None
+    try:
+        request = ProcessRequest.model_validate_json(line)
+        doc_id = request.id
+        async with _admission(_content_type(request), request.content):
+            result = {"line": line_number, "id": doc_id, **(await process_document(request))}
+    except ValidationError as ve:
+        result = {"line": line_number, "id": doc_id, "status": "error", "status_code": 422,
+                  "detail": codec.loads(ve.json(include_url=False))}
+    except HTTPException as he:
+        result = {"line": line_number, "id": doc_id, "status": "error", "status_code": he.status_code,
+                  "detail": he.detail}
+    return codec.dumps(result) + b"\n"
+
+class _DuplexStreamingResponse(StreamingResponse):
+    """StreamingResponse that may keep reading the request body while it streams"""
+
+    async def listen_for_disconnect(self, receive) -> None:
+        # The body iterator owns `receive`; listening here as well would swallow body chunks
+        await anyio.sleep_forever()
+
+@app.post("/process/batch")
+async def process_batch(
+    request: Request,
+    concurrency: int = Query(BATCH_MAX_CONCURRENCY, ge=1),
+):
+    """Process an NDJSON body of ProcessRequests, streaming one NDJSON result per document as it finishes"""
+    limit = min(concurrency, BATCH_MAX_CONCURRENCY)
+
+    async def results() -> AsyncIterator[bytes]:
+        pending = set()
+        line_number = 0
+        try:
+            async for line in _iter_ndjson(request.stream()):
+                line_number += 1
+                if not line.strip():
+                    continue
+                # Only read ahead as far as the parallelism limit so memory stays flat
+                while len(pending) >= limit:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+                pending.add(asyncio.create_task(_process_batch_line(line_number, line)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    return _DuplexStreamingResponse(results(), media_type="application/x-ndjson")
+
+def _spool_upload(upload: BinaryIO, hasher: "hashlib._Hash") -> pathlib.Path:
+    """Copy an upload to a named temp file chunk by chunk, hashing it on the way"""
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as spooled:
+        while True:
+            chunk = upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            spooled.write(chunk)
+    return pathlib.Path(spooled.name)
+
 @app.post("/process/file")
 async def process_file(
     file: UploadFile = File(...),
-    id: str = Form(...)
+    id: str = Form(...),
+    pdf_mode: Literal["full", "classify_first"] = Form("full"),
 ):
+    if file.content_type == "message/rfc822":
+        return await _process_email_upload(file, id)
+    if file.content_type != 'application/pdf':
+        raise HTTPException(status_code=400, detail="Unsupported file type")
+
+    request = ProcessRequest(
+        id=id,
+        content="",
+        content_type="pdf_base64",
+        metadata={"filename": file.filename, "content_type": file.content_type},
+        pdf_mode=pdf_mode,
+    )
+    hasher = content_hasher(_cache_tag(file.content_type, pdf_mode))
+    spooled_path = None
     try:
-        content = await file.read()
-        if file.content_type == 'application/pdf':
-            pdf_base64 = base64.b64encode(content).decode()
-            
-            # Create a ProcessRequest and use the existing process_input function
-            request = ProcessRequest(
-                id=id,
-                content=pdf_base64,
-                content_type="pdf_base64",
-                metadata={"filename": file.filename, "content_type": file.content_type}
-            )
-            
-            return await process_input(request)
+        # Small uploads go to the PDF agent as raw bytes, large ones as a file path; never as base64
+        if file.size is not None and file.size <= UPLOAD_SPOOL_THRESHOLD:
+            pdf_source = await file.read()
+            hasher.update(pdf_source)
         else:
-            raise HTTPException(status_code=400, detail="Unsupported file type")
-            
-    except Exception as e:
+            pdf_source = spooled_path = await run_io_bound(_spool_upload, file.file, hasher)
+        async with _admission("pdf_base64", ""):
+            return await process_document(request, upload=pdf_source, cache_key=hasher.hexdigest())
+    except OSError as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if spooled_path is not None:
+            spooled_path.unlink(missing_ok=True)
+
+async def _process_email_upload(file: UploadFile, id: str) -> Dict[str, Any]:
+    """Process an uploaded message and, concurrently, its PDF and JSON attachments as child documents"""
+    from app.agents.email_agent import read_email_message
+
+    request = ProcessRequest(
+        id=id,
+        content="",
+        content_type="email",
+        metadata={"filename": file.filename, "content_type": file.content_type},
+    )
+    hasher = content_hasher(_cache_tag(file.content_type, "full"))
+    # Fed to the parser in chunks straight from the spooled upload; never decoded to one str
+    message = await run_io_bound(read_email_message, file.file, hasher)
+    # The attachments run in the message's slot; its urgency is judged on the subject
+    async with _admission("email", str(message.get("subject", ""))):
+        parent, attachments = await asyncio.gather(
+            process_document(request, upload=message, cache_key=hasher.hexdigest()),
+            _process_attachments(id, message),
+            return_exceptions=True,
+        )
+    if isinstance(parent, BaseException):
+        raise parent
+    if isinstance(attachments, BaseException):
+        raise HTTPException(status_code=500, detail=str(attachments))
+    if attachments:
+        # Link the children from the parent document, under the parent's retention
+        await store_document(
+            id,
+            [("attachments", {"documents": attachments}, "email_agent")],
+            retention_class=(parent.get("classification") or {}).get("intent"),
+        )
+        parent["attachments"] = attachments
+    return parent
+
+async def _process_attachments(parent_id: str, message: "EmailMessage") -> List[Dict[str, Any]]:
+    from app.agents.email_agent import iter_attachments, attachment_kind
+
+    parts = [(position, part) for position, part in iter_attachments(message) if attachment_kind(part)]
+    return list(await asyncio.gather(
+        *(_process_attachment(parent_id, position, part) for position, part in parts[:EMAIL_MAX_ATTACHMENTS])
+    ))
+
+async def _process_attachment(parent_id: str, position: int, part: "EmailMessage") -> Dict[str, Any]:
+    from app.agents.email_agent import attachment_kind, decode_attachment
+
+    child_id = f"{parent_id}-att-{position}"
+    kind = attachment_kind(part)
+    metadata = {"parent_id": parent_id, "filename": part.get_filename(), "content_type": part.get_content_type()}
+    summary = {"id": child_id, "position": position, **metadata}
+    payload = None
+    try:
+        # Decoded only now, and spooled to disk when large
+        payload = await run_io_bound(decode_attachment, part, UPLOAD_SPOOL_THRESHOLD)
+        # Both kinds are handed over as the decoded bytes or spooled file and read by their handler
+        content_type, tag = ("pdf_base64", "application/pdf") if kind == "pdf" else ("json", "json")
+        request = ProcessRequest(id=child_id, content="", content_type=content_type, metadata=metadata)
+        cache_key = await run_io_bound(_hash_upload, payload, content_hasher(_cache_tag(tag, "full")))
+        result = await process_document(request, upload=payload, cache_key=cache_key)
+        summary.update(status="processed", intent=(result.get("classification") or {}).get("intent"))
+    except HTTPException as he:
+        summary.update(status="error", status_code=he.status_code, detail=he.detail)
+    except (OSError, ValueError) as e:
+        summary.update(status="error", status_code=400, detail=str(e))
+    finally:
+        if isinstance(payload, pathlib.Path):
+            payload.unlink(missing_ok=True)
+    return summary
+
+def _hash_upload(payload: Union[bytes, pathlib.Path], hasher: "hashlib._Hash") -> str:
+    if isinstance(payload, pathlib.Path):
+        with open(payload, "rb") as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+    else:
+        hasher.update(payload)
+    return hasher.hexdigest()
+
+@app.get("/documents")
+async def list_documents(
+    intent: Optional[str] = None,
+    urgency: Optional[str] = None,
+    format: Optional[str] = None,
+    subtype: Optional[str] = None,
+    since: Optional[datetime] = Query(None, description="Only documents classified at or after this time (UTC)"),
+    until: Optional[datetime] = Query(None, description="Only documents classified at or before this time (UTC)"),
+    cursor: Optional[str] = Query(None, description="`next_cursor` of the previous page"),
+    limit: int = Query(50, ge=1, le=500),
+):
+    """Documents matching every given classification value, newest first"""
+    filters = {name: value for name, value in
+               (("intent", intent), ("urgency", urgency), ("format", format), ("subtype", subtype)) if value}
+    try:
+        documents, next_cursor = await query_documents(filters, since, until, cursor, limit)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return {"documents": documents, "next_cursor": next_cursor}
+
+@app.get("/search")
+async def search(
+    q: str = Query(..., min_length=1, description="Words to look for in the extracted text"),
+    cursor: Optional[str] = Query(None, description="`next_cursor` of the previous page"),
+    limit: int = Query(20, ge=1, le=200),
+):
+    """Documents ranked by BM25 relevance to `q`"""
+    if cursor is not None and not cursor.isdigit():
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    results, next_cursor = await search_documents(q, cursor, limit)
+    return {"query": q, "results": results, "next_cursor": next_cursor}
 
 @app.get("/document/{id}")
 async def get_document(id: str):
-    # Get all processing results for the document
-    classification = get_data(f"{id}_classification")
-    metadata = get_data(f"{id}_metadata")
-    processing_history = get_processing_history(id)
+    # Get all processing results for the document with a single MGET
+    records = await get_document_data(id)
+    classification = records["classification"]
+    metadata = records["metadata"]
     
     if not classification and not metadata:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -140,20 +649,70 @@ async def get_document(id: str):
         "id": id,
         "classification": classification["data"] if classification else None,
         "metadata": metadata["data"] if metadata else None,
-        "processing_history": processing_history
+        "processing_history": processing_history_from(records)
     }
     
     # Add type-specific processing results
-    pdf_data = get_data(f"{id}_pdf")
+    pdf_data = records["pdf"]
     if pdf_data:
         result["pdf_analysis"] = pdf_data["data"]
     
-    email_data = get_data(f"{id}_email")
+    email_data = records["email"]
     if email_data:
         result["email_analysis"] = email_data["data"]
     
-    json_data = get_data(f"{id}_json")
+    json_data = records["json"]
     if json_data:
         result["json_analysis"] = json_data["data"]
+
+    attachments = records["attachments"]
+    if attachments:
+        result["attachments"] = attachments["data"]["documents"]
     
-    return result
+    return CodecJSONResponse(result)
+
+@app.get("/document/{id}/history")
+async def get_history(
+    id: str,
+    cursor: Optional[str] = Query(None, description="`next_cursor` of the previous page"),
+    limit: int = Query(50, ge=1, le=500),
+    order: Literal["asc", "desc"] = Query("asc"),
+):
+    """Every agent run recorded for a document, one page at a time"""
+    try:
+        events, next_cursor = await get_document_history(id, cursor, limit, reverse=order == "desc")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not events and cursor is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"id": id, "events": events, "next_cursor": next_cursor}
+
+@app.delete("/document/{id}")
+async def remove_document(id: str):
+    if not await delete_document(id):
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"id": id, "status": "deleted"}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await get_job_queue().get_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return cache_stats()
+
+@app.get("/classifier/stats")
+async def get_classifier_stats():
+    return llm_stats()
+
+@app.get("/admission/stats")
+async def get_admission_stats():
+    return admission_stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text exposition format
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,844 @@
+import abc
+import bisect
+import collections
+import heapq
+import itertools
+import math
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from app import codec
+from app.executor import run_io_bound
+from app.memory import indexes, near_duplicates, search_index
+
+# Where records and documents are kept: "redis", "memory" (an in-process LRU capped at
+# STORAGE_MEMORY_MAX_BYTES) or "sqlite" (an embedded file in WAL mode at STORAGE_SQLITE_PATH).
+# Every backend serves the record API, documents with their history, the classification
+# indexes, near-duplicate lookups and full-text search.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "redis")
+STORAGE_MEMORY_MAX_BYTES = int(os.getenv("STORAGE_MEMORY_MAX_BYTES", str(256 * 1024 * 1024)))
+STORAGE_SQLITE_PATH = os.getenv("STORAGE_SQLITE_PATH", "documents.db")
+# Writes grouped into one SQLite transaction; a partial group is committed STORAGE_SQLITE_COMMIT_MS
+# after its first write, so at most that much acknowledged work is lost on a crash
+STORAGE_SQLITE_BATCH = int(os.getenv("STORAGE_SQLITE_BATCH", "64"))
+STORAGE_SQLITE_COMMIT_MS = float(os.getenv("STORAGE_SQLITE_COMMIT_MS", "50"))
+# Expired documents removed per document write
+STORAGE_PURGE_BATCH = 100
+
+Records = Dict[str, bytes]
+# One history event per written key
+Events = Dict[str, Dict[str, str]]
+Reader = Callable[[List[str]], List[Optional[bytes]]]
+# update() callback: given a reader and the key's current record, the records, blobs and events to write
+Merge = Callable[[Reader, Optional[bytes]], Tuple[Records, Records, Events]]
+HistoryEntry = Tuple[str, Dict[str, str]]
+Page = Tuple[List[Dict[str, Any]], Optional[str]]
+
+# Expiry times are compared with this clock (seconds since the epoch)
+_clock = time.time
+
+
+class DocumentWrite(NamedTuple):
+    """Everything one store_document() call writes, already encoded"""
+
+    records: Records  # field -> record, merged into the document's existing fields
+    blobs: Records
+    events: List[Dict[str, str]]  # appended to the document's history, in order
+    ttl: int  # seconds the document, its history and its blobs live; 0 = forever
+    indexed_at: datetime
+    expires_at: Optional[float]
+    index_values: Optional[Dict[str, str]]  # a new classification's indexed values, if any
+    search_terms: Optional[Dict[str, int]]  # term frequencies of the text to search, if any
+    signature: Optional[List[int]]  # MinHash signature for near-duplicate lookups, if any
+
+
+class StorageBackend(abc.ABC):
+    """Interface shared by the storage backends.
+
+    Records and blobs are encoded bytes (see storage_format). Blobs are content-addressed, so a
+    blob that already exists is never rewritten. Each write may append an event to the history
+    of the keys it writes. A document is a set of per-agent records stored, read and expired
+    together; a history cursor is the first element of a HistoryEntry.
+    """
+
+    name = "backend"
+
+    @abc.abstractmethod
+    def write(self, records: Records, blobs: Records, events: Events) -> None:
+        ...
+
+    @abc.abstractmethod
+    def read(self, keys: List[str]) -> List[Optional[bytes]]:
+        ...
+
+    @abc.abstractmethod
+    def update(self, key: str, merge: Merge) -> None:
+        """Replace `key` with what merge() makes of its current record, atomically"""
+
+    @abc.abstractmethod
+    def history(self, key: str) -> List[HistoryEntry]:
+        """(cursor, event) pairs of a key, oldest first"""
+
+    async def awrite(self, records: Records, blobs: Records, events: Events) -> None:
+        await run_io_bound(self.write, records, blobs, events)
+
+    async def aread(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await run_io_bound(self.read, keys)
+
+    @abc.abstractmethod
+    async def store_document(self, doc_id: str, write: DocumentWrite) -> None:
+        """Apply a DocumentWrite atomically, moving the document in the indexes it names"""
+
+    @abc.abstractmethod
+    async def read_document(self, doc_id: str, fields: Optional[List[str]] = None) -> Records:
+        """The stored records of a document (only `fields`, if given), keyed by field"""
+
+    @abc.abstractmethod
+    async def document_history(
+        self, doc_id: str, cursor: Optional[str], count: int, reverse: bool = False,
+    ) -> List[HistoryEntry]:
+        """Up to `count` history entries after `cursor` (exclusive), oldest first unless `reverse`"""
+
+    @abc.abstractmethod
+    async def delete_document(self, doc_id: str, event: Dict[str, str], history_ttl: int) -> bool:
+        """Delete a document and take it out of every index; its history, with `event` appended,
+        is kept for `history_ttl` seconds (0 = forever). False if there was no such document."""
+
+    @abc.abstractmethod
+    async def query_documents(
+        self,
+        filters: Dict[str, str],
+        since: Optional[datetime],
+        until: Optional[datetime],
+        cursor: Optional[str],
+        limit: int,
+    ) -> Page:
+        """One page of documents whose classification matches every filter, newest first; the
+        cursor is opaque to callers (see indexes.page_bounds and indexes.keyset_bounds)"""
+
+    @abc.abstractmethod
+    async def near_duplicate_candidates(self, doc_id: str, signature: Sequence[int]) -> Dict[str, Optional[bytes]]:
+        """The stored "minhash" records of documents sharing an LSH bucket with `signature`"""
+
+    @abc.abstractmethod
+    async def search(self, query: str, cursor: Optional[str], limit: int) -> Page:
+        """One page of documents ranked by BM25 for `query`; the cursor is an offset"""
+
+    def close(self) -> None:
+        pass
+
+
+def _event_size(event: Dict[str, str]) -> int:
+    return sum(len(name) + len(value) for name, value in event.items()) + 64
+
+
+def _history_after(cursor: Optional[str], reverse: bool) -> Callable[[int], bool]:
+    if not cursor:
+        return lambda event_id: True
+    position = int(cursor)
+    return (lambda event_id: event_id < position) if reverse else (lambda event_id: event_id > position)
+
+
+class MemoryBackend(StorageBackend):
+    """In-process LRU of records, blobs, documents and histories. Once they take more than
+    `max_bytes`, the least recently used entries are evicted; a record can outlive an evicted
+    blob, whose text then reads back as None, as with an expired blob in Redis. An evicted
+    document leaves the indexes with it. The indexes themselves are not counted."""
+
+    name = "memory"
+
+    def __init__(self, max_bytes: int = STORAGE_MEMORY_MAX_BYTES, history_maxlen: int = 1000):
+        self.max_bytes = max_bytes
+        self.history_maxlen = history_maxlen
+        # Record and blob keys map to bytes, ("doc", id) to a dict of field -> record and
+        # ("history", key) to a deque of (id, event, size)
+        self._entries: "collections.OrderedDict[Any, Any]" = collections.OrderedDict()
+        self._sizes: Dict[Any, int] = {}
+        self.bytes = 0
+        self.evictions = 0
+        self._event_ids = itertools.count(1)
+        # Entries with a TTL, and a heap of (expires_at, n, key) to find the expired ones
+        self._expires: Dict[Any, float] = {}
+        self._expiry_heap: List[Tuple[float, int, Any]] = []
+        self._expiry_order = itertools.count()
+        # doc id -> (indexed values, classification time, timestamp)
+        self._classified: Dict[str, Tuple[Dict[str, str], float, str]] = {}
+        # indexes.filter_key -> (classification time, id) of the documents under it, ascending
+        self._index: Dict[str, List[Tuple[float, str]]] = {}
+        # Full-text index: doc id -> (docno, term frequencies, length) and term -> {docno: frequency}
+        self._texts: Dict[str, Tuple[int, Dict[str, int], int]] = {}
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._text_ids: Dict[int, str] = {}
+        self._text_length = 0
+        self._docnos = itertools.count(1)
+        # LSH buckets, newest document last, and the buckets each document is in
+        self._buckets: Dict[str, "collections.OrderedDict[str, float]"] = {}
+        self._doc_buckets: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def _put(self, key: Any, value: Any, size: int) -> None:
+        self.bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+
+    def _drop(self, key: Any) -> None:
+        """Remove an entry, and a document from the indexes"""
+        if key in self._entries:
+            del self._entries[key]
+            self.bytes -= self._sizes.pop(key)
+        self._expires.pop(key, None)
+        if isinstance(key, tuple) and key[0] == "doc":
+            self._forget(key[1])
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _set_expiry(self, key: Any, expires_at: Optional[float]) -> None:
+        if expires_at is None:
+            self._expires.pop(key, None)
+            return
+        self._expires[key] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, next(self._expiry_order), key))
+        if len(self._expiry_heap) > 2 * len(self._expires) + 1024:
+            # Mostly superseded expiry times: start over from the current ones
+            self._expiry_heap = [(when, next(self._expiry_order), entry) for entry, when in self._expires.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _purge(self, now: float) -> None:
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, _, key = heapq.heappop(self._expiry_heap)
+            # The heap keeps superseded expiry times; only act on the current one
+            expires_at = self._expires.get(key)
+            if expires_at is not None and expires_at <= now:
+                self._drop(key)
+
+    def _get(self, key: Any, now: float) -> Any:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= now:
+            self._drop(key)
+            return None
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def _read(self, keys: List[str]) -> List[Optional[bytes]]:
+        now = _clock()
+        return [self._get(key, now) for key in keys]
+
+    def _put_blob(self, key: str, blob: bytes, expires_at: Optional[float], now: float) -> None:
+        # A shared blob lives as long as its longest-lived owner
+        if self._get(key, now) is None:
+            self._put(key, blob, len(key) + len(blob))
+            self._set_expiry(key, expires_at)
+        elif key in self._expires and (expires_at is None or expires_at > self._expires[key]):
+            self._set_expiry(key, expires_at)
+
+    def _append_history(self, key: str, event: Dict[str, str], now: float) -> None:
+        history_key = ("history", key)
+        history: Optional[Deque[Tuple[int, Dict[str, str], int]]] = self._get(history_key, now)
+        size = self._sizes.get(history_key, 0)
+        if history is None:
+            history = collections.deque(maxlen=self.history_maxlen)
+        elif len(history) == history.maxlen:
+            # The oldest event is about to be dropped
+            size -= history[0][2]
+        entry_size = _event_size(event)
+        history.append((next(self._event_ids), event, entry_size))
+        self._put(history_key, history, size + entry_size)
+
+    def _write(self, records: Records, blobs: Records, events: Events) -> None:
+        now = _clock()
+        for key, blob in blobs.items():
+            self._put_blob(key, blob, None, now)
+        for key, record in records.items():
+            self._put(key, record, len(key) + len(record))
+            self._expires.pop(key, None)
+        for key, event in events.items():
+            self._append_history(key, event, now)
+        self._evict()
+
+    def write(self, records: Records, blobs: Records, events: Events) -> None:
+        with self._lock:
+            self._write(records, blobs, events)
+
+    def read(self, keys: List[str]) -> List[Optional[bytes]]:
+        with self._lock:
+            return self._read(keys)
+
+    def update(self, key: str, merge: Merge) -> None:
+        with self._lock:
+            self._write(*merge(self._read, self._read([key])[0]))
+
+    def history(self, key: str) -> List[HistoryEntry]:
+        with self._lock:
+            history = self._get(("history", key), _clock()) or ()
+            return [(str(event_id), dict(event)) for event_id, event, _ in history]
+
+    # Nothing here blocks, so the event loop calls straight in
+    async def awrite(self, records: Records, blobs: Records, events: Events) -> None:
+        self.write(records, blobs, events)
+
+    async def aread(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self.read(keys)
+
+    def _forget(self, doc_id: str) -> None:
+        self._unclassify(doc_id)
+        self._unindex_text(doc_id)
+        self._forget_signature(doc_id)
+
+    def _classify(self, doc_id: str, values: Dict[str, str], score: float, timestamp: str) -> None:
+        self._unclassify(doc_id)
+        self._classified[doc_id] = (values, score, timestamp)
+        for key in indexes.index_keys(values):
+            bisect.insort(self._index.setdefault(key, []), (score, doc_id))
+
+    def _unclassify(self, doc_id: str) -> None:
+        entry = self._classified.pop(doc_id, None)
+        if entry is None:
+            return
+        values, score, _ = entry
+        for key in indexes.index_keys(values):
+            members = self._index[key]
+            del members[bisect.bisect_left(members, (score, doc_id))]
+            if not members:
+                del self._index[key]
+
+    def _unindex_text(self, doc_id: str) -> None:
+        entry = self._texts.pop(doc_id, None)
+        if entry is None:
+            return
+        docno, terms, length = entry
+        for term in terms:
+            postings = self._postings[term]
+            del postings[docno]
+            if not postings:
+                del self._postings[term]
+        del self._text_ids[docno]
+        self._text_length -= length
+
+    def _index_text(self, doc_id: str, terms: Dict[str, int]) -> None:
+        self._unindex_text(doc_id)
+        docno = next(self._docnos)
+        length = sum(terms.values())
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[docno] = frequency
+        self._texts[doc_id] = (docno, terms, length)
+        self._text_ids[docno] = doc_id
+        self._text_length += length
+
+    def _insert_signature(self, doc_id: str, signature: Sequence[int], score: float) -> None:
+        self._forget_signature(doc_id)
+        buckets = self._doc_buckets[doc_id] = set()
+        for bucket in near_duplicates.bucket_keys(signature):
+            members = self._buckets.setdefault(bucket, collections.OrderedDict())
+            members[doc_id] = score
+            buckets.add(bucket)
+            # Only the newest documents of a bucket are kept
+            while len(members) > near_duplicates.LSH_BUCKET_SIZE:
+                oldest, _ = members.popitem(last=False)
+                self._doc_buckets[oldest].discard(bucket)
+
+    def _forget_signature(self, doc_id: str) -> None:
+        for bucket in self._doc_buckets.pop(doc_id, ()):
+            members = self._buckets[bucket]
+            del members[doc_id]
+            if not members:
+                del self._buckets[bucket]
+
+    async def store_document(self, doc_id: str, write: DocumentWrite) -> None:
+        with self._lock:
+            now = _clock()
+            self._purge(now)
+            for key, blob in write.blobs.items():
+                self._put_blob(key, blob, write.expires_at, now)
+            key = ("doc", doc_id)
+            fields = {**(self._get(key, now) or {}), **write.records}
+            self._put(key, fields, sum(len(field) + len(record) for field, record in fields.items()))
+            self._set_expiry(key, write.expires_at)
+            for event in write.events:
+                self._append_history(doc_id, event, now)
+            self._set_expiry(("history", doc_id), write.expires_at)
+            score = indexes.epoch(write.indexed_at)
+            if write.index_values is not None:
+                self._classify(doc_id, write.index_values, score, write.indexed_at.isoformat())
+            if write.search_terms is not None:
+                self._index_text(doc_id, write.search_terms)
+            if write.signature is not None:
+                self._insert_signature(doc_id, write.signature, score)
+            self._evict()
+
+    async def read_document(self, doc_id: str, fields: Optional[List[str]] = None) -> Records:
+        with self._lock:
+            stored = self._get(("doc", doc_id), _clock()) or {}
+            if fields is None:
+                return dict(stored)
+            return {field: stored[field] for field in fields if field in stored}
+
+    async def document_history(
+        self, doc_id: str, cursor: Optional[str], count: int, reverse: bool = False,
+    ) -> List[HistoryEntry]:
+        after = _history_after(cursor, reverse)
+        with self._lock:
+            history = list(self._get(("history", doc_id), _clock()) or ())
+        if reverse:
+            history.reverse()
+        entries = (entry for entry in history if after(entry[0]))
+        return [(str(event_id), dict(event)) for event_id, event, _ in itertools.islice(entries, count)]
+
+    async def delete_document(self, doc_id: str, event: Dict[str, str], history_ttl: int) -> bool:
+        with self._lock:
+            now = _clock()
+            if self._get(("doc", doc_id), now) is None:
+                return False
+            self._drop(("doc", doc_id))
+            self._append_history(doc_id, event, now)
+            self._set_expiry(("history", doc_id), now + history_ttl if history_ttl else None)
+            self._evict()
+            return True
+
+    async def query_documents(
+        self,
+        filters: Dict[str, str],
+        since: Optional[datetime],
+        until: Optional[datetime],
+        cursor: Optional[str],
+        limit: int,
+    ) -> Page:
+        key = indexes.filter_key({field: value.lower() for field, value in filters.items()})
+        bounds = indexes.keyset_bounds(since, until, cursor)
+        if bounds is None:
+            return [], None
+        high, low, after = bounds
+        with self._lock:
+            self._purge(_clock())
+            members = self._index.get(key, [])
+            # A page is the limit + 1 members just below its upper bound, so it costs
+            # O(log N + limit) however deep it is
+            end = len(members) if high == math.inf else bisect.bisect_left(members, (math.nextafter(high, math.inf),))
+            if after is not None:
+                end = min(end, bisect.bisect_left(members, after))
+            start = max(bisect.bisect_left(members, (low,)), end - limit - 1)
+            matching = members[start:end][::-1]
+            page = matching[:limit]
+            documents = []
+            for _, doc_id in page:
+                values, _, timestamp = self._classified[doc_id]
+                documents.append({"id": doc_id, "timestamp": timestamp, "classification": dict(values)})
+        return documents, indexes.keyset_cursor(page, len(matching) > limit)
+
+    async def near_duplicate_candidates(self, doc_id: str, signature: Sequence[int]) -> Dict[str, Optional[bytes]]:
+        with self._lock:
+            now = _clock()
+            self._purge(now)
+            found = {member for bucket in near_duplicates.bucket_keys(signature)
+                     for member in self._buckets.get(bucket, ())} - {doc_id}
+            return {candidate: (self._get(("doc", candidate), now) or {}).get("minhash") for candidate in found}
+
+    async def search(self, query: str, cursor: Optional[str], limit: int) -> Page:
+        terms = sorted(search_index.tokenize(query))
+        if not terms:
+            return [], None
+        with self._lock:
+            self._purge(_clock())
+            postings = {
+                term: [(docno, frequency, self._texts[self._text_ids[docno]][2])
+                       for docno, frequency in self._postings[term].items()]
+                for term in terms if term in self._postings
+            }
+            ranked = search_index.rank_entries(postings, len(self._texts), self._text_length)
+            page, next_cursor = search_index.page(ranked, cursor, limit)
+            return [{"id": self._text_ids[docno], "score": round(score, 4)} for score, docno in page], next_cursor
+
+
+_INDEX_COLUMNS = ", ".join(indexes.INDEXED_FIELDS)
+
+_SQLITE_TABLES = (
+    "CREATE TABLE IF NOT EXISTS records (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS history "
+    "(id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, event BLOB NOT NULL, expires_at REAL)",
+    # One row per document: its expiry and, once classified, its indexed values and classification time
+    "CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, expires_at REAL, indexed_at REAL, timestamp TEXT, "
+    + ", ".join(f"{field} TEXT" for field in indexes.INDEXED_FIELDS) + ") WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS document_fields "
+    "(id TEXT, field TEXT, value BLOB NOT NULL, PRIMARY KEY (id, field)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS search_documents "
+    "(docno INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT NOT NULL UNIQUE, length INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS search_postings "
+    "(term TEXT, docno INTEGER, frequency INTEGER NOT NULL, PRIMARY KEY (term, docno)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS lsh (bucket TEXT, id TEXT, score REAL NOT NULL, PRIMARY KEY (bucket, id)) WITHOUT ROWID",
+)
+# Columns added since the first release of the file
+_SQLITE_COLUMNS = (("records", "expires_at REAL"), ("history", "expires_at REAL"))
+_SQLITE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS records_by_expiry ON records (expires_at) WHERE expires_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS history_by_key ON history (key, id)",
+    "CREATE INDEX IF NOT EXISTS history_by_expiry ON history (expires_at) WHERE expires_at IS NOT NULL",
+    # documents is WITHOUT ROWID, so its primary key trails every index: these are ordered by
+    # (indexed_at, id) and (field, indexed_at, id), which is what a filtered page seeks on
+    "CREATE INDEX IF NOT EXISTS documents_by_time ON documents (indexed_at) WHERE indexed_at IS NOT NULL",
+    *(f"CREATE INDEX IF NOT EXISTS documents_by_{field} ON documents ({field}, indexed_at) WHERE indexed_at IS NOT NULL"
+      for field in indexes.INDEXED_FIELDS),
+    "CREATE INDEX IF NOT EXISTS documents_by_expiry ON documents (expires_at) WHERE expires_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS search_postings_by_docno ON search_postings (docno)",
+    "CREATE INDEX IF NOT EXISTS lsh_by_id ON lsh (id)",
+)
+
+# A shared blob lives as long as its longest-lived owner; an expired one is replaced outright
+_UPSERT_BLOB = (
+    "INSERT INTO records (key, value, expires_at) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+    "value = CASE WHEN records.expires_at <= ? THEN excluded.value ELSE records.value END, "
+    "expires_at = CASE WHEN records.expires_at <= ? THEN excluded.expires_at "
+    "WHEN records.expires_at IS NULL OR excluded.expires_at IS NULL THEN NULL "
+    "ELSE MAX(records.expires_at, excluded.expires_at) END"
+)
+
+_LIVE_DOCUMENT = "(documents.expires_at IS NULL OR documents.expires_at > ?)"
+
+
+def _placeholders(values: Sequence[Any]) -> str:
+    return ",".join("?" * len(values))
+
+
+class SQLiteBackend(StorageBackend):
+    """Records, documents, histories and their indexes in one SQLite file in WAL mode.
+
+    All access goes through one connection. Writes share an open transaction that is committed
+    every `batch_size` writes or `commit_ms` after the first uncommitted one, so a burst of small
+    writes costs one commit. This process reads its own uncommitted writes; other processes see
+    them once committed. Document calls run on the thread pool.
+    """
+
+    name = "sqlite"
+
+    def __init__(
+        self,
+        path: str = STORAGE_SQLITE_PATH,
+        history_maxlen: int = 1000,
+        batch_size: int = STORAGE_SQLITE_BATCH,
+        commit_ms: float = STORAGE_SQLITE_COMMIT_MS,
+    ):
+        self.path = path
+        self.history_maxlen = history_maxlen
+        self.batch_size = max(batch_size, 1)
+        self.commit_ms = commit_ms
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints; a commit survives a process crash, not a power cut
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SQLITE_TABLES:
+            self._db.execute(statement)
+        for table, column in _SQLITE_COLUMNS:
+            columns = {row[1] for row in self._db.execute(f"PRAGMA table_info({table})")}
+            if column.split()[0] not in columns:
+                self._db.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+        for statement in _SQLITE_INDEXES:
+            self._db.execute(statement)
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._timer: Optional[threading.Timer] = None
+        self._closed = False
+
+    def _read(self, keys: List[str]) -> List[Optional[bytes]]:
+        found: Dict[str, bytes] = {}
+        now = _clock()
+        # Stay below SQLite's bound-parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = (f"SELECT key, value FROM records WHERE key IN ({_placeholders(chunk)}) "
+                     "AND (expires_at IS NULL OR expires_at > ?)")
+            found.update(self._db.execute(query, [*chunk, now]).fetchall())
+        return [found.get(key) for key in keys]
+
+    def _put_blobs(self, blobs: Records, expires_at: Optional[float], now: float) -> None:
+        self._db.executemany(_UPSERT_BLOB, [(key, blob, expires_at, now, now) for key, blob in blobs.items()])
+
+    def _append_history(self, key: str, event: Dict[str, str]) -> None:
+        self._db.execute("INSERT INTO history (key, event) VALUES (?, ?)", (key, codec.dumps(event)))
+        self._db.execute(
+            "DELETE FROM history WHERE key = ? AND id <= "
+            "(SELECT id FROM history WHERE key = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+            (key, key, self.history_maxlen),
+        )
+
+    def _write(self, records: Records, blobs: Records, events: Events) -> None:
+        self._put_blobs(blobs, None, _clock())
+        self._db.executemany("INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)", records.items())
+        for key, event in events.items():
+            self._append_history(key, event)
+
+    def _transaction(self, work: Callable[[], Any]) -> Any:
+        """Run `work` inside the shared transaction; a failure only undoes its own writes"""
+        if not self._db.in_transaction:
+            # IMMEDIATE takes the write lock up front, so a read-modify-write cannot interleave
+            # with another process
+            self._db.execute("BEGIN IMMEDIATE")
+        self._db.execute("SAVEPOINT write")
+        try:
+            result = work()
+        except BaseException:
+            self._db.execute("ROLLBACK TO write")
+            self._db.execute("RELEASE write")
+            raise
+        self._db.execute("RELEASE write")
+        self._uncommitted += 1
+        if self._uncommitted >= self.batch_size:
+            self._commit()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.commit_ms / 1000, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+        return result
+
+    def _commit(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+        self._uncommitted = 0
+
+    def flush(self) -> None:
+        """Commit the writes of a partial batch now"""
+        with self._lock:
+            if not self._closed:
+                self._commit()
+
+    def _locked_write(self, work: Callable[[], Any]) -> Any:
+        with self._lock:
+            return self._transaction(work)
+
+    def _locked_read(self, work: Callable[[], Any]) -> Any:
+        with self._lock:
+            return work()
+
+    def write(self, records: Records, blobs: Records, events: Events) -> None:
+        self._locked_write(lambda: self._write(records, blobs, events))
+
+    def read(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self._locked_read(lambda: self._read(keys))
+
+    def update(self, key: str, merge: Merge) -> None:
+        self._locked_write(lambda: self._write(*merge(self._read, self._read([key])[0])))
+
+    def history(self, key: str) -> List[HistoryEntry]:
+        rows = self._locked_read(lambda: self._db.execute(
+            "SELECT id, event FROM history WHERE key = ? AND (expires_at IS NULL OR expires_at > ?) ORDER BY id",
+            (key, _clock()),
+        ).fetchall())
+        return [(str(event_id), codec.loads(event)) for event_id, event in rows]
+
+    def _forget(self, doc_id: str) -> None:
+        self._db.execute("DELETE FROM document_fields WHERE id = ?", (doc_id,))
+        self._db.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+        self._db.execute("DELETE FROM lsh WHERE id = ?", (doc_id,))
+        self._unindex_text(doc_id)
+
+    def _unindex_text(self, doc_id: str) -> None:
+        row = self._db.execute("SELECT docno FROM search_documents WHERE id = ?", (doc_id,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM search_postings WHERE docno = ?", row)
+            self._db.execute("DELETE FROM search_documents WHERE docno = ?", row)
+
+    def _purge(self, now: float) -> None:
+        expired = self._db.execute(
+            "SELECT id FROM documents WHERE expires_at <= ? LIMIT ?", (now, STORAGE_PURGE_BATCH)
+        ).fetchall()
+        for (doc_id,) in expired:
+            self._forget(doc_id)
+        self._db.execute("DELETE FROM records WHERE expires_at <= ?", (now,))
+        self._db.execute("DELETE FROM history WHERE expires_at <= ?", (now,))
+
+    def _store_document(self, doc_id: str, write: DocumentWrite) -> None:
+        now = _clock()
+        self._purge(now)
+        self._put_blobs(write.blobs, write.expires_at, now)
+        row = self._db.execute("SELECT expires_at FROM documents WHERE id = ?", (doc_id,)).fetchone()
+        if row is not None and row[0] is not None and row[0] <= now:
+            # Expired, not purged yet: the document starts over
+            self._forget(doc_id)
+        self._db.execute(
+            "INSERT INTO documents (id, expires_at) VALUES (?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET expires_at = excluded.expires_at",
+            (doc_id, write.expires_at),
+        )
+        self._db.executemany(
+            "INSERT OR REPLACE INTO document_fields (id, field, value) VALUES (?, ?, ?)",
+            [(doc_id, field, record) for field, record in write.records.items()],
+        )
+        for event in write.events:
+            self._append_history(doc_id, event)
+        self._db.execute("UPDATE history SET expires_at = ? WHERE key = ?", (write.expires_at, doc_id))
+        score = indexes.epoch(write.indexed_at)
+        if write.index_values is not None:
+            self._db.execute(
+                "UPDATE documents SET indexed_at = ?, timestamp = ?, "
+                + ", ".join(f"{field} = ?" for field in indexes.INDEXED_FIELDS) + " WHERE id = ?",
+                (score, write.indexed_at.isoformat(), *[write.index_values.get(field) for field in indexes.INDEXED_FIELDS], doc_id),
+            )
+        if write.search_terms is not None:
+            self._unindex_text(doc_id)
+            docno = self._db.execute(
+                "INSERT INTO search_documents (id, length) VALUES (?, ?)", (doc_id, sum(write.search_terms.values()))
+            ).lastrowid
+            self._db.executemany(
+                "INSERT INTO search_postings (term, docno, frequency) VALUES (?, ?, ?)",
+                [(term, docno, frequency) for term, frequency in write.search_terms.items()],
+            )
+        if write.signature is not None:
+            self._db.execute("DELETE FROM lsh WHERE id = ?", (doc_id,))
+            for bucket in near_duplicates.bucket_keys(write.signature):
+                self._db.execute("INSERT INTO lsh (bucket, id, score) VALUES (?, ?, ?)", (bucket, doc_id, score))
+                # Only the newest documents of a bucket are kept
+                self._db.execute(
+                    "DELETE FROM lsh WHERE bucket = ? AND id NOT IN "
+                    "(SELECT id FROM lsh WHERE bucket = ? ORDER BY score DESC LIMIT ?)",
+                    (bucket, bucket, near_duplicates.LSH_BUCKET_SIZE),
+                )
+
+    async def store_document(self, doc_id: str, write: DocumentWrite) -> None:
+        await run_io_bound(self._locked_write, lambda: self._store_document(doc_id, write))
+
+    def _read_document(self, doc_id: str, fields: Optional[List[str]]) -> Records:
+        query = ("SELECT field, value FROM document_fields JOIN documents USING (id) "
+                 f"WHERE id = ? AND {_LIVE_DOCUMENT}")
+        parameters: List[Any] = [doc_id, _clock()]
+        if fields is not None:
+            query += f" AND field IN ({_placeholders(fields)})"
+            parameters += fields
+        return dict(self._db.execute(query, parameters).fetchall())
+
+    async def read_document(self, doc_id: str, fields: Optional[List[str]] = None) -> Records:
+        return await run_io_bound(self._locked_read, lambda: self._read_document(doc_id, fields))
+
+    def _document_history(self, doc_id: str, cursor: Optional[str], count: int, reverse: bool) -> List[HistoryEntry]:
+        query = "SELECT id, event FROM history WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)"
+        parameters: List[Any] = [doc_id, _clock()]
+        if cursor:
+            query += " AND id < ?" if reverse else " AND id > ?"
+            parameters.append(int(cursor))
+        query += f" ORDER BY id {'DESC' if reverse else 'ASC'} LIMIT ?"
+        rows = self._db.execute(query, [*parameters, count]).fetchall()
+        return [(str(event_id), codec.loads(event)) for event_id, event in rows]
+
+    async def document_history(
+        self, doc_id: str, cursor: Optional[str], count: int, reverse: bool = False,
+    ) -> List[HistoryEntry]:
+        return await run_io_bound(self._locked_read, lambda: self._document_history(doc_id, cursor, count, reverse))
+
+    def _delete_document(self, doc_id: str, event: Dict[str, str], history_ttl: int) -> bool:
+        now = _clock()
+        row = self._db.execute(f"SELECT 1 FROM documents WHERE id = ? AND {_LIVE_DOCUMENT}", (doc_id, now)).fetchone()
+        if row is None:
+            return False
+        self._forget(doc_id)
+        self._append_history(doc_id, event)
+        self._db.execute("UPDATE history SET expires_at = ? WHERE key = ?", (now + history_ttl if history_ttl else None, doc_id))
+        return True
+
+    async def delete_document(self, doc_id: str, event: Dict[str, str], history_ttl: int) -> bool:
+        return await run_io_bound(self._locked_write, lambda: self._delete_document(doc_id, event, history_ttl))
+
+    def _query_documents(
+        self,
+        filters: Dict[str, str],
+        since: Optional[datetime],
+        until: Optional[datetime],
+        cursor: Optional[str],
+        limit: int,
+    ) -> Page:
+        bounds = indexes.keyset_bounds(since, until, cursor)
+        if bounds is None:
+            return [], None
+        high, low, after = bounds
+        if after is None or after[0] > high:
+            conditions = [f"indexed_at BETWEEN ? AND ? AND {_LIVE_DOCUMENT}"]
+            parameters: List[Any] = [low, high, _clock()]
+        else:
+            # Seek to the end of the previous page on the index instead of skipping rows with OFFSET
+            conditions = [f"indexed_at >= ? AND (indexed_at, id) < (?, ?) AND {_LIVE_DOCUMENT}"]
+            parameters = [low, *after, _clock()]
+        for field in indexes.INDEXED_FIELDS:
+            if field in filters:
+                conditions.append(f"{field} = ?")
+                parameters.append(filters[field].lower())
+        rows = self._db.execute(
+            f"SELECT id, indexed_at, timestamp, {_INDEX_COLUMNS} FROM documents WHERE {' AND '.join(conditions)} "
+            "ORDER BY indexed_at DESC, id DESC LIMIT ?",
+            [*parameters, limit + 1],
+        ).fetchall()
+        page = rows[:limit]
+        documents = [
+            {"id": doc_id, "timestamp": timestamp,
+             "classification": {field: value for field, value in zip(indexes.INDEXED_FIELDS, values) if value is not None}}
+            for doc_id, _, timestamp, *values in page
+        ]
+        return documents, indexes.keyset_cursor([(score, doc_id) for doc_id, score, *_ in page], len(rows) > limit)
+
+    async def query_documents(
+        self,
+        filters: Dict[str, str],
+        since: Optional[datetime],
+        until: Optional[datetime],
+        cursor: Optional[str],
+        limit: int,
+    ) -> Page:
+        return await run_io_bound(self._locked_read, lambda: self._query_documents(filters, since, until, cursor, limit))
+
+    def _near_duplicate_candidates(self, doc_id: str, signature: Sequence[int]) -> Dict[str, Optional[bytes]]:
+        buckets = near_duplicates.bucket_keys(signature)
+        found = [candidate for (candidate,) in self._db.execute(
+            f"SELECT DISTINCT id FROM lsh WHERE bucket IN ({_placeholders(buckets)}) AND id != ?", [*buckets, doc_id],
+        ).fetchall()]
+        if not found:
+            return {}
+        signatures = dict(self._db.execute(
+            "SELECT id, value FROM document_fields JOIN documents USING (id) "
+            f"WHERE field = 'minhash' AND id IN ({_placeholders(found)}) AND {_LIVE_DOCUMENT}",
+            [*found, _clock()],
+        ).fetchall())
+        return {candidate: signatures.get(candidate) for candidate in found}
+
+    async def near_duplicate_candidates(self, doc_id: str, signature: Sequence[int]) -> Dict[str, Optional[bytes]]:
+        return await run_io_bound(self._locked_read, lambda: self._near_duplicate_candidates(doc_id, signature))
+
+    def _search(self, terms: List[str], cursor: Optional[str], limit: int) -> Page:
+        now = _clock()
+        postings: Dict[str, List[Tuple[int, int, int]]] = collections.defaultdict(list)
+        for term, docno, frequency, length in self._db.execute(
+            "SELECT term, docno, frequency, length FROM search_postings JOIN search_documents USING (docno) "
+            f"JOIN documents USING (id) WHERE term IN ({_placeholders(terms)}) AND {_LIVE_DOCUMENT}",
+            [*terms, now],
+        ):
+            postings[term].append((docno, frequency, length))
+        documents, total_length = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM search_documents"
+        ).fetchone()
+        page, next_cursor = search_index.page(search_index.rank_entries(postings, documents, total_length), cursor, limit)
+        if not page:
+            return [], next_cursor
+        docnos = [docno for _, docno in page]
+        ids = dict(self._db.execute(
+            f"SELECT docno, id FROM search_documents WHERE docno IN ({_placeholders(docnos)})", docnos,
+        ).fetchall())
+        return [{"id": ids[docno], "score": round(score, 4)} for score, docno in page], next_cursor
+
+    async def search(self, query: str, cursor: Optional[str], limit: int) -> Page:
+        terms = sorted(search_index.tokenize(query))
+        if not terms:
+            return [], None
+        return await run_io_bound(self._locked_read, lambda: self._search(terms, cursor, limit))
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._closed:
+                self._commit()
+                self._db.close()
+                self._closed = True
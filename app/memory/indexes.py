@@ -0,0 +1,216 @@
+import itertools
+import math
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional, Tuple
+
+from redis.exceptions import WatchError
+
+# Secondary indexes over the classification of each document. Every combination of the indexed
+# values a document has gets a sorted set of document ids scored by classification time, e.g.
+# "idx:intent=complaint&urgency=high". A filtered query is then one range read on one set, so a
+# page costs O(log N + page size) whatever the filters. idx:doc:{id} remembers what a document
+# is indexed under, so reclassification, deletion and expiry can take it out again.
+INDEXED_FIELDS = ("format", "intent", "subtype", "urgency")
+INDEX_PREFIX = "idx:"
+# Expiry time of every indexed document that has a TTL
+EXPIRY_KEY = "idx:expiry"
+# Expired documents removed from the indexes per write or query
+INDEX_PRUNE_BATCH = 100
+
+
+def doc_index_key(doc_id: str) -> str:
+    return f"{INDEX_PREFIX}doc:{doc_id}"
+
+
+def index_values(classification: Dict[str, Any]) -> Dict[str, str]:
+    """The indexed values of a classification, normalized; missing values are not indexed"""
+    return {
+        field: str(classification[field]).lower()
+        for field in INDEXED_FIELDS
+        if classification.get(field) is not None
+    }
+
+
+def filter_key(filters: Dict[str, str]) -> str:
+    """The set holding exactly the documents matching every filter"""
+    if not filters:
+        return f"{INDEX_PREFIX}all"
+    return INDEX_PREFIX + "&".join(f"{field}={filters[field]}" for field in INDEXED_FIELDS if field in filters)
+
+
+def index_keys(values: Dict[str, str]) -> List[str]:
+    fields = [field for field in INDEXED_FIELDS if field in values]
+    return [
+        filter_key({field: values[field] for field in combination})
+        for size in range(len(fields) + 1)
+        for combination in itertools.combinations(fields, size)
+    ]
+
+
+def epoch(moment: datetime) -> float:
+    # Naive datetimes are UTC throughout the storage layer
+    return (moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def page_bounds(
+    since: Optional[datetime], until: Optional[datetime], cursor: Optional[str],
+) -> Optional[Tuple[float, float, int]]:
+    """(newest, oldest, skip) classification times of a page; None if the range is empty.
+
+    A cursor is "<score>:<n>": continue at classification time <score>, skipping the n documents
+    with exactly that time that were already returned. A malformed one raises ValueError.
+    """
+    high = epoch(until) if until else math.inf
+    skip = 0
+    if cursor:
+        score, _, seen = cursor.partition(":")
+        high, skip = float(score), int(seen or 0)
+    low = epoch(since) if since else -math.inf
+    if high < low:
+        return None
+    return high, low, skip
+
+
+def next_cursor(scores: List[float], more: bool, cursor: Optional[str], high: float, skip: int) -> Optional[str]:
+    """Cursor of the page after one whose documents had classification times `scores`"""
+    if not more:
+        return None
+    last_score = scores[-1]
+    ties = sum(1 for score in scores if score == last_score)
+    # Documents at the boundary time that an earlier page already returned are skipped again
+    if cursor and high == last_score:
+        ties += skip
+    return f"{last_score!r}:{ties}"
+
+
+def keyset_bounds(
+    since: Optional[datetime], until: Optional[datetime], cursor: Optional[str],
+) -> Optional[Tuple[float, float, Optional[Tuple[float, str]]]]:
+    """(newest, oldest, after) of a page for backends that can seek to a (classification time, id)
+    pair; None if the range is empty. The page holds the documents ordered before `after`.
+
+    A cursor is "<score>:<id>", the last document of the previous page. Documents are ordered by
+    time then id, both descending, as in a Redis sorted set. A malformed one raises ValueError.
+    """
+    high = epoch(until) if until else math.inf
+    low = epoch(since) if since else -math.inf
+    after = None
+    if cursor:
+        score, separator, last_id = cursor.partition(":")
+        after = (float(score), last_id)
+        if not separator or math.isnan(after[0]):
+            raise ValueError(f"invalid cursor {cursor!r}")
+    if high < low:
+        return None
+    return high, low, after
+
+
+def keyset_cursor(page: List[Tuple[float, str]], more: bool) -> Optional[str]:
+    """Cursor of the page after one whose (classification time, id) pairs were `page`"""
+    if not more:
+        return None
+    score, doc_id = page[-1]
+    return f"{score!r}:{doc_id}"
+
+
+def decode_values(fields: Dict[bytes, bytes]) -> Dict[str, str]:
+    return {name.decode(): value.decode() for name, value in fields.items()}
+
+
+def queue_unindex(pipe, doc_id: str, previous: Dict[str, str]) -> None:
+    for key in index_keys({field: value for field, value in previous.items() if field in INDEXED_FIELDS}):
+        pipe.zrem(key, doc_id)
+    pipe.delete(doc_index_key(doc_id))
+    pipe.zrem(EXPIRY_KEY, doc_id)
+
+
+def queue_index(
+    pipe,
+    doc_id: str,
+    previous: Dict[str, str],
+    values: Dict[str, str],
+    indexed_at: datetime,
+    expires_at: Optional[float],
+) -> None:
+    """Move a document from the sets of its previous classification to those of its new one"""
+    new_keys = set(index_keys(values))
+    for key in set(index_keys({field: value for field, value in previous.items() if field in INDEXED_FIELDS})) - new_keys:
+        pipe.zrem(key, doc_id)
+    score = epoch(indexed_at)
+    for key in new_keys:
+        pipe.zadd(key, {doc_id: score})
+    pipe.delete(doc_index_key(doc_id))
+    pipe.hset(doc_index_key(doc_id), mapping={**values, "timestamp": indexed_at.isoformat()})
+    queue_expiry(pipe, doc_id, expires_at, only_indexed=False)
+
+
+def queue_expiry(pipe, doc_id: str, expires_at: Optional[float], only_indexed: bool = True) -> None:
+    """Track when a document expires; `only_indexed` leaves documents without a classification alone"""
+    if expires_at is None:
+        pipe.zrem(EXPIRY_KEY, doc_id)
+    elif only_indexed:
+        pipe.zadd(EXPIRY_KEY, {doc_id: expires_at}, xx=True)
+    else:
+        pipe.zadd(EXPIRY_KEY, {doc_id: expires_at})
+
+
+async def prune_expired(client, now: float, batch: int = INDEX_PRUNE_BATCH) -> List[str]:
+    """Take up to `batch` expired documents out of the indexes; returns their ids"""
+    expired = [member.decode() for member in await client.zrangebyscore(EXPIRY_KEY, "-inf", now, start=0, num=batch)]
+    if not expired:
+        return []
+    keys = [doc_index_key(doc_id) for doc_id in expired]
+    async with client.pipeline(transaction=True) as pipe:
+        try:
+            # A document stored again under the same id meanwhile rewrites its idx:doc key and aborts this
+            await pipe.watch(*keys)
+            reads = client.pipeline(transaction=False)
+            for key in keys:
+                reads.hgetall(key)
+            previous = await reads.execute()
+            pipe.multi()
+            for doc_id, fields in zip(expired, previous):
+                queue_unindex(pipe, doc_id, decode_values(fields))
+            await pipe.execute()
+        except WatchError:
+            # The next prune picks them up again
+            return []
+    return expired
+
+
+async def query(
+    client,
+    filters: Dict[str, str],
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of matching documents, newest first, and the cursor of the next page (see page_bounds)"""
+    key = filter_key({field: value.lower() for field, value in filters.items()})
+    bounds = page_bounds(since, until, cursor)
+    if bounds is None:
+        return [], None
+    high, low, skip = bounds
+
+    now = epoch(datetime.utcnow())
+    await prune_expired(client, now)
+    entries = await client.zrevrangebyscore(
+        key, "+inf" if high == math.inf else high, "-inf" if low == -math.inf else low,
+        start=skip, num=limit + 1, withscores=True,
+    )
+    page, more = entries[:limit], len(entries) > limit
+    pipe = client.pipeline(transaction=False)
+    for member, _ in page:
+        pipe.hgetall(doc_index_key(member.decode()))
+        pipe.zscore(EXPIRY_KEY, member)
+    replies = await pipe.execute() if page else []
+    documents = []
+    for (member, _), fields, expires_at in zip(page, replies[::2], replies[1::2]):
+        if expires_at is not None and expires_at <= now:
+            # Expired, but beyond what this query's prune got to
+            continue
+        values = decode_values(fields)
+        documents.append({"id": member.decode(), "timestamp": values.pop("timestamp", None), "classification": values})
+    return documents, next_cursor([score for _, score in page], more, cursor, high, skip)
+
@@ -0,0 +1,77 @@
+import argparse
+from typing import Dict
+
+from app import codec
+from app.memory.shared_memory import get_redis, DOCUMENT_SUFFIXES, document_key, retention_ttl
+from app.memory.storage_format import encode_record, decode_record, is_current_format
+
+MIGRATION_BATCH_SIZE = 500
+
+
+def fold_document(doc_id: str, dry_run: bool = False) -> bool:
+    """Move a document's per-agent `{id}_{field}` keys into its `doc:{id}` hash and apply its TTL"""
+    keys = [f"{doc_id}_{suffix}" for suffix in DOCUMENT_SUFFIXES]
+    values = get_redis().mget(keys)
+    records: Dict[str, bytes] = {}
+    blobs: Dict[str, bytes] = {}
+    retention_class = None
+    for suffix, value in zip(DOCUMENT_SUFFIXES, values):
+        if not value:
+            continue
+        record = decode_record(value)
+        if "data" not in record:
+            continue
+        if suffix == "classification":
+            retention_class = record["data"].get("intent")
+        if is_current_format(value):
+            records[suffix] = value
+        else:
+            metadata = record.get("metadata") or {}
+            records[suffix], record_blobs = encode_record(record["data"], metadata.get("source"), metadata.get("timestamp"))
+            blobs.update(record_blobs)
+    if not records or dry_run:
+        return bool(records)
+    ttl = retention_ttl(retention_class)
+    pipe = get_redis().pipeline(transaction=True)
+    for key, blob in blobs.items():
+        pipe.set(key, blob, nx=True, ex=ttl or None)
+        if ttl:
+            pipe.expire(key, ttl, gt=True)
+    pipe.hset(document_key(doc_id), mapping=records)
+    if ttl:
+        pipe.expire(document_key(doc_id), ttl)
+    pipe.delete(*keys)
+    pipe.execute()
+    return True
+
+
+def migrate_all(batch_size: int = MIGRATION_BATCH_SIZE, dry_run: bool = False) -> Dict[str, int]:
+    """SCAN for per-agent document keys and fold each document into its hash; safe to re-run"""
+    totals = {"documents": 0}
+    seen = set()
+    # Longest first: "*_json" also matches "{id}_embedded_json", which belongs to document {id}
+    suffixes = sorted(DOCUMENT_SUFFIXES, key=len, reverse=True)
+    for suffix in DOCUMENT_SUFFIXES:
+        for key in get_redis().scan_iter(match=f"*_{suffix}", count=batch_size):
+            name = key.decode()
+            if next(other for other in suffixes if name.endswith(f"_{other}")) != suffix:
+                continue
+            doc_id = name[:-len(suffix) - 1]
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            if fold_document(doc_id, dry_run):
+                totals["documents"] += 1
+    return totals
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Migrate stored documents to the compact, one-hash-per-document format")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+    print(migrate_all(args.batch_size, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
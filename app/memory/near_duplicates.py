@@ -0,0 +1,142 @@
+import hashlib
+import os
+import re
+from typing import Callable, Dict, Any, List, Optional, Sequence
+
+from app.memory.storage_format import decode_record
+
+# Near-duplicate detection: a MinHash signature of each document's word shingles, stored in its
+# hash as the "minhash" field, and an LSH banding index. Documents whose signatures agree on
+# every row of at least one band share a bucket, so a lookup reads LSH_BANDS buckets instead of
+# comparing against every stored document.
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "1") != "0"
+# Estimated Jaccard similarity from which a stored document is reported as `near_duplicate_of`
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", "0.8"))
+# From this similarity the neighbour's classification is reused and the LLM/PDF stages are skipped;
+# 0 never skips
+NEAR_DUPLICATE_SKIP_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_SKIP_THRESHOLD", "0"))
+# PDFs are compared on the text of their first pages, so a duplicate is caught before full extraction
+NEAR_DUPLICATE_PDF_PAGES = int(os.getenv("NEAR_DUPLICATE_PDF_PAGES", "2"))
+# Most recent documents kept per bucket; bounds a lookup for very common templates
+LSH_BUCKET_SIZE = int(os.getenv("LSH_BUCKET_SIZE", "50"))
+
+SHINGLE_WORDS = 3
+PERMUTATIONS = 128
+LSH_BANDS = 32
+LSH_ROWS = PERMUTATIONS // LSH_BANDS
+
+_WORD = re.compile(r"\w+")
+_MASK = (1 << 64) - 1
+_MULTIPLIER = 0x100000001B3
+
+
+def _mix(value: int) -> int:
+    # splitmix64 finalizer: spreads polynomial shingle hashes over all 64 bits
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK
+    return value ^ (value >> 31)
+
+
+def words(text_lower: str) -> List[str]:
+    """The words a signature is built from, of an already lowercased text"""
+    return _WORD.findall(text_lower)
+
+
+def minhash(text: str) -> List[int]:
+    """MinHash signature of the word shingles of a text, PERMUTATIONS 32-bit values"""
+    return minhash_words(words(text.lower()))
+
+
+def minhash_words(text_words: Sequence[str]) -> List[int]:
+    """MinHash signature of a word sequence.
+
+    One-permutation hashing: each shingle hash is split into a bin (its low bits) and a value,
+    and each bin keeps its minimum, so the cost is one pass over the text. Empty bins borrow
+    from the next non-empty bin (densification) so short texts still compare fairly.
+    """
+    word_hashes: Dict[str, int] = {}
+    hashes = []
+    for word in text_words:
+        value = word_hashes.get(word)
+        if value is None:
+            value = word_hashes[word] = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), "little")
+        hashes.append(value)
+
+    bins: List[Optional[int]] = [None] * PERMUTATIONS
+    for start in range(max(len(hashes) - SHINGLE_WORDS + 1, 1 if hashes else 0)):
+        shingle = 0
+        for value in hashes[start:start + SHINGLE_WORDS]:
+            shingle = (shingle * _MULTIPLIER + value) & _MASK
+        shingle = _mix(shingle)
+        position, value = shingle % PERMUTATIONS, shingle // PERMUTATIONS
+        current = bins[position]
+        if current is None or value < current:
+            bins[position] = value
+
+    if all(value is None for value in bins):
+        return [0] * PERMUTATIONS
+    signature = []
+    for position in range(PERMUTATIONS):
+        distance = 0
+        while bins[(position + distance) % PERMUTATIONS] is None:
+            distance += 1
+        value = bins[(position + distance) % PERMUTATIONS]
+        signature.append(_mix(value + distance) & 0xFFFFFFFF if distance else value & 0xFFFFFFFF)
+    return signature
+
+
+def similarity(first: Sequence[int], second: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the texts behind two signatures"""
+    return sum(1 for a, b in zip(first, second) if a == b) / PERMUTATIONS
+
+
+def bucket_keys(signature: Sequence[int]) -> List[str]:
+    keys = []
+    for band in range(LSH_BANDS):
+        rows = signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]
+        digest = hashlib.blake2b(",".join(map(str, rows)).encode(), digest_size=8).hexdigest()
+        keys.append(f"lsh:{band}:{digest}")
+    return keys
+
+
+def queue_insert(pipe, doc_id: str, signature: Sequence[int], score: float, ttl: int) -> None:
+    for key in bucket_keys(signature):
+        pipe.zadd(key, {doc_id: score})
+        # Only the newest documents of a bucket are kept
+        pipe.zremrangebyrank(key, 0, -LSH_BUCKET_SIZE - 1)
+        if ttl:
+            pipe.expire(key, ttl, gt=True)
+        else:
+            pipe.persist(key)
+
+
+def best_match(signature: Sequence[int], candidates: Dict[str, Optional[bytes]]) -> Optional[Dict[str, Any]]:
+    """The candidate most similar to `signature` at or above NEAR_DUPLICATE_THRESHOLD, as {"id", "similarity"}.
+
+    `candidates` maps document ids to their stored "minhash" records, None once gone.
+    """
+    best = None
+    for candidate, record in sorted(candidates.items()):
+        if record is None:
+            continue
+        score = similarity(signature, decode_record(record)["data"]["values"])
+        if score >= NEAR_DUPLICATE_THRESHOLD and (best is None or score > best["similarity"]):
+            best = {"id": candidate, "similarity": round(score, 3)}
+    return best
+
+
+async def candidates(
+    client, doc_id: str, signature: Sequence[int], document_key: Callable[[str], str],
+) -> Dict[str, Optional[bytes]]:
+    """The signatures of the documents sharing an LSH bucket with `signature`, other than doc_id"""
+    pipe = client.pipeline(transaction=False)
+    for key in bucket_keys(signature):
+        pipe.zrevrange(key, 0, LSH_BUCKET_SIZE - 1)
+    found = sorted({member.decode() for members in await pipe.execute() for member in members} - {doc_id})
+    if not found:
+        return {}
+    pipe = client.pipeline(transaction=False)
+    for candidate in found:
+        pipe.hget(document_key(candidate), "minhash")
+    # Expired or deleted documents linger in buckets until pushed out by newer ones
+    return dict(zip(found, await pipe.execute()))
@@ -0,0 +1,102 @@
+import hashlib
+import os
+from typing import Dict, Any, Optional, Union
+
+import redis
+from cachetools import LRUCache
+
+from app import codec
+from app.memory.shared_memory import get_async_redis, get_storage_backend
+
+# Bump whenever an agent's output changes so stale analyses are not reused
+AGENT_VERSION = "3"
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+# The in-process tier is bounded by the size of the serialized entries, not their count
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(24 * 3600)))
+
+_local: LRUCache = LRUCache(maxsize=RESULT_CACHE_MAX_BYTES, getsizeof=len)
+_stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+
+def content_hasher(content_type: str) -> "hashlib._Hash":
+    """Incremental hasher for callers that stream content (e.g. uploads) through it"""
+    digest = hashlib.sha256()
+    digest.update(f"{AGENT_VERSION}\0{content_type}\0".encode())
+    return digest
+
+
+def content_hash(content_type: str, content: Union[str, bytes]) -> str:
+    """Cache key for a document: hash of its content type and bytes plus the agent version"""
+    digest = content_hasher(content_type)
+    digest.update(content.encode() if isinstance(content, str) else content)
+    return digest.hexdigest()
+
+
+def _redis_key(key: str) -> str:
+    return f"result_cache:{key}"
+
+
+def _redis_tier() -> bool:
+    # Without Redis as the storage backend the local LRU is the only tier
+    return get_storage_backend().name == "redis"
+
+
+async def get_cached(key: str) -> Optional[Dict[str, Any]]:
+    """Look a key up in the local LRU, then Redis (when it is the storage backend); Redis hits are promoted to the LRU"""
+    if not RESULT_CACHE_ENABLED:
+        return None
+    value = _local.get(key)
+    if value is not None:
+        _stats["local_hits"] += 1
+        return codec.loads(value)
+    if not _redis_tier():
+        _stats["misses"] += 1
+        return None
+    try:
+        value = await get_async_redis().get(_redis_key(key))
+    except redis.RedisError:
+        _stats["errors"] += 1
+        value = None
+    if value is None:
+        _stats["misses"] += 1
+        return None
+    _stats["redis_hits"] += 1
+    if len(value) <= RESULT_CACHE_MAX_BYTES:
+        _local[key] = value
+    return codec.loads(value)
+
+
+async def put_cached(key: str, entry: Dict[str, Any]) -> None:
+    if not RESULT_CACHE_ENABLED:
+        return
+    value = codec.dumps(entry)
+    # Entries larger than the whole LRU only go to Redis
+    if len(value) <= RESULT_CACHE_MAX_BYTES:
+        _local[key] = value
+    if not _redis_tier():
+        _stats["stores"] += 1
+        return
+    try:
+        await get_async_redis().set(_redis_key(key), value, ex=RESULT_CACHE_TTL)
+    except redis.RedisError:
+        _stats["errors"] += 1
+        return
+    _stats["stores"] += 1
+
+
+def cache_stats() -> Dict[str, Any]:
+    lookups = _stats["local_hits"] + _stats["redis_hits"] + _stats["misses"]
+    hits = _stats["local_hits"] + _stats["redis_hits"]
+    return {
+        **_stats,
+        "hit_ratio": hits / lookups if lookups else 0.0,
+        "local_entries": len(_local),
+        "local_bytes": _local.currsize,
+        "local_max_bytes": _local.maxsize,
+    }
+
+
+def clear_local_cache() -> None:
+    _local.clear()
@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import collections
+import math
+import os
+import re
+import time
+import uuid
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+from redis.exceptions import WatchError
+
+from app import codec
+
+# Full-text index over extracted document text. Writers only XADD an event holding a document's
+# term frequencies (tokenized once, off the event loop) in the same transaction as the document
+# itself. A single indexer at a time folds pending events into per-term postings lists, so
+# document numbers are assigned in order and every list stays sorted and delta encoded:
+#
+#   search:p:{term}   varint(docno - previous docno) varint(term frequency) varint(document length) ...
+#
+# Deleted, replaced and expired documents become tombstones (skipped when ranking) until
+# `python -m app.memory.search_index --compact` rewrites the lists without them.
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "1") != "0"
+# Pending events folded into the postings per indexer transaction
+SEARCH_FLUSH_BATCH = int(os.getenv("SEARCH_FLUSH_BATCH", "256"))
+SEARCH_MAX_TERM_LENGTH = 64
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+PREFIX = "search:"
+EVENTS_KEY = "search:events"
+CURSOR_KEY = "search:cursor"
+LOCK_KEY = "search:lock"
+NEXT_DOCNO_KEY = "search:next_docno"
+TAILS_KEY = "search:tails"  # term -> last docno in its postings
+DOCNOS_KEY = "search:docnos"  # document id -> current docno
+IDS_KEY = "search:ids"  # docno -> document id
+LENGTHS_KEY = "search:lengths"  # docno -> document length in terms
+STATS_KEY = "search:stats"  # live documents and their total length
+TOMBSTONES_KEY = "search:tombstones"
+EXPIRY_KEY = "search:expiry"  # document id -> expiry time
+LOCK_MS = 30_000
+
+_TOKEN = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or our please that the this to was we were will with you your".split()
+)
+
+
+def postings_key(term: str) -> str:
+    return f"{PREFIX}p:{term}"
+
+
+def tokenize(text: str) -> Dict[str, int]:
+    """Term frequencies of a text: lowercased words, part numbers like widget-a kept whole"""
+    return dict(collections.Counter(
+        token for token in _TOKEN.findall(text.lower())
+        if token not in STOPWORDS and len(token) <= SEARCH_MAX_TERM_LENGTH
+    ))
+
+
+def encode_varint(value: int, out: bytearray) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_postings(data: bytes) -> Iterator[Tuple[int, int, int]]:
+    """Yield (docno, term frequency, document length) from a postings list"""
+    values: List[int] = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        values.append(value)
+        value = shift = 0
+    docno = 0
+    for position in range(0, len(values), 3):
+        docno += values[position]
+        yield docno, values[position + 1], values[position + 2]
+
+
+def encode_postings(postings: List[Tuple[int, int, int]], previous: int = 0) -> bytes:
+    out = bytearray()
+    for docno, frequency, length in postings:
+        encode_varint(docno - previous, out)
+        encode_varint(frequency, out)
+        encode_varint(length, out)
+        previous = docno
+    return bytes(out)
+
+
+def index_event(doc_id: str, terms: Dict[str, int], expires_at: Optional[float]) -> Dict[str, bytes]:
+    """The stream entry that (re)indexes a document with its term frequencies"""
+    return {"op": b"index", "id": doc_id.encode(), "terms": codec.dumps(terms),
+            "expires_at": str(expires_at or 0).encode()}
+
+
+def queue_index(pipe, event: Dict[str, bytes]) -> None:
+    pipe.xadd(EVENTS_KEY, event)
+
+
+def queue_delete(pipe, doc_id: str) -> None:
+    pipe.xadd(EVENTS_KEY, {"op": "delete", "id": doc_id})
+
+
+class _Batch:
+    """Index changes computed from one run of pending events, written in one transaction"""
+
+    def __init__(self, next_docno: int, tails: Dict[str, int], docnos: Dict[str, Optional[int]], lengths: Dict[int, int]):
+        self.next_docno = next_docno
+        self.tails = tails
+        self.docnos = docnos
+        self.lengths = lengths
+        self.appends: Dict[str, bytearray] = collections.defaultdict(bytearray)
+        self.tombstones: List[int] = []
+        self.removed_ids: List[str] = []
+        self.expiry: Dict[str, float] = {}
+        self.live_delta = 0
+        self.length_delta = 0
+
+    def remove(self, doc_id: str) -> None:
+        docno = self.docnos.get(doc_id)
+        if docno is None:
+            return
+        self.tombstones.append(docno)
+        self.live_delta -= 1
+        self.length_delta -= self.lengths.pop(docno, 0)
+        self.docnos[doc_id] = None
+        self.expiry.pop(doc_id, None)
+        self.removed_ids.append(doc_id)
+
+    def add(self, doc_id: str, terms: Dict[str, int], expires_at: float) -> None:
+        self.remove(doc_id)
+        self.next_docno += 1
+        docno = self.next_docno
+        length = sum(terms.values())
+        for term, frequency in terms.items():
+            out = self.appends[term]
+            encode_varint(docno - self.tails.get(term, 0), out)
+            encode_varint(frequency, out)
+            encode_varint(length, out)
+            self.tails[term] = docno
+        self.docnos[doc_id] = docno
+        self.lengths[docno] = length
+        self.live_delta += 1
+        self.length_delta += length
+        if expires_at:
+            self.expiry[doc_id] = expires_at
+        if doc_id in self.removed_ids:
+            self.removed_ids.remove(doc_id)
+
+
+async def _apply_batch(client) -> bool:
+    """Fold up to SEARCH_FLUSH_BATCH pending events and expired documents into the index.
+
+    Returns False once nothing is left. The transaction is WATCHed on the cursor, so a second
+    indexer that ran meanwhile (say, after a lock timeout) makes this one start over instead of
+    appending out of order.
+    """
+    async with client.pipeline(transaction=True) as pipe:
+        await pipe.watch(CURSOR_KEY)
+        cursor = await pipe.get(CURSOR_KEY)
+        events = await client.xrange(EVENTS_KEY, min=b"(" + cursor if cursor else "-", count=SEARCH_FLUSH_BATCH)
+        expired = [member.decode() for member in
+                   await client.zrangebyscore(EXPIRY_KEY, "-inf", time.time(), start=0, num=SEARCH_FLUSH_BATCH)]
+        if not events and not expired:
+            return False
+
+        parsed = [(fields[b"op"], fields[b"id"].decode(), fields) for _, fields in events]
+        doc_ids = sorted({doc_id for _, doc_id, _ in parsed} | set(expired))
+        terms = sorted({term for op, _, fields in parsed if op == b"index" for term in codec.loads(fields[b"terms"])})
+        reads = client.pipeline(transaction=False)
+        reads.get(NEXT_DOCNO_KEY)
+        reads.hmget(DOCNOS_KEY, doc_ids)
+        if terms:
+            reads.hmget(TAILS_KEY, terms)
+        replies = await reads.execute()
+        docnos = {doc_id: int(docno) if docno else None for doc_id, docno in zip(doc_ids, replies[1])}
+        known = [docno for docno in docnos.values() if docno is not None]
+        lengths = dict(zip(known, [int(length or 0) for length in await client.hmget(LENGTHS_KEY, known)])) if known else {}
+        tails = {term: int(tail) for term, tail in zip(terms, replies[2]) if tail} if terms else {}
+
+        batch = _Batch(int(replies[0] or 0), tails, docnos, lengths)
+        # Expired documents go first, so a document indexed again in this batch stays
+        for doc_id in expired:
+            batch.remove(doc_id)
+        for op, doc_id, fields in parsed:
+            if op == b"index":
+                batch.add(doc_id, codec.loads(fields[b"terms"]), float(fields[b"expires_at"]))
+            else:
+                batch.remove(doc_id)
+
+        pipe.multi()
+        for term, data in batch.appends.items():
+            pipe.append(postings_key(term), bytes(data))
+        if batch.appends:
+            pipe.hset(TAILS_KEY, mapping={term: batch.tails[term] for term in batch.appends})
+        pipe.set(NEXT_DOCNO_KEY, batch.next_docno)
+        live = {doc_id: docno for doc_id, docno in batch.docnos.items() if docno is not None and docno not in known}
+        if live:
+            pipe.hset(DOCNOS_KEY, mapping=live)
+            pipe.hset(IDS_KEY, mapping={docno: doc_id for doc_id, docno in live.items()})
+            pipe.hset(LENGTHS_KEY, mapping={docno: batch.lengths[docno] for docno in live.values()})
+        if batch.removed_ids:
+            pipe.hdel(DOCNOS_KEY, *batch.removed_ids)
+        if batch.tombstones:
+            pipe.sadd(TOMBSTONES_KEY, *batch.tombstones)
+            pipe.hdel(IDS_KEY, *batch.tombstones)
+            pipe.hdel(LENGTHS_KEY, *batch.tombstones)
+        pipe.hincrby(STATS_KEY, "documents", batch.live_delta)
+        pipe.hincrby(STATS_KEY, "length", batch.length_delta)
+        gone = [doc_id for doc_id in doc_ids if doc_id not in batch.expiry]
+        if gone:
+            pipe.zrem(EXPIRY_KEY, *gone)
+        if batch.expiry:
+            pipe.zadd(EXPIRY_KEY, batch.expiry)
+        if events:
+            pipe.set(CURSOR_KEY, events[-1][0])
+            pipe.xtrim(EVENTS_KEY, minid=events[-1][0])
+        try:
+            await pipe.execute()
+        except WatchError:
+            pass
+        return True
+
+
+async def _pending(client) -> bool:
+    cursor = await client.get(CURSOR_KEY)
+    return bool(await client.xrange(EVENTS_KEY, min=b"(" + cursor if cursor else "-", count=1))
+
+
+async def flush(client) -> None:
+    """Bring the index up to date with every event written so far, unless another indexer is on it.
+
+    A writer that finds the lock taken leaves its event to the holder, which checks for new
+    events after releasing the lock and goes again if there are any.
+    """
+    while True:
+        token = uuid.uuid4().hex
+        if not await client.set(LOCK_KEY, token, nx=True, px=LOCK_MS):
+            return
+        try:
+            while await _apply_batch(client):
+                pass
+        finally:
+            if await client.get(LOCK_KEY) == token.encode():
+                await client.delete(LOCK_KEY)
+        if not await _pending(client):
+            return
+
+
+def rank(postings: Dict[str, bytes], documents: int, total_length: int) -> List[Tuple[float, int]]:
+    """BM25 scores of every document containing a query term, best first"""
+    return rank_entries({term: list(decode_postings(data)) for term, data in postings.items()}, documents, total_length)
+
+
+def rank_entries(
+    postings: Dict[str, List[Tuple[int, int, int]]], documents: int, total_length: int,
+) -> List[Tuple[float, int]]:
+    """rank() over decoded (docno, term frequency, document length) postings"""
+    average_length = total_length / documents if documents else 1.0
+    scores: Dict[int, float] = collections.defaultdict(float)
+    for entries in postings.values():
+        # Tombstoned postings count towards df until compaction; a small overestimate
+        idf = math.log(1 + (documents - len(entries) + 0.5) / (len(entries) + 0.5))
+        for docno, frequency, length in entries:
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            scores[docno] += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+    return sorted(((score, docno) for docno, score in scores.items()), key=lambda item: (-item[0], item[1]))
+
+
+def page(ranked: List[Tuple[float, int]], cursor: Optional[str], limit: int) -> Tuple[List[Tuple[float, int]], Optional[str]]:
+    """The `limit` ranked entries after offset `cursor`, and the cursor of the next page"""
+    offset = int(cursor or 0)
+    return ranked[offset:offset + limit], str(offset + limit) if len(ranked) > offset + limit else None
+
+
+async def search(client, query: str, cursor: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of documents ranked by BM25 for `query`, and the cursor of the next page"""
+    await flush(client)
+    terms = sorted(tokenize(query))
+    if not terms:
+        return [], None
+    reads = client.pipeline(transaction=False)
+    for term in terms:
+        reads.get(postings_key(term))
+    reads.hmget(STATS_KEY, ["documents", "length"])
+    *values, (documents, total_length) = await reads.execute()
+    ranked = rank({term: data for term, data in zip(terms, values) if data}, int(documents or 0), int(total_length or 0))
+
+    # Skip tombstones, checking a chunk of candidates at a time, until one entry past the page
+    offset = int(cursor or 0)
+    live: List[Tuple[float, int]] = []
+    position = 0
+    while position < len(ranked) and len(live) <= offset + limit:
+        chunk = ranked[position:position + 2 * limit]
+        dead = await client.smismember(TOMBSTONES_KEY, [docno for _, docno in chunk])
+        live += [entry for entry, is_dead in zip(chunk, dead) if not is_dead]
+        position += len(chunk)
+    page = live[offset:offset + limit]
+    ids = await client.hmget(IDS_KEY, [docno for _, docno in page]) if page else []
+    results = [{"id": doc_id.decode(), "score": round(score, 4)} for (score, _), doc_id in zip(page, ids) if doc_id]
+    next_cursor = str(offset + limit) if len(live) > offset + limit else None
+    return results, next_cursor
+
+
+async def compact(client) -> int:
+    """Rewrite the postings lists without tombstoned documents; returns how many were dropped"""
+    tombstones = {int(docno) for docno in await client.smembers(TOMBSTONES_KEY)}
+    if not tombstones:
+        return 0
+    async for key in client.scan_iter(match=postings_key("*"), count=500):
+        term = key.decode()[len(postings_key("")):]
+        while True:
+            async with client.pipeline(transaction=True) as pipe:
+                try:
+                    # Appends by an indexer touch the list (and the cursor); retry the term if so
+                    await pipe.watch(key, CURSOR_KEY)
+                    entries = [entry for entry in decode_postings(await pipe.get(key) or b"") if entry[0] not in tombstones]
+                    cursor = await pipe.get(CURSOR_KEY)
+                    pipe.multi()
+                    # Rewriting the cursor aborts an indexer that read this term's tail before the rewrite
+                    pipe.set(CURSOR_KEY, cursor)
+                    if entries:
+                        pipe.set(key, encode_postings(entries))
+                        pipe.hset(TAILS_KEY, term, entries[-1][0])
+                    else:
+                        pipe.delete(key)
+                        pipe.hdel(TAILS_KEY, term)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    continue
+    await client.srem(TOMBSTONES_KEY, *tombstones)
+    return len(tombstones)
+
+
+def main() -> None:
+    from app.memory.shared_memory import get_async_redis
+
+    parser = argparse.ArgumentParser(description="Maintain the full-text search index")
+    parser.add_argument("--compact", action="store_true", help="drop deleted and expired documents from the postings")
+    args = parser.parse_args()
+
+    async def run() -> None:
+        client = get_async_redis()
+        await flush(client)
+        if args.compact:
+            print(f"Dropped {await compact(client)} documents from the postings")
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,486 @@
 import redis
-import json
+import redis.asyncio as aioredis
+import asyncio
+import atexit
+import os
+import weakref
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Iterable, List, Sequence, Tuple
 
-r = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+from app.executor import run_io_bound
+from app.metrics import storage_operation
+from app.memory import indexes, near_duplicates, search_index
+from app.memory.backends import (
+    STORAGE_BACKEND, StorageBackend, MemoryBackend, SQLiteBackend, DocumentWrite, Records, Events, Merge, HistoryEntry,
+)
+from app.memory.storage_format import RawJSON, encode_record, decode_record, blob_refs, decompress_blobs, inflate
 
-def store_data(key: str, data: Dict[str, Any], source: Optional[str] = None) -> None:
-    # Add metadata
-    metadata = {
-        "timestamp": datetime.utcnow().isoformat(),
-        "source": source or "unknown",
-        "version": "1.0"
-    }
-    
-    # Combine data with metadata
-    stored_data = {
-        "data": data,
-        "metadata": metadata
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+# Upper bound on open connections per event loop; callers wait up to REDIS_POOL_TIMEOUT for a free one
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+
+# Per-agent fields that make up one document, in the order they are written
+DOCUMENT_SUFFIXES = ("metadata", "classification", "pdf", "email", "json", "embedded_json", "attachments")
+
+# Every document is one hash, expiring as a unit. DOCUMENT_TTL applies unless the document's
+# retention class (its classified intent) has its own entry, e.g. "Complaint=7776000,Regulation=0".
+# A TTL of 0 keeps documents forever.
+DOCUMENT_TTL = int(os.getenv("DOCUMENT_TTL", str(30 * 24 * 3600)))
+DOCUMENT_RETENTION_CLASSES = {
+    name.strip(): int(seconds)
+    for name, seconds in (
+        entry.split("=", 1) for entry in os.getenv("DOCUMENT_RETENTION_CLASSES", "Complaint=7776000").split(",") if entry.strip()
+    )
+}
+
+# Every agent result written to a document is also appended as an event to its history stream,
+# trimmed to about DOCUMENT_HISTORY_MAXLEN events. The stream expires with the document.
+DOCUMENT_HISTORY_MAXLEN = int(os.getenv("DOCUMENT_HISTORY_MAXLEN", "1000"))
+# Attempts of an optimistic (WATCH) update before giving up on a key that keeps changing
+UPDATE_MAX_RETRIES = int(os.getenv("UPDATE_MAX_RETRIES", "16"))
+
+_redis: Optional[redis.Redis] = None
+
+def get_redis() -> redis.Redis:
+    """The synchronous client, created on first use so the other backends never open one"""
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+    return _redis
+
+# redis.asyncio connections are bound to the loop that opened them, so keep one pool per loop
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aioredis.Redis]" = weakref.WeakKeyDictionary()
+
+def get_async_redis() -> aioredis.Redis:
+    """Return the pooled async client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        pool = aioredis.BlockingConnectionPool(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_POOL_TIMEOUT,
+        )
+        client = aioredis.Redis(connection_pool=pool)
+        _async_clients[loop] = client
+    return client
+
+def _encode_entries(
+    entries: Iterable[Tuple[str, Dict[str, Any], Optional[str]]],
+    timestamp: Optional[str] = None,
+    raw_json: Optional[RawJSON] = None,
+) -> Tuple[Dict[str, bytes], Dict[str, bytes]]:
+    """Encode records for several keys; blobs shared between them are only kept once"""
+    records: Dict[str, bytes] = {}
+    blobs: Dict[str, bytes] = {}
+    for key, data, source in entries:
+        records[key], record_blobs = encode_record(data, source, timestamp, raw_json)
+        blobs.update(record_blobs)
+    return records, blobs
+
+def document_key(doc_id: str) -> str:
+    return f"doc:{doc_id}"
+
+def history_key(doc_id: str) -> str:
+    return f"history:{doc_id}"
+
+def retention_ttl(retention_class: Optional[str] = None) -> int:
+    """Seconds a document of the given retention class is kept (0 = no expiry)"""
+    return DOCUMENT_RETENTION_CLASSES.get(retention_class, DOCUMENT_TTL) if retention_class else DOCUMENT_TTL
+
+def _queue_blob_writes(pipe, blobs: Dict[str, bytes], ttl: int = 0) -> None:
+    # Content-addressed: an existing blob already holds identical bytes
+    for key, blob in blobs.items():
+        if ttl:
+            pipe.set(key, blob, nx=True, ex=ttl)
+            # A blob shared with a longer-lived document keeps the longer TTL
+            pipe.expire(key, ttl, gt=True)
+        else:
+            pipe.set(key, blob, nx=True)
+            pipe.persist(key)
+
+def _queue_writes(pipe, records: Dict[str, bytes], blobs: Dict[str, bytes], events: Optional[Events] = None) -> None:
+    # Blobs first, so a reader never sees a record whose blob is not there yet
+    _queue_blob_writes(pipe, blobs)
+    for key, record in records.items():
+        pipe.set(key, record)
+    for key, event in (events or {}).items():
+        _queue_history_event(pipe, key, event)
+
+def _decode_values(keys: List[str], values: List[Optional[bytes]]) -> Tuple[Dict[str, Optional[Dict[str, Any]]], List[str]]:
+    decoded = {key: decode_record(value) if value else None for key, value in zip(keys, values)}
+    refs = set()
+    for record in decoded.values():
+        if record is not None:
+            blob_refs(record.get("data"), refs)
+    return decoded, sorted(refs)
+
+def _inflate_records(
+    decoded: Dict[str, Optional[Dict[str, Any]]],
+    refs: List[str],
+    blob_values: List[Optional[bytes]],
+) -> Dict[str, Optional[Dict[str, Any]]]:
+    blobs = decompress_blobs(dict(zip(refs, blob_values)))
+    return {
+        key: {**record, "data": inflate(record["data"], blobs)} if record is not None else None
+        for key, record in decoded.items()
     }
-    
-    r.set(key, json.dumps(stored_data))
+
+def _decode_history(entries) -> List[HistoryEntry]:
+    return [(entry_id.decode(), {name.decode(): value.decode() for name, value in fields.items()})
+            for entry_id, fields in entries]
+
+class RedisBackend(StorageBackend):
+    """Records as plain keys, documents as hashes and histories as capped streams, in the
+    configured Redis; the indexes, search and near-duplicate buckets are Redis structures too"""
+
+    name = "redis"
+
+    def write(self, records: Records, blobs: Records, events: Events) -> None:
+        pipe = get_redis().pipeline(transaction=False)
+        _queue_writes(pipe, records, blobs, events)
+        pipe.execute()
+
+    async def awrite(self, records: Records, blobs: Records, events: Events) -> None:
+        pipe = get_async_redis().pipeline(transaction=False)
+        _queue_writes(pipe, records, blobs, events)
+        if len(pipe):
+            await pipe.execute()
+
+    def read(self, keys: List[str]) -> List[Optional[bytes]]:
+        return get_redis().mget(keys)
+
+    async def aread(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await get_async_redis().mget(keys)
+
+    def update(self, key: str, merge: Merge) -> None:
+        """Optimistic: the write only lands if the key did not change since it was read"""
+        for _ in range(UPDATE_MAX_RETRIES):
+            with get_redis().pipeline(transaction=True) as pipe:
+                try:
+                    pipe.watch(key)
+                    records, blobs, events = merge(pipe.mget, pipe.get(key))
+                    pipe.multi()
+                    _queue_writes(pipe, records, blobs, events)
+                    pipe.execute()
+                    return
+                except redis.WatchError:
+                    # A concurrent writer got there first; merge into its version
+                    continue
+        raise redis.WatchError(f"{key} changed on every one of {UPDATE_MAX_RETRIES} update attempts")
+
+    def history(self, key: str) -> List[HistoryEntry]:
+        return _decode_history(get_redis().xrange(history_key(key)))
+
+    async def store_document(self, doc_id: str, write: DocumentWrite) -> None:
+        client = get_async_redis()
+        search_event = None
+        if write.search_terms is not None:
+            search_event = search_index.index_event(doc_id, write.search_terms, write.expires_at)
+
+        def queue(pipe, previous: Optional[Dict[str, str]]) -> None:
+            key = document_key(doc_id)
+            _queue_blob_writes(pipe, write.blobs, write.ttl)
+            pipe.hset(key, mapping=write.records)
+            for event in write.events:
+                _queue_history_event(pipe, doc_id, event)
+            for expiring in (key, history_key(doc_id)):
+                if write.ttl:
+                    pipe.expire(expiring, write.ttl)
+                else:
+                    pipe.persist(expiring)
+            if previous is None:
+                indexes.queue_expiry(pipe, doc_id, write.expires_at)
+            else:
+                indexes.queue_index(pipe, doc_id, previous, write.index_values, write.indexed_at, write.expires_at)
+            if search_event is not None:
+                search_index.queue_index(pipe, search_event)
+            if write.signature is not None:
+                near_duplicates.queue_insert(pipe, doc_id, write.signature, indexes.epoch(write.indexed_at), write.ttl)
+
+        if write.index_values is None:
+            pipe = client.pipeline(transaction=True)
+            queue(pipe, None)
+            await pipe.execute()
+        else:
+            await _store_classified(client, doc_id, queue)
+        if search_event is not None:
+            with storage_operation("search_index"):
+                await search_index.flush(client)
+
+    async def read_document(self, doc_id: str, fields: Optional[List[str]] = None) -> Records:
+        client = get_async_redis()
+        if fields is None:
+            return {field.decode(): value for field, value in (await client.hgetall(document_key(doc_id))).items()}
+        values = await client.hmget(document_key(doc_id), fields)
+        return {field: value for field, value in zip(fields, values) if value is not None}
+
+    async def document_history(
+        self, doc_id: str, cursor: Optional[str], count: int, reverse: bool = False,
+    ) -> List[HistoryEntry]:
+        client = get_async_redis()
+        try:
+            if reverse:
+                entries = await client.xrevrange(history_key(doc_id), max=f"({cursor}" if cursor else "+", count=count)
+            else:
+                entries = await client.xrange(history_key(doc_id), min=f"({cursor}" if cursor else "-", count=count)
+        except redis.ResponseError as exc:
+            # Redis rejects a malformed stream id
+            raise ValueError(f"invalid history cursor {cursor!r}") from exc
+        return _decode_history(entries)
+
+    async def delete_document(self, doc_id: str, event: Dict[str, str], history_ttl: int) -> bool:
+        client = get_async_redis()
+        if not await client.delete(document_key(doc_id)):
+            return False
+        previous = indexes.decode_values(await client.hgetall(indexes.doc_index_key(doc_id)))
+        pipe = client.pipeline(transaction=True)
+        indexes.queue_unindex(pipe, doc_id, previous)
+        if search_index.SEARCH_INDEX_ENABLED:
+            search_index.queue_delete(pipe, doc_id)
+        _queue_history_event(pipe, doc_id, event)
+        if history_ttl:
+            pipe.expire(history_key(doc_id), history_ttl)
+        else:
+            pipe.persist(history_key(doc_id))
+        await pipe.execute()
+        return True
+
+    async def query_documents(
+        self,
+        filters: Dict[str, str],
+        since: Optional[datetime],
+        until: Optional[datetime],
+        cursor: Optional[str],
+        limit: int,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        return await indexes.query(get_async_redis(), filters, since, until, cursor, limit)
+
+    async def near_duplicate_candidates(self, doc_id: str, signature: Sequence[int]) -> Dict[str, Optional[bytes]]:
+        return await near_duplicates.candidates(get_async_redis(), doc_id, signature, document_key)
+
+    async def search(self, query: str, cursor: Optional[str], limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        return await search_index.search(get_async_redis(), query, cursor, limit)
+
+_storage_backend: Optional[StorageBackend] = None
+
+def get_storage_backend() -> StorageBackend:
+    """The backend selected by STORAGE_BACKEND, created on first use"""
+    global _storage_backend
+    if _storage_backend is None:
+        if STORAGE_BACKEND == "memory":
+            _storage_backend = MemoryBackend(history_maxlen=DOCUMENT_HISTORY_MAXLEN)
+        elif STORAGE_BACKEND == "sqlite":
+            _storage_backend = SQLiteBackend(history_maxlen=DOCUMENT_HISTORY_MAXLEN)
+            atexit.register(_storage_backend.close)
+        else:
+            _storage_backend = RedisBackend()
+    return _storage_backend
+
+def set_storage_backend(backend: Optional[StorageBackend]) -> Optional[StorageBackend]:
+    """Install a backend (None goes back to STORAGE_BACKEND); returns the previous one"""
+    global _storage_backend
+    previous, _storage_backend = _storage_backend, backend
+    return previous
+
+def _stored_event(event: str, source: Optional[str], timestamp: str) -> Dict[str, str]:
+    return {"event": event, "source": source or "unknown", "timestamp": timestamp}
+
+def store_data(key: str, data: Dict[str, Any], source: Optional[str] = None) -> None:
+    with storage_operation("store_data"):
+        timestamp = datetime.utcnow().isoformat()
+        records, blobs = _encode_entries([(key, data, source)], timestamp)
+        get_storage_backend().write(records, blobs, {key: _stored_event("stored", source, timestamp)})
 
 def get_data(key: str) -> Optional[Dict[str, Any]]:
-    value = r.get(key)
-    return json.loads(value) if value else None
+    with storage_operation("get_data"):
+        backend = get_storage_backend()
+        value = backend.read([key])[0]
+        if not value:
+            return None
+        decoded, refs = _decode_values([key], [value])
+        if refs:
+            decoded = _inflate_records(decoded, refs, backend.read(refs))
+        return decoded[key]
 
 def update_data(key: str, update_fields: Dict[str, Any], source: Optional[str] = None) -> None:
-    existing = get_data(key)
-    if existing and "data" in existing:
-        # Update only the data portion
-        existing["data"].update(update_fields)
-        # Update metadata
-        existing["metadata"]["timestamp"] = datetime.utcnow().isoformat()
-        existing["metadata"]["source"] = source or existing["metadata"].get("source", "unknown")
-        store_data(key, existing["data"], source)
-    else:
-        # If no existing data, create new entry
-        store_data(key, update_fields, source)
-
-def get_processing_history(key: str) -> list:
-    """Get the processing history of a document by its key"""
-    data = get_data(key)
-    if data and "metadata" in data:
-        return [data["metadata"]]
-    return []
+    """Merge fields into a record atomically"""
+    def merge(read, value: Optional[bytes]) -> Tuple[Records, Records, Events]:
+        data: Dict[str, Any] = {}
+        record_source = source
+        if value:
+            decoded, refs = _decode_values([key], [value])
+            if refs:
+                decoded = _inflate_records(decoded, refs, read(refs))
+            data = decoded[key].get("data") or {}
+            record_source = source or decoded[key]["metadata"].get("source")
+        data.update(update_fields)
+        timestamp = datetime.utcnow().isoformat()
+        records, blobs = _encode_entries([(key, data, record_source)], timestamp)
+        return records, blobs, {key: _stored_event("updated", record_source, timestamp)}
+
+    with storage_operation("update_data"):
+        get_storage_backend().update(key, merge)
+
+def get_processing_history(doc_id: str) -> list:
+    """Get every recorded processing event of a document (or record key), oldest first"""
+    return [{"cursor": cursor, **event} for cursor, event in get_storage_backend().history(doc_id)]
+
+async def store_many(entries: Iterable[Tuple[str, Dict[str, Any], Optional[str]]]) -> None:
+    """Write several (key, data, source) entries and their blobs in a single pipelined round trip"""
+    entries = list(entries)
+    with storage_operation("store_many"):
+        timestamp = datetime.utcnow().isoformat()
+        # Compression and serialization of large bodies run off the event loop
+        records, blobs = await run_io_bound(_encode_entries, entries, timestamp)
+        events = {key: _stored_event("stored", source, timestamp) for key, _, source in entries}
+        await get_storage_backend().awrite(records, blobs, events)
+
+async def get_many(keys: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Fetch several keys with one MGET, plus one more for any blobs they reference"""
+    if not keys:
+        return {}
+    with storage_operation("get_many"):
+        backend = get_storage_backend()
+        decoded, refs = _decode_values(keys, await backend.aread(keys))
+        if not refs:
+            return decoded
+        blob_values = await backend.aread(refs)
+        return await run_io_bound(_inflate_records, decoded, refs, blob_values)
+
+async def store_document(
+    doc_id: str,
+    entries: Iterable[Tuple[str, Dict[str, Any], Optional[str]]],
+    retention_class: Optional[str] = None,
+    search_text: Optional[str] = None,
+    raw_json: Optional[RawJSON] = None,
+) -> None:
+    """Write (field, data, source) agent results into the document and (re)set its TTL, atomically.
+
+    Each result is also appended to the document's history in the same write, a classification
+    moves the document in the secondary indexes and `search_text` goes to the full-text index.
+    Payloads in `raw_json` are stored as the text they were parsed from.
+    """
+    entries = list(entries)
+    now = datetime.utcnow()
+    timestamp = now.isoformat()
+    ttl = retention_ttl(retention_class)
+    search_terms = None
+    with storage_operation("encode"):
+        records, blobs = await run_io_bound(_encode_entries, entries, timestamp, raw_json)
+        if search_text and search_index.SEARCH_INDEX_ENABLED:
+            search_terms = await run_io_bound(search_index.tokenize, search_text)
+    if not records:
+        return
+    classification = next((data for field, data, _ in entries if field == "classification"), None)
+    write = DocumentWrite(
+        records=records,
+        blobs=blobs,
+        events=[{"event": "stored", "field": field, "source": source or "unknown", "timestamp": timestamp}
+                for field, _, source in entries],
+        ttl=ttl,
+        indexed_at=now,
+        expires_at=indexes.epoch(now) + ttl if ttl else None,
+        index_values=indexes.index_values(classification) if classification is not None else None,
+        search_terms=search_terms,
+        signature=next((data["values"] for field, data, _ in entries if field == "minhash"), None),
+    )
+    with storage_operation("store_document"):
+        await get_storage_backend().store_document(doc_id, write)
+
+async def _store_classified(client, doc_id: str, queue) -> None:
+    for _ in range(UPDATE_MAX_RETRIES):
+        async with client.pipeline(transaction=True) as pipe:
+            try:
+                # The sets the document leaves depend on what it was indexed under until now
+                await pipe.watch(indexes.doc_index_key(doc_id))
+                previous = indexes.decode_values(await pipe.hgetall(indexes.doc_index_key(doc_id)))
+                pipe.multi()
+                queue(pipe, previous)
+                await pipe.execute()
+                return
+            except redis.WatchError:
+                continue
+    raise redis.WatchError(f"{doc_id} was reclassified on every one of {UPDATE_MAX_RETRIES} attempts")
+
+def _queue_history_event(pipe, doc_id: str, event: Dict[str, str]) -> None:
+    # Approximate trimming keeps XADD O(1): Redis drops whole macro nodes once they are past the cap
+    pipe.xadd(history_key(doc_id), event, maxlen=DOCUMENT_HISTORY_MAXLEN, approximate=True)
+
+async def get_document_history(
+    doc_id: str,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+    reverse: bool = False,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of a document's history after `cursor` (exclusive); returns the events and the next cursor.
+
+    A cursor the backend cannot parse raises ValueError.
+    """
+    with storage_operation("get_history"):
+        entries = await get_storage_backend().document_history(doc_id, cursor, limit + 1, reverse)
+    events = [{"cursor": entry_id, **event} for entry_id, event in entries[:limit]]
+    # One extra entry was read to tell whether another page exists
+    next_cursor = events[-1]["cursor"] if len(entries) > limit else None
+    return events, next_cursor
+
+async def _inflate_document(backend: StorageBackend, fields: Records) -> Dict[str, Optional[Dict[str, Any]]]:
+    decoded, refs = _decode_values(list(fields), list(fields.values()))
+    if refs:
+        decoded = await run_io_bound(_inflate_records, decoded, refs, await backend.aread(refs))
+    return decoded
+
+async def get_document_data(doc_id: str) -> Dict[str, Optional[Dict[str, Any]]]:
+    """Fetch every per-agent record of a document, keyed by field, in one read (plus one for blobs)"""
+    backend = get_storage_backend()
+    with storage_operation("get_document"):
+        decoded = await _inflate_document(backend, await backend.read_document(doc_id))
+    return {suffix: decoded.get(suffix) for suffix in DOCUMENT_SUFFIXES}
+
+async def delete_document(doc_id: str) -> bool:
+    """Delete a document and take it out of the indexes; shared blobs are left to expire with their longest-lived owner.
+
+    The history outlives the document, with a "deleted" event, until DOCUMENT_TTL passes.
+    """
+    with storage_operation("delete_document"):
+        event = {"event": "deleted", "timestamp": datetime.utcnow().isoformat()}
+        return await get_storage_backend().delete_document(doc_id, event, DOCUMENT_TTL)
+
+async def query_documents(
+    filters: Dict[str, str],
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = 50,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of documents whose classification matches every filter, newest first"""
+    with storage_operation("query_documents"):
+        return await get_storage_backend().query_documents(filters, since, until, cursor, limit)
+
+async def find_near_duplicate(doc_id: str, signature: List[int]) -> Optional[Dict[str, Any]]:
+    """The stored document most similar to a MinHash signature, if any is similar enough"""
+    with storage_operation("near_duplicate_lookup"):
+        candidates = await get_storage_backend().near_duplicate_candidates(doc_id, signature)
+        return near_duplicates.best_match(signature, candidates)
+
+async def get_document_field(doc_id: str, field: str) -> Optional[Dict[str, Any]]:
+    """One per-agent record of a document, e.g. its classification"""
+    backend = get_storage_backend()
+    with storage_operation("get_document"):
+        decoded = await _inflate_document(backend, await backend.read_document(doc_id, [field]))
+    return decoded.get(field)
+
+async def search_documents(query: str, cursor: Optional[str] = None, limit: int = 20) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of full-text search results, best match first"""
+    with storage_operation("search"):
+        return await get_storage_backend().search(query, cursor, limit)
+
+def processing_history_from(records: Dict[str, Optional[Dict[str, Any]]]) -> list:
+    """Build the processing history from already-fetched records, oldest first"""
+    history = [record["metadata"] for record in records.values() if record and "metadata" in record]
+    return sorted(history, key=lambda entry: entry.get("timestamp", ""))
@@ -0,0 +1,163 @@
+import hashlib
+import os
+import zlib
+from datetime import datetime
+from typing import Dict, Any, NamedTuple, Optional, Tuple, Set
+
+from app import codec
+
+# Format 3: compact records whose large text bodies live in shared, content-addressed,
+# zlib-compressed blobs, referenced as {"$blob": digest}. Keys of the stored data that start with
+# "$" get another "$", so data can never pass for a reference. Format 2 (the same, unescaped) and
+# format 1 records ({"data": ..., "metadata": {...}}) are still read.
+STORAGE_FORMAT_VERSION = 3
+BLOB_PREFIX = "blob:"
+# Strings (and copies of the input payload) at least this long are moved into blobs
+STORAGE_BLOB_MIN_BYTES = int(os.getenv("STORAGE_BLOB_MIN_BYTES", "1024"))
+STORAGE_COMPRESSION_LEVEL = int(os.getenv("STORAGE_COMPRESSION_LEVEL", "6"))
+# Fields holding a verbatim copy of a parsed JSON payload; identical payloads share one blob
+DEDUP_JSON_FIELDS = ("processed_data", "embedded_json")
+
+# The JSON text parsed values were decoded from, by id() of the value. The value is held too, so
+# its id cannot be reused meanwhile. Such a value is stored as its text, not serialized again.
+RawJSON = Dict[int, Tuple[Any, str]]
+
+
+def remember_raw_json(raw_json: Optional[RawJSON], value: Any, text: str) -> None:
+    if raw_json is not None and isinstance(value, (dict, list)):
+        raw_json[id(value)] = (value, text)
+
+
+class BlobRef(NamedTuple):
+    """A blob reference in decoded data; parsed JSON never contains tuples, so no data looks like one"""
+
+    digest: str
+    json: bool = False
+
+
+def blob_key(digest: str) -> str:
+    return f"{BLOB_PREFIX}{digest}"
+
+
+def _store_blob(payload: bytes, blobs: Dict[str, bytes]) -> str:
+    digest = hashlib.sha256(payload).hexdigest()
+    if blob_key(digest) not in blobs:
+        blobs[blob_key(digest)] = zlib.compress(payload, STORAGE_COMPRESSION_LEVEL)
+    return digest
+
+
+def _extract_blobs(
+    value: Any, blobs: Dict[str, bytes], field: Optional[str] = None, raw_json: Optional[RawJSON] = None,
+) -> Any:
+    if field in DEDUP_JSON_FIELDS and isinstance(value, (dict, list)):
+        raw = raw_json.get(id(value)) if raw_json else None
+        payload = raw[1].encode() if raw is not None else codec.dumps(value)
+        if len(payload) >= STORAGE_BLOB_MIN_BYTES:
+            return {"$blob": _store_blob(payload, blobs), "$json": 1}
+    if isinstance(value, str) and len(value) >= STORAGE_BLOB_MIN_BYTES:
+        return {"$blob": _store_blob(value.encode(), blobs)}
+    if isinstance(value, BlobRef):
+        # Re-encoding decoded data whose blob is already stored
+        return {"$blob": value.digest, "$json": 1} if value.json else {"$blob": value.digest}
+    if isinstance(value, dict):
+        return {
+            "$" + key if isinstance(key, str) and key.startswith("$") else key: _extract_blobs(item, blobs, key, raw_json)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_extract_blobs(item, blobs, raw_json=raw_json) for item in value]
+    return value
+
+
+def encode_record(
+    data: Dict[str, Any],
+    source: Optional[str] = None,
+    timestamp: Optional[str] = None,
+    raw_json: Optional[RawJSON] = None,
+) -> Tuple[bytes, Dict[str, bytes]]:
+    """Serialize one agent result; returns the record and the compressed blobs it references"""
+    blobs: Dict[str, bytes] = {}
+    record = {
+        "v": STORAGE_FORMAT_VERSION,
+        "d": _extract_blobs(data, blobs, raw_json=raw_json),
+        "m": [timestamp or datetime.utcnow().isoformat(), source or "unknown"],
+    }
+    return codec.dumps(record), blobs
+
+
+def _decode_refs(value: Any) -> Any:
+    """Turn the references of format 3 data into BlobRefs and unescape its "$" keys"""
+    if isinstance(value, dict):
+        if "$blob" in value:
+            return BlobRef(value["$blob"], bool(value.get("$json")))
+        return {key[1:] if key.startswith("$") else key: _decode_refs(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode_refs(item) for item in value]
+    return value
+
+
+def _decode_legacy_refs(value: Any) -> Any:
+    # Format 2 did not escape keys: any small dict with a "$blob" key was taken for a reference
+    if isinstance(value, dict):
+        if "$blob" in value and len(value) <= 2:
+            return BlobRef(value["$blob"], bool(value.get("$json")))
+        return {key: _decode_legacy_refs(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode_legacy_refs(item) for item in value]
+    return value
+
+
+def decode_record(raw: bytes) -> Dict[str, Any]:
+    """Parse a stored record of any format into the {"data", "metadata"} envelope.
+
+    Blob references are left in place as BlobRefs; resolve them with blob_refs() and inflate().
+    """
+    record = codec.loads(raw)
+    version = record.get("v")
+    if version not in (2, STORAGE_FORMAT_VERSION):
+        return record
+    data = record["d"]
+    # Only data with a "$" key (a reference or an escaped key) needs walking
+    if b'"$' in raw:
+        data = _decode_refs(data) if version == STORAGE_FORMAT_VERSION else _decode_legacy_refs(data)
+    timestamp, source = record["m"]
+    return {
+        "data": data,
+        "metadata": {"timestamp": timestamp, "source": source, "version": str(version)},
+    }
+
+
+def blob_refs(value: Any, refs: Optional[Set[str]] = None) -> Set[str]:
+    """Collect the blob keys referenced anywhere in a decoded value"""
+    refs = set() if refs is None else refs
+    if isinstance(value, BlobRef):
+        refs.add(blob_key(value.digest))
+    elif isinstance(value, dict):
+        for item in value.values():
+            blob_refs(item, refs)
+    elif isinstance(value, list):
+        for item in value:
+            blob_refs(item, refs)
+    return refs
+
+
+def decompress_blobs(blobs: Dict[str, Optional[bytes]]) -> Dict[str, Optional[bytes]]:
+    return {key: zlib.decompress(payload) if payload is not None else None for key, payload in blobs.items()}
+
+
+def inflate(value: Any, blobs: Dict[str, Optional[bytes]]) -> Any:
+    """Replace blob references with their (decompressed) contents; missing blobs become None"""
+    if isinstance(value, BlobRef):
+        payload = blobs.get(blob_key(value.digest))
+        if payload is None:
+            return None
+        return codec.loads(payload) if value.json else payload.decode()
+    if isinstance(value, dict):
+        return {key: inflate(item, blobs) for key, item in value.items()}
+    if isinstance(value, list):
+        return [inflate(item, blobs) for item in value]
+    return value
+
+
+def is_current_format(raw: bytes) -> bool:
+    return raw.startswith(b'{"v":%d,' % STORAGE_FORMAT_VERSION)
@@ -0,0 +1,158 @@
+import bisect
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency histograms kept in-process and rendered in the Prometheus text format on /metrics.
+# An observation is a bisect and three additions under a lock, cheap enough to leave on.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+# Adds a Server-Timing header with the per-stage durations of each response
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "1") != "0"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (the last one is +Inf)..., sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self, labels: Tuple[str, ...]) -> Optional[Dict[str, float]]:
+        """Count and sum observed for one label set"""
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                return None
+            return {"count": sum(series[:-1]), "sum": series[-1]}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels))
+            prefix = label_text + "," if label_text else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}_sum{suffix} {values[-1]}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+    def clear(self) -> None:
+        with self._lock:
+            self._series.clear()
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+STAGE_SECONDS = Histogram(
+    "document_stage_seconds", "Time spent in each document processing stage", ("content_type", "stage")
+)
+STORAGE_SECONDS = Histogram(
+    "storage_operation_seconds", "Time spent in document storage calls", ("operation",)
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "admission_wait_seconds", "Time spent queued for an in-flight slot", ("content_type", "priority")
+)
+REGISTRY = [STAGE_SECONDS, STORAGE_SECONDS, ADMISSION_WAIT_SECONDS]
+
+# Durations collected for the Server-Timing header of the request being served, by metric name
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+
+def record(histogram: Histogram, labels: Tuple[str, ...], timing_name: str, seconds: float) -> None:
+    if METRICS_ENABLED:
+        histogram.observe(labels, seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[timing_name] = timings.get(timing_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str, content_type: str) -> Iterator[None]:
+    """Time a pipeline stage, including any time spent waiting for a pool worker"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(STAGE_SECONDS, (content_type, name), name, time.perf_counter() - start)
+
+
+@contextmanager
+def storage_operation(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(STORAGE_SECONDS, (name,), f"storage_{name}", time.perf_counter() - start)
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in REGISTRY:
+        lines.extend(histogram.render())
+    return "\n".join(lines) + "\n"
+
+
+def server_timing_header(timings: Dict[str, float], total: Optional[float] = None) -> str:
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware that reports the stages timed while serving a request in a Server-Timing header.
+
+    Stages finished before the response starts are included, so streaming responses only
+    report the work done before their first chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not SERVER_TIMING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings:
+                header = server_timing_header(timings, time.perf_counter() - start)
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
@@ -0,0 +1,29 @@
+import os
+
+import pytest
+
+# The suite runs on STORAGE_BACKEND; left unset, on Redis if one answers and in memory otherwise.
+# This has to happen before anything imports app.memory.backends.
+if "STORAGE_BACKEND" not in os.environ:
+    import redis
+
+    try:
+        redis.Redis(
+            host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")), socket_connect_timeout=0.5,
+        ).ping()
+    except redis.RedisError:
+        os.environ["STORAGE_BACKEND"] = "memory"
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "redis: checks Redis internals, so only runs with STORAGE_BACKEND=redis")
+
+
+def pytest_collection_modifyitems(config, items):
+    backend = os.getenv("STORAGE_BACKEND", "redis")
+    if backend == "redis":
+        return
+    skip = pytest.mark.skip(reason=f"needs Redis, STORAGE_BACKEND={backend}")
+    for item in items:
+        if "redis" in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,83 @@
+import asyncio
+
+import httpx
+import pytest
+
+import app.admission as admission
+from app.admission import NORMAL, URGENT, Overloaded, admit, priority
+from app.main import app
+
+
+def test_preclassification_flags_severe_complaints():
+    assert priority("text", "Urgent complaint: the shipment arrived damaged, this is a serious problem") == URGENT
+    assert priority("text", "Please send a quote for 10 units") == NORMAL
+    # Base64 PDFs are not readable before extraction
+    assert priority("pdf_base64", "c2V2ZXJlIGNvbXBsYWludA==") == NORMAL
+
+
+def test_urgent_documents_are_admitted_first(monkeypatch):
+    monkeypatch.setattr(admission, "_limits", {"text": 1})
+    order = []
+
+    async def document(name, level):
+        async with admit("text", level):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    async def run():
+        async with admit("text"):
+            waiters = [asyncio.create_task(document(f"normal-{n}", NORMAL)) for n in range(3)]
+            waiters.append(asyncio.create_task(document("urgent", URGENT)))
+            await asyncio.sleep(0)
+            stats = admission.admission_stats()["lanes"]["text"]
+        await asyncio.gather(*waiters)
+        return stats
+
+    stats = asyncio.run(run())
+    assert order == ["urgent", "normal-0", "normal-1", "normal-2"]
+    assert stats["in_flight"] == 1
+    assert stats["queued"] == 4
+    assert stats["queued_urgent"] == 1
+
+
+def test_cancelled_waiters_give_up_their_place(monkeypatch):
+    monkeypatch.setattr(admission, "_limits", {"text": 1})
+
+    async def run():
+        async with admit("text"):
+            waiter = asyncio.create_task(admit("text").__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+        # The slot was not handed to the cancelled waiter
+        async with admit("text"):
+            return admission.admission_stats()["lanes"]["text"]
+
+    stats = asyncio.run(run())
+    assert stats["in_flight"] == 1
+    assert stats["queued"] == 0
+
+
+def test_overloaded_lane_sheds_with_retry_after(monkeypatch):
+    monkeypatch.setattr(admission, "_limits", {"text": 1})
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async with admit("text"):
+                # One document in flight that takes 10s on average: a new arrival would wait past the budget
+                admission._controller().lane("text").service_seconds = 10.0
+                with pytest.raises(Overloaded):
+                    async with admit("text"):
+                        pass
+                response = await client.post("/process/", json={
+                    "id": "test_admission_shed", "content": "Please send a quote", "content_type": "text",
+                })
+                stats = (await client.get("/admission/stats")).json()
+        return response, stats
+
+    response, stats = asyncio.run(run())
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "10"
+    assert stats["lanes"]["text"]["rejected"] == 2
+    assert stats["lanes"]["text"]["in_flight"] == 1
@@ -130,3 +130,62 @@ def test_document_history():
     assert "processing_history" in history_data
     assert history_data["classification"]["intent"] == "Complaint"
     assert history_data["classification"]["urgency"] == "high"
+
+def test_document_history_lists_every_agent():
+    doc_id = "test_history_2"
+    response = client.post(
+        "/process/",
+        json={
+            "id": doc_id,
+            "content": "From: a@example.com\nSubject: Invoice\n\nPlease pay the invoice.",
+            "content_type": "email",
+            "metadata": {"source": "test"}
+        }
+    )
+    assert response.status_code == 200
+
+    history = client.get(f"/document/{doc_id}").json()["processing_history"]
+    sources = {entry["source"] for entry in history}
+    assert {"client_metadata", "classifier_agent", "email_agent"} <= sources
+
+def test_identical_documents_reuse_cached_analysis():
+    payload = {
+        "content": "From: a@example.com\nSubject: Complaint\n\nThis is a complaint about a cached order.",
+        "content_type": "email",
+    }
+    first = client.post("/process/", json={"id": "test_cache_1", **payload})
+    assert first.status_code == 200
+    hits_before = client.get("/cache/stats").json()["local_hits"]
+
+    second = client.post("/process/", json={"id": "test_cache_2", **payload})
+    assert second.status_code == 200
+    assert second.json()["cached"] is True
+    assert second.json()["classification"] == first.json()["classification"]
+    assert client.get("/cache/stats").json()["local_hits"] == hits_before + 1
+
+    # The reused analysis is linked to the new document id
+    document = client.get("/document/test_cache_2").json()
+    assert document["classification"]["intent"] == "Complaint"
+    assert document["email_analysis"]["analysis"]["intent"] == "Complaint"
+
+def test_process_batch_streams_ndjson():
+    lines = [
+        json.dumps({"id": "test_batch_1", "content": "Invoice: amount due $20", "content_type": "text"}),
+        "{not json",
+        json.dumps({"id": "test_batch_2", "content": "abc", "content_type": "pdf_base64"}),
+        "",
+        json.dumps({"id": "test_batch_3", "content_type": "json", "content": "", "json": {"rfq_number": "R-1"}}),
+    ]
+    response = client.post(
+        "/process/batch?concurrency=2",
+        content="\n".join(lines).encode(),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    results = {item["line"]: item for item in map(json.loads, response.text.splitlines())}
+
+    assert sorted(results) == [1, 2, 3, 5]
+    assert results[1]["status"] == "processed"
+    assert results[2]["status_code"] == 422
+    assert results[3]["status"] == "error" and results[3]["id"] == "test_batch_2"
+    assert results[5]["json_analysis"]["document_type"] == "rfq"
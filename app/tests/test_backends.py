@@ -0,0 +1,278 @@
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional
+
+import pytest
+
+from app import codec
+from app.memory import backends
+from app.memory.backends import DocumentWrite, MemoryBackend, SQLiteBackend
+from app.memory.near_duplicates import minhash
+from app.memory.shared_memory import (
+    RedisBackend, delete_document, find_near_duplicate, get_data, get_document_data, get_document_field,
+    get_document_history, get_many, get_processing_history, query_documents, retention_ttl, search_documents,
+    set_storage_backend, store_data, store_document, store_many, update_data,
+)
+
+LONG_TEXT = "Invoice for 40 units of WIDGET-A. " * 100
+
+
+@pytest.fixture(params=[pytest.param("redis", marks=pytest.mark.redis), "memory", "sqlite"])
+def backend(request, tmp_path):
+    backend = {
+        "redis": RedisBackend,
+        "memory": MemoryBackend,
+        "sqlite": lambda: SQLiteBackend(str(tmp_path / "records.db")),
+    }[request.param]()
+    previous = set_storage_backend(backend)
+    yield backend
+    set_storage_backend(previous)
+    backend.close()
+
+
+def test_record_api_round_trip(backend):
+    key = f"test_backend_{backend.name}_pdf"
+    store_data(key, {"content": LONG_TEXT, "pages": 3}, "pdf_agent")
+    update_data(key, {"pages": 4})
+    record = get_data(key)
+    assert record["data"] == {"content": LONG_TEXT, "pages": 4}
+    assert record["metadata"]["source"] == "pdf_agent"
+    assert get_data(f"test_backend_{backend.name}_missing") is None
+
+    history = get_processing_history(key)
+    assert [event["event"] for event in history][-2:] == ["stored", "updated"]
+    assert history[-1]["source"] == "pdf_agent"
+
+
+def test_batched_writes_and_reads(backend):
+    keys = [f"test_backend_{backend.name}_many_{n}" for n in range(3)]
+
+    async def run():
+        await store_many((key, {"text": LONG_TEXT, "n": n}, "email_agent") for n, key in enumerate(keys))
+        return await get_many(keys + [f"test_backend_{backend.name}_absent"])
+
+    records = asyncio.run(run())
+    assert [records[key]["data"]["n"] for key in keys] == [0, 1, 2]
+    assert records[keys[0]]["data"]["text"] == LONG_TEXT
+    assert records[f"test_backend_{backend.name}_absent"] is None
+
+
+def test_concurrent_updates_are_merged(backend):
+    key = f"test_backend_{backend.name}_concurrent"
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda n: update_data(key, {f"field_{n}": n}, "test"), range(40)))
+    assert get_data(key)["data"] == {f"field_{n}": n for n in range(40)}
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_bytes=700, history_maxlen=2)
+    previous = set_storage_backend(backend)
+    try:
+        for n in range(6):
+            store_data(f"lru_{n}", {"n": n})
+            get_data("lru_0")  # kept warm
+        assert backend.bytes <= 700 and backend.evictions > 0
+        assert get_data("lru_0")["data"] == {"n": 0}
+        assert get_data("lru_1") is None
+        for _ in range(3):
+            update_data("lru_0", {"n": 0})
+        assert len(get_processing_history("lru_0")) == 2
+    finally:
+        set_storage_backend(previous)
+
+
+def test_sqlite_backend_commits_in_batches_and_persists(tmp_path):
+    path = str(tmp_path / "records.db")
+    backend = SQLiteBackend(path, batch_size=3, commit_ms=60_000)
+    previous = set_storage_backend(backend)
+    try:
+        store_data("persisted_1", {"text": LONG_TEXT})
+        # Another connection only sees the write once its batch is committed
+        other = sqlite3.connect(path)
+        assert other.execute("SELECT COUNT(*) FROM records WHERE key = 'persisted_1'").fetchone() == (0,)
+        store_data("persisted_2", {"n": 2})
+        store_data("persisted_3", {"n": 3})
+        assert other.execute("SELECT COUNT(*) FROM records WHERE key LIKE 'persisted_%'").fetchone() == (3,)
+        assert other.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+        other.close()
+    finally:
+        set_storage_backend(previous)
+        backend.close()
+
+    reopened = SQLiteBackend(path)
+    previous = set_storage_backend(reopened)
+    try:
+        assert get_data("persisted_1")["data"] == {"text": LONG_TEXT}
+        assert [event["event"] for event in get_processing_history("persisted_2")] == ["stored"]
+    finally:
+        set_storage_backend(previous)
+        reopened.close()
+
+
+def _document(doc_id: str, text: str, intent: Optional[str] = None, retention_class: Optional[str] = None):
+    entries = [("email", {"content": {"text": text}}, "email_agent"), ("minhash", {"values": minhash(text)}, "near_duplicates")]
+    if intent is not None:
+        entries.append(("classification", {"intent": intent, "urgency": "high"}, "classifier_agent"))
+    return store_document(doc_id, entries, retention_class, search_text=text)
+
+
+def test_documents_history_and_delete(backend):
+    doc_id = f"test_backend_{backend.name}_document"
+
+    async def run():
+        await _document(doc_id, LONG_TEXT, "Invoice")
+        await _document(doc_id, LONG_TEXT + " reviewed", "Invoice")
+        records = await get_document_data(doc_id)
+        field = await get_document_field(doc_id, "classification")
+        first, cursor = await get_document_history(doc_id, limit=4)
+        rest, end = await get_document_history(doc_id, cursor=cursor, limit=4)
+        latest, _ = await get_document_history(doc_id, limit=1, reverse=True)
+        deleted = await delete_document(doc_id), await delete_document(doc_id)
+        after = await get_document_data(doc_id), (await get_document_history(doc_id, limit=1, reverse=True))[0][0]
+        return records, field, first + rest, end, latest, deleted, after
+
+    records, field, history, end, latest, deleted, (after, last) = asyncio.run(run())
+    assert records["email"]["data"] == {"content": {"text": LONG_TEXT + " reviewed"}}
+    assert field["data"] == {"intent": "Invoice", "urgency": "high"}
+    assert [event["field"] for event in history] == ["email", "minhash", "classification"] * 2
+    assert end is None and latest[0] == history[-1]
+    assert deleted == (True, False)
+    assert all(record is None for record in after.values())
+    assert last["event"] == "deleted"
+
+
+def test_documents_are_indexed_searched_and_deduplicated(backend):
+    prefix = f"test_backend_{backend.name}_indexed"
+    start = datetime.utcnow()
+    text = "Order 77 of cogwheel-k7 is late; please expedite the cogwheel-k7 shipment to the plant."
+
+    async def run():
+        for n in range(3):
+            await _document(f"{prefix}_{n}", f"{text} Ticket {n}.", "Complaint")
+        await _document(f"{prefix}_invoice", "Please pay invoice 9 for flange-t3.", "Invoice")
+        pages, cursor = [], None
+        while True:
+            page, cursor = await query_documents({"intent": "complaint"}, since=start, cursor=cursor, limit=2)
+            pages.append(page)
+            if cursor is None:
+                break
+        results, search_cursor = await search_documents("cogwheel-k7", limit=2)
+        duplicate = await find_near_duplicate(f"{prefix}_new", minhash(f"{text} Ticket 0."))
+        await delete_document(f"{prefix}_0")
+        return pages, results, search_cursor, duplicate, await search_documents("cogwheel-k7"), await find_near_duplicate(
+            f"{prefix}_new", minhash(f"{text} Ticket 0.")
+        )
+
+    pages, results, search_cursor, duplicate, (after_delete, _), remaining = asyncio.run(run())
+    assert [[document["id"] for document in page] for page in pages] == [[f"{prefix}_2", f"{prefix}_1"], [f"{prefix}_0"]]
+    assert pages[0][0]["classification"] == {"intent": "complaint", "urgency": "high"}
+    assert len(results) == 2 and search_cursor is not None
+    assert {result["id"] for result in results} <= {f"{prefix}_{n}" for n in range(3)}
+    assert duplicate == {"id": f"{prefix}_0", "similarity": 1.0}
+    assert f"{prefix}_0" not in {result["id"] for result in after_delete}
+    assert remaining["id"] != f"{prefix}_0"
+
+
+def test_query_pages_seek_past_ties_and_reclassification(backend):
+    intent = f"paging-{backend.name}-{time.time_ns()}"
+    moments = [datetime(2024, 5, 1, 12, minute) for minute in (0, 1, 1, 1, 2)]
+
+    def write(n, values, indexed_at):
+        return backend.store_document(f"test_paging_{n}", DocumentWrite(
+            records={"classification": codec.dumps(values)}, blobs={}, events=[], ttl=0, indexed_at=indexed_at, expires_at=None,
+            index_values=values, search_terms=None, signature=None,
+        ))
+
+    async def run():
+        for n, moment in enumerate(moments):
+            await write(n, {"intent": intent, "urgency": "high" if n % 2 else "low"}, moment)
+        # Moving a document to another classification takes it out of the old sets
+        await write(4, {"intent": f"{intent}-moved"}, moments[4])
+        pages, cursor = [], None
+        while True:
+            page, cursor = await backend.query_documents({"intent": intent}, None, None, cursor, 2)
+            pages.append([document["id"] for document in page])
+            if cursor is None:
+                break
+        urgent, _ = await backend.query_documents({"intent": intent, "urgency": "HIGH"}, None, None, None, 10)
+        older, _ = await backend.query_documents({"intent": intent}, None, moments[0], None, 10)
+        return pages, [document["id"] for document in urgent], [document["id"] for document in older]
+
+    pages, urgent, older = asyncio.run(run())
+    # Newest first, ties in descending id order
+    assert pages == [["test_paging_3", "test_paging_2"], ["test_paging_1", "test_paging_0"]]
+    assert urgent == ["test_paging_3", "test_paging_1"]
+    assert older == ["test_paging_0"]
+    with pytest.raises(ValueError):
+        asyncio.run(backend.query_documents({}, None, None, "not-a-cursor", 10))
+
+
+def test_sqlite_query_pages_seek_on_an_index(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "records.db"))
+    statements = []
+    backend._db.set_trace_callback(statements.append)
+    try:
+        asyncio.run(backend.query_documents({"intent": "complaint"}, datetime(2024, 1, 1), None, "1714564800.0:test_paging_3", 10))
+        backend._db.set_trace_callback(None)
+        query = next(statement for statement in statements if statement.startswith("SELECT id"))
+        plan = " ".join(row[-1] for row in backend._db.execute(f"EXPLAIN QUERY PLAN {query}"))
+    finally:
+        backend.close()
+    # A range on the index ending at the cursor, read in order without sorting
+    assert "INDEX documents_by_intent (intent=? AND indexed_at>? AND (indexed_at,id)<(?,?))" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+@pytest.mark.parametrize("name", ["memory", "sqlite"])
+def test_expired_documents_leave_every_index(name, tmp_path, monkeypatch):
+    backend = MemoryBackend() if name == "memory" else SQLiteBackend(str(tmp_path / "records.db"))
+    previous = set_storage_backend(backend)
+    text = "Shipment of bearing-z9 for order 12 is delayed by two weeks at the port."
+
+    async def run():
+        await _document("expiring", text, "Invoice")
+        # Complaints are kept longer than DOCUMENT_TTL
+        await _document("kept", "We have a complaint about 3 units of flange-q2.", "Complaint", retention_class="Complaint")
+        monkeypatch.setattr(backends, "_clock", lambda: time.time() + retention_ttl() + 1)
+        return (
+            await get_document_data("expiring"),
+            await get_document_history("expiring"),
+            (await query_documents({}))[0],
+            (await search_documents("bearing-z9"))[0],
+            await find_near_duplicate("other", minhash(text)),
+            await get_document_field("kept", "classification"),
+        )
+
+    try:
+        records, history, listed, found, duplicate, kept = asyncio.run(run())
+    finally:
+        set_storage_backend(previous)
+        backend.close()
+    assert all(record is None for record in records.values())
+    assert history == ([], None)
+    assert [document["id"] for document in listed] == ["kept"]
+    assert found == [] and duplicate is None
+    assert kept["data"]["intent"] == "Complaint"
+
+
+def test_sqlite_backend_upgrades_an_existing_file(tmp_path):
+    path = str(tmp_path / "records.db")
+    old = sqlite3.connect(path)
+    old.execute("CREATE TABLE records (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID")
+    old.execute("CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, event BLOB NOT NULL)")
+    old.commit()
+    old.close()
+
+    backend = SQLiteBackend(path)
+    previous = set_storage_backend(backend)
+    try:
+        store_data("upgraded", {"n": 1})
+        asyncio.run(_document("upgraded_document", LONG_TEXT, "Invoice"))
+        assert get_data("upgraded")["data"] == {"n": 1}
+        assert asyncio.run(get_document_field("upgraded_document", "classification"))["data"]["intent"] == "Invoice"
+    finally:
+        set_storage_backend(previous)
+        backend.close()
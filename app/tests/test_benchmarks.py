@@ -0,0 +1,46 @@
+import random
+
+from app.agents.email_agent import parse_email
+from app.agents.pdf_agent import extract_text_from_pdf
+from app.benchmarks.corpus import build_corpus, make_email, make_pdf_document
+from app.benchmarks.run import find_regressions, load_baseline, percentile, run_benchmarks, save_baseline
+
+
+def test_corpus_is_deterministic_and_parseable():
+    assert build_corpus(seed=1) == build_corpus(seed=1)
+
+    rng = random.Random(0)
+    pdf = make_pdf_document(rng, "rfq", pages=3, lines_per_page=5)
+    extracted = extract_text_from_pdf(pdf)
+    assert extracted["success"] and "quotation request" in extracted["text"]
+
+    parsed = parse_email(make_email(rng, "multipart", "complaint", 50, [pdf]))
+    assert parsed["content"]["html"]
+    assert [a["filename"] for a in parsed["content"]["attachments"]] == ["attachment_1.pdf"]
+    assert parsed["analysis"]["intent"] == "Complaint"
+
+
+def test_percentile_nearest_rank():
+    samples = [float(n) for n in range(1, 101)]
+    assert percentile(samples, 50) == 50.0
+    assert percentile(samples, 95) == 95.0
+    assert percentile(samples, 99) == 99.0
+    assert percentile([3.0], 99) == 3.0
+
+
+def test_baseline_round_trip_and_regressions(tmp_path):
+    results = run_benchmarks(["parse_json[json_invoice_10]"], iterations=3, warmup=0, end_to_end=False)
+    assert list(results) == ["parse_json[json_invoice_10]"]
+
+    path = str(tmp_path / "baseline.json")
+    assert load_baseline(path) is None
+    save_baseline(results, path)
+    assert load_baseline(path) == results
+
+    baseline = {"a": {"p50_ms": 10.0, "p95_ms": 20.0}, "b": {"p50_ms": 0.01, "p95_ms": 0.01}}
+    current = {
+        "a": {"p50_ms": 11.0, "p95_ms": 30.0},   # p95 is 50% slower
+        "b": {"p50_ms": 0.05, "p95_ms": 0.05},   # 5x slower, but within timer noise
+        "c": {"p50_ms": 99.0, "p95_ms": 99.0},   # not in the baseline
+    }
+    assert find_regressions(current, baseline, threshold=0.2) == [("a", "p95_ms", 20.0, 30.0)]
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+from app import codec
+from app.main import app
+from app.memory import result_cache
+from app.memory.result_cache import content_hash
+
+client = TestClient(app)
+
+
+def test_codec_round_trip_and_fallback():
+    value = {"text": "Grüße", "amount": 12.5, "items": [1, None, True]}
+    assert codec.loads(codec.dumps(value)) == value
+    assert json.loads(codec.dumps(value)) == value
+    # Values the fast codec rejects fall back to the stdlib instead of failing
+    assert codec.loads(codec.dumps({1: 2 ** 70})) == {"1": 2 ** 70}
+
+
+def test_webhook_json_is_parsed_once(monkeypatch):
+    payload = {"invoice_number": "INV-W1", "date": "2024-05-01", "amount": 10.0, "customer": {"name": "A"}}
+
+    def no_loads(data):
+        raise AssertionError("webhook payload was re-parsed")
+
+    monkeypatch.setattr(codec, "loads", no_loads)
+    response = client.post("/process/", json={"id": "test_codec_webhook", "content": "", "json": payload})
+    monkeypatch.undo()
+    assert response.status_code == 200
+    assert response.json()["json_analysis"]["processed_data"] == payload
+    assert response.json()["json_analysis"]["valid"] is True
+
+
+def test_cache_entry_stores_each_agent_result_once():
+    content = json.dumps({"invoice_number": "INV-C1", "date": "2024-05-01", "amount": 3.0, "customer": {}})
+    first = client.post("/process/", json={"id": "test_codec_cache_1", "content": content, "content_type": "json"})
+
+    entry = codec.loads(result_cache._local[content_hash("json", content)])
+    assert set(entry["links"]) == {"classification", "json_analysis"}
+    assert set(entry["result"]) == {"status"}
+
+    second = client.post("/process/", json={"id": "test_codec_cache_2", "content": content, "content_type": "json"})
+    assert second.json() == {**first.json(), "cached": True}
+
+
+def test_result_cache_skips_redis_on_other_backends(monkeypatch):
+    from app.memory.backends import MemoryBackend
+    from app.memory.shared_memory import set_storage_backend
+
+    def no_redis():
+        raise AssertionError("the result cache opened a Redis connection")
+
+    previous = set_storage_backend(MemoryBackend())
+    monkeypatch.setattr(result_cache, "get_async_redis", no_redis)
+    try:
+        asyncio.run(result_cache.put_cached("test_cache_tier", {"result": {"status": "ok"}}))
+        del result_cache._local["test_cache_tier"]
+        assert asyncio.run(result_cache.get_cached("test_cache_tier")) is None
+    finally:
+        set_storage_backend(previous)
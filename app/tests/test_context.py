@@ -0,0 +1,65 @@
+import asyncio
+import base64
+
+from fastapi.testclient import TestClient
+
+import app.agents.email_agent as email_agent
+from app.agents.keywords import KeywordMatcher
+from app.context import DocumentContext
+from app.main import app
+
+client = TestClient(app)
+
+EMAIL = (
+    "From: customer@example.com\nSubject: Order 12\nContent-Type: text/html\n\n"
+    "<html><body><p>A complaint: we have a serious problem with order 12, please call us.</p></body></html>"
+)
+
+
+def test_artifacts_are_computed_once(monkeypatch):
+    calls = {"read": 0, "scan": 0}
+    read_email_parts, scan_lowered = email_agent.read_email_parts, KeywordMatcher.scan_lowered
+
+    def counting_read(message):
+        calls["read"] += 1
+        return read_email_parts(message)
+
+    def counting_scan(self, text_lower):
+        calls["scan"] += 1
+        return scan_lowered(self, text_lower)
+
+    monkeypatch.setattr(email_agent, "read_email_parts", counting_read)
+    monkeypatch.setattr(KeywordMatcher, "scan_lowered", counting_scan)
+
+    async def run():
+        context = DocumentContext("email", EMAIL)
+        # Stages asking at the same time share the computation
+        email_data, hits, signature, text = await asyncio.gather(
+            context.get("email"), context.get("hits"), context.get("minhash"), context.get("text"),
+        )
+        return email_data, hits, signature, text, await context.get("hits")
+
+    email_data, hits, signature, text, hits_again = asyncio.run(run())
+    assert calls == {"read": 1, "scan": 1}
+    assert hits_again is hits
+    assert "<p>" not in text and text.strip().startswith("A complaint")
+    assert email_data["analysis"]["intent"] == "Complaint"
+    assert len(signature) == 128
+
+
+def test_base64_pdf_is_classified_on_its_text():
+    text = "Invoice 88: amount due $500, payment is due by June 1st."
+    response = client.post("/process/", json={
+        "id": "test_context_pdf", "content": base64.b64encode(text.encode()).decode(), "content_type": "pdf_base64",
+    })
+    assert response.status_code == 200
+    classification = response.json()["classification"]
+    assert classification["format"] == "PDF"
+    assert classification["intent"] == "Invoice"
+    assert classification["metadata"]["content_length"] == len(text)
+
+
+def test_invalid_base64_is_rejected():
+    response = client.post("/process/", json={"id": "test_context_bad_pdf", "content": "abc", "content_type": "pdf_base64"})
+    assert response.status_code == 400
+    assert "Invalid base64 content" in response.json()["detail"]
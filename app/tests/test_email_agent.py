@@ -0,0 +1,178 @@
+import random
+import time
+
+from app.agents.email_agent import extract_json_from_text, find_json_objects, parse_email
+from app.benchmarks.corpus import make_email, make_pdf_document
+
+
+def test_find_json_objects_in_one_pass():
+    text = 'intro {not json} then {"a": {"b": 1}}\nand later\n{\n  "c": [1, 2]\n} trailing }'
+    assert find_json_objects(text) == [{"a": {"b": 1}}, {"c": [1, 2]}]
+    assert find_json_objects(text, limit=1) == [{"a": {"b": 1}}]
+    # Multi-line objects are found (the old regex lacked DOTALL)
+    assert extract_json_from_text('Quote:\n{\n "rfq_number": "R-1"\n}') == {"rfq_number": "R-1"}
+    assert extract_json_from_text("no braces here") is None
+
+
+def test_find_json_objects_in_adversarial_text():
+    # Unclosed nesting made every '{' re-decode the rest of the text, and deep nesting overflowed
+    unclosed = ('{"a":' * 300 + 'x') * 200
+    deep = '{"a":' * 50000 + '1' + '}' * 50000
+    started = time.monotonic()
+    assert find_json_objects(unclosed + ' {"found": true}') == [{"found": True}]
+    assert find_json_objects(deep + ' {"found": true}') == [{"found": True}]
+    assert time.monotonic() - started < 3
+    # Braces inside strings do not count
+    assert find_json_objects('{"a": "}{"} and {"b": "x\\"}"}') == [{"a": "}{"}, {"b": 'x"}'}]
+
+
+def test_html_email_converted_once(monkeypatch):
+    calls = []
+    import app.agents.email_agent as email_agent
+    original = email_agent.html_to_text
+    monkeypatch.setattr(email_agent, "html_to_text", lambda html: calls.append(html) or original(html))
+
+    message = make_email(random.Random(1), "html", "complaint", 40)
+    parsed = parse_email(message)
+    assert len(calls) == 1
+    assert "<p>" not in parsed["content"]["text"]
+    assert parsed["analysis"]["intent"] == "Complaint"
+
+    # HTML pasted without a Content-Type header is converted too
+    parsed = parse_email('From: a@example.com\n\n<html><body><p>Invoice {"invoice_number": "9"}</p></body></html>')
+    assert parsed["embedded_json"] == {"invoice_number": "9"}
+    assert parsed["analysis"]["embedded_json_count"] == 1
+
+
+def _message_with_attachments(pdf):
+    from email.message import EmailMessage
+
+    msg = EmailMessage()
+    msg["From"] = "buyer@example.com"
+    msg["Subject"] = "Quote request"
+    msg.set_content("Please send a quotation request reply, details attached.")
+    msg.add_attachment(pdf, maintype="application", subtype="pdf", filename="invoice.pdf")
+    msg.add_attachment(b'{"rfq_number": "R-9", "date": "2024-01-01", "items": []}',
+                       maintype="application", subtype="json", filename="rfq.json")
+    msg.add_attachment(b"\x00\x01", maintype="application", subtype="octet-stream", filename="blob.bin")
+    return msg.as_bytes()
+
+
+def test_decode_attachment_spools_large_payloads(monkeypatch):
+    import pathlib
+    from email import message_from_bytes, policy
+    import app.agents.email_agent as email_agent
+
+    pdf = make_pdf_document(random.Random(2), "invoice", pages=2)
+    msg = message_from_bytes(_message_with_attachments(pdf), policy=policy.default)
+    parts = dict(email_agent.iter_attachments(msg))
+    assert [email_agent.attachment_kind(part) for part in parts.values()] == ["pdf", "json", None]
+
+    assert email_agent.decode_attachment(parts[0], spool_threshold=10 ** 9) == pdf
+    monkeypatch.setattr(email_agent, "EMAIL_CHUNK_SIZE", 130)
+    path = email_agent.decode_attachment(parts[0], spool_threshold=0)
+    try:
+        assert isinstance(path, pathlib.Path) and path.read_bytes() == pdf
+    finally:
+        path.unlink()
+
+
+def test_decode_attachment_does_not_copy_the_encoded_payload():
+    import os
+    import tracemalloc
+    from email import message_from_bytes, policy
+    from email.message import EmailMessage
+    import app.agents.email_agent as email_agent
+
+    data = os.urandom(8 * 1024 * 1024)
+    msg = EmailMessage()
+    msg.set_content("Scan attached.")
+    msg.add_attachment(data, maintype="application", subtype="pdf", filename="scan.pdf")
+    part = next(message_from_bytes(msg.as_bytes(), policy=policy.default).iter_attachments())
+
+    tracemalloc.start()
+    try:
+        path = email_agent.decode_attachment(part, spool_threshold=0)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    try:
+        assert path.read_bytes() == data
+        # A few chunks, never a second copy of the ~11 MB of base64 text
+        assert peak < 4 * email_agent.EMAIL_CHUNK_SIZE
+    finally:
+        path.unlink()
+
+
+def test_upload_rfc822_fans_out_attachments(monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    client = TestClient(app)
+    pdf = make_pdf_document(random.Random(3), "invoice", pages=2)
+    for threshold in (10 ** 9, 0):
+        monkeypatch.setattr("app.main.UPLOAD_SPOOL_THRESHOLD", threshold)
+        response = client.post(
+            "/process/file",
+            data={"id": f"test_mime_{threshold}"},
+            files={"file": ("quote.eml", _message_with_attachments(pdf), "message/rfc822")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["classification"]["intent"] == "RFQ"
+        assert data["classification"]["format"] == "Email"
+        assert [a["filename"] for a in data["email_analysis"]["content"]["attachments"]] == ["invoice.pdf", "rfq.json", "blob.bin"]
+        children = {child["filename"]: child for child in data["attachments"]}
+        assert set(children) == {"invoice.pdf", "rfq.json"}
+        assert all(child["status"] == "processed" for child in children.values())
+
+        pdf_child = client.get(f"/document/{children['invoice.pdf']['id']}").json()
+        assert pdf_child["pdf_analysis"]["document_type"] == "invoice"
+        assert pdf_child["metadata"]["parent_id"] == f"test_mime_{threshold}"
+        json_child = client.get(f"/document/{children['rfq.json']['id']}").json()
+        assert json_child["json_analysis"]["document_type"] == "rfq"
+        parent = client.get(f"/document/test_mime_{threshold}").json()
+        assert [child["id"] for child in parent["attachments"]] == [child["id"] for child in data["attachments"]]
+
+
+def test_decode_attachment_without_the_private_payload(monkeypatch):
+    from email import message_from_bytes, policy
+    import app.agents.email_agent as email_agent
+
+    assert email_agent._PRIVATE_PAYLOAD
+    monkeypatch.setattr(email_agent, "_PRIVATE_PAYLOAD", False)
+    pdf = make_pdf_document(random.Random(4), "invoice", pages=1)
+    msg = message_from_bytes(_message_with_attachments(pdf), policy=policy.default)
+    part = dict(email_agent.iter_attachments(msg))[0]
+    path = email_agent.decode_attachment(part, spool_threshold=0)
+    try:
+        assert path.read_bytes() == pdf
+    finally:
+        path.unlink()
+
+
+def test_json_attachment_is_read_from_its_spooled_file(monkeypatch):
+    from email.message import EmailMessage
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    client = TestClient(app)
+    monkeypatch.setattr("app.main.UPLOAD_SPOOL_THRESHOLD", 0)
+    text = '{"rfq_number": "R-spooled", "date": "2024-02-01", "items": []}'
+    msg = EmailMessage()
+    msg["Subject"] = "Quote request"
+    msg.set_content("Details attached.")
+    msg.add_attachment(text.encode(), maintype="application", subtype="json", filename="rfq.json")
+    response = client.post(
+        "/process/file",
+        data={"id": "test_mime_spooled_json"},
+        files={"file": ("quote.eml", msg.as_bytes(), "message/rfc822")},
+    )
+    assert response.status_code == 200
+    [child] = response.json()["attachments"]
+    assert child["status"] == "processed" and child["intent"] == "RFQ"
+
+    # Hashed from the file, the attachment has the cache key of the same JSON posted as text
+    posted = client.post("/process/", json={"id": "test_posted_json", "content": text, "content_type": "json"})
+    assert posted.json()["cached"] is True
+    assert posted.json()["json_analysis"]["document_type"] == "rfq"
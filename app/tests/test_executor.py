@@ -0,0 +1,85 @@
+import asyncio
+import signal
+import time
+
+import pytest
+
+from app import executor
+from app.executor import run_cpu_bound, run_io_bound, TaskTimeoutError
+
+
+def _sleep_through_alarms(seconds):
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+    time.sleep(seconds)
+
+
+def _sleep_then(seconds, value):
+    time.sleep(seconds)
+    return value
+
+
+def test_cpu_bound_runs_in_process_pool():
+    assert asyncio.run(run_cpu_bound(pow, 2, 10)) == 1024
+
+
+def test_io_bound_timeout():
+    with pytest.raises(TaskTimeoutError):
+        asyncio.run(run_io_bound(time.sleep, 0.5, timeout=0.05))
+
+
+def test_timeout_none_uses_default_and_zero_disables_it(monkeypatch):
+    monkeypatch.setattr(executor, "AGENT_TASK_TIMEOUT", 0.05)
+    with pytest.raises(TaskTimeoutError):
+        asyncio.run(run_io_bound(time.sleep, 0.5, timeout=None))
+    assert asyncio.run(run_io_bound(time.sleep, 0.1, timeout=0)) is None
+
+
+def test_cpu_bound_timeout_frees_the_worker(monkeypatch):
+    executor.shutdown_pools()
+    monkeypatch.setattr(executor, "PDF_POOL_SIZE", 1)
+    try:
+        started = time.monotonic()
+        with pytest.raises(TaskTimeoutError):
+            asyncio.run(run_cpu_bound(time.sleep, 30, timeout=0.2))
+        assert time.monotonic() - started < executor.PDF_TIMEOUT_GRACE
+        # The only worker is free again, not still sleeping
+        assert asyncio.run(run_cpu_bound(pow, 2, 3, timeout=5)) == 8
+    finally:
+        executor.shutdown_pools()
+
+
+def test_stuck_worker_gets_its_pool_replaced(monkeypatch):
+    executor.shutdown_pools()
+    monkeypatch.setattr(executor, "PDF_POOL_SIZE", 1)
+    monkeypatch.setattr(executor, "PDF_TIMEOUT_GRACE", 0.3)
+    try:
+        asyncio.run(run_cpu_bound(pow, 2, 3))
+        stuck_pool = executor.get_process_pool()
+        with pytest.raises(TaskTimeoutError):
+            asyncio.run(run_cpu_bound(_sleep_through_alarms, 30, timeout=0.2))
+        assert executor.get_process_pool() is not stuck_pool
+        assert asyncio.run(run_cpu_bound(pow, 2, 4, timeout=5)) == 16
+    finally:
+        executor.shutdown_pools()
+
+
+def test_tasks_sharing_a_stuck_pool_are_resubmitted(monkeypatch):
+    executor.shutdown_pools()
+    monkeypatch.setattr(executor, "PDF_POOL_SIZE", 2)
+    monkeypatch.setattr(executor, "PDF_TIMEOUT_GRACE", 0.3)
+
+    async def run():
+        return await asyncio.gather(
+            run_cpu_bound(_sleep_through_alarms, 30, timeout=0.2),
+            # Still running in the other worker when the stuck one's pool is torn down
+            run_cpu_bound(_sleep_then, 1.5, "done", timeout=10),
+            return_exceptions=True,
+        )
+
+    try:
+        asyncio.run(run_cpu_bound(pow, 2, 3))
+        stuck, innocent = asyncio.run(run())
+    finally:
+        executor.shutdown_pools()
+    assert isinstance(stuck, TaskTimeoutError)
+    assert innocent == "done"
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.memory import indexes
+from app.memory.shared_memory import get_redis
+
+client = TestClient(app)
+
+COMPLAINT = "From: a@example.com\nSubject: Complaint\n\nThis is a serious complaint about order {n}."
+INVOICE = "From: a@example.com\nSubject: Invoice\n\nPlease pay the invoice for order {n}."
+
+
+def _process(doc_id: str, template: str, n: int) -> None:
+    payload = {"id": doc_id, "content": template.format(n=n), "content_type": "email"}
+    assert client.post("/process/", json=payload).status_code == 200
+
+
+def _list(**params):
+    response = client.get("/documents", params=params)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_index_keys_cover_every_filter_combination():
+    keys = indexes.index_keys({"intent": "complaint", "urgency": "high", "format": "email"})
+    assert len(keys) == 8
+    assert indexes.filter_key({"urgency": "high", "intent": "complaint"}) in keys
+    assert indexes.filter_key({}) in keys
+
+
+def test_filters_time_range_and_pagination():
+    start = datetime.utcnow().isoformat()
+    for n in range(5):
+        _process(f"test_index_complaint_{n}", COMPLAINT, n)
+    _process("test_index_invoice", INVOICE, 0)
+
+    ids, cursor = [], None
+    while True:
+        page = _list(intent="Complaint", urgency="high", since=start, limit=2, **({"cursor": cursor} if cursor else {}))
+        assert len(page["documents"]) <= 2
+        ids += [document["id"] for document in page["documents"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    # Newest first, each document once
+    assert ids == [f"test_index_complaint_{n}" for n in reversed(range(5))]
+    assert all(document["classification"]["intent"] == "complaint" for document in _list(intent="complaint", since=start)["documents"])
+    assert [document["id"] for document in _list(intent="Invoice", since=start)["documents"]] == ["test_index_invoice"]
+    assert _list(intent="Complaint", until=start, since=start)["documents"] == []
+
+
+def test_reclassification_and_delete_leave_the_indexes():
+    start = datetime.utcnow().isoformat()
+    _process("test_index_moving", COMPLAINT, 9)
+    _process("test_index_moving", INVOICE, 9)
+    assert "test_index_moving" not in {document["id"] for document in _list(intent="Complaint", since=start)["documents"]}
+    assert "test_index_moving" in {document["id"] for document in _list(intent="Invoice", since=start)["documents"]}
+
+    client.delete("/document/test_index_moving")
+    assert _list(intent="Invoice", since=start)["documents"] == []
+
+
+@pytest.mark.redis
+def test_deleted_and_expired_documents_leave_the_redis_sets():
+    start = datetime.utcnow().isoformat()
+    _process("test_index_deleted", INVOICE, 11)
+    client.delete("/document/test_index_deleted")
+    assert not get_redis().exists(indexes.doc_index_key("test_index_deleted"))
+
+    _process("test_index_expiring", INVOICE, 10)
+    # Pretend its TTL ran out
+    get_redis().zadd(indexes.EXPIRY_KEY, {"test_index_expiring": 1.0})
+    assert _list(intent="Invoice", since=start)["documents"] == []
+    assert get_redis().zscore(indexes.filter_key({"intent": "invoice"}), "test_index_expiring") is None
+
+
+def test_invalid_cursor():
+    assert client.get("/documents", params={"cursor": "not-a-cursor"}).status_code == 400
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.jobs.queue as job_queue
+from app.jobs.queue import InMemoryJobQueue, JOB_MAX_ATTEMPTS, RedisStreamJobQueue
+from app.jobs.worker import handle_job
+from app.main import app
+
+
+def test_async_mode_returns_job_and_worker_completes_it(monkeypatch):
+    monkeypatch.setattr("app.jobs.queue._queue", InMemoryJobQueue())
+    monkeypatch.setattr("app.main.JOB_QUEUE_BACKEND", "memory")
+
+    with TestClient(app) as client:
+        response = client.post(
+            "/process/?mode=async",
+            json={"id": "test_job_1", "content": "We have a complaint about delivery.", "content_type": "text"},
+        )
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+
+        deadline = time.time() + 10
+        job = client.get(f"/jobs/{job_id}").json()
+        while job["status"] not in ("done", "failed") and time.time() < deadline:
+            time.sleep(0.05)
+            job = client.get(f"/jobs/{job_id}").json()
+
+        assert job["status"] == "done"
+        assert job["result"]["classification"]["intent"] == "Complaint"
+        assert client.get("/jobs/unknown").status_code == 404
+
+
+def test_retries_then_dead_letters(monkeypatch):
+    async def broken(request):
+        raise RuntimeError("redis went away")
+
+    monkeypatch.setattr("app.main.process_document", broken)
+    queue = InMemoryJobQueue()
+
+    async def run():
+        await queue.enqueue("job-retry", "doc", '{"id": "doc", "content": "x"}')
+        statuses = []
+        while True:
+            jobs = await queue.claim("test", 1, 10)
+            if not jobs:
+                return statuses
+            statuses.append(await handle_job(queue, jobs[0]))
+
+    statuses = asyncio.run(run())
+    assert statuses == ["retrying"] * (JOB_MAX_ATTEMPTS - 1) + ["failed"]
+    assert queue.dead_letters[0]["job_id"] == "job-retry"
+
+
+def test_client_errors_are_not_retried():
+    queue = InMemoryJobQueue()
+
+    async def run():
+        await queue.enqueue("job-bad-pdf", "doc", '{"id": "doc", "content": "abc", "content_type": "pdf_base64"}')
+        jobs = await queue.claim("test", 1, 10)
+        return await handle_job(queue, jobs[0]), await queue.get_status("job-bad-pdf")
+
+    status, job = asyncio.run(run())
+    assert status == "failed"
+    assert job["attempts"] == 1 and job["error"].startswith("400")
+
+
+@pytest.mark.redis
+def test_jobs_that_keep_killing_their_worker_are_dead_lettered(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_STREAM", "test:jobs:crash")
+    monkeypatch.setattr(job_queue, "JOB_DEAD_LETTER_STREAM", "test:jobs:crash:dead")
+    # Every claimed entry is immediately up for takeover, as if its worker had died
+    monkeypatch.setattr(job_queue, "JOB_VISIBILITY_TIMEOUT_MS", 0)
+    queue = RedisStreamJobQueue()
+
+    async def run():
+        await queue.enqueue("job-crash", "doc", '{"id": "doc", "content": "x"}')
+        claims = [await queue.claim(f"worker-{n}", 1, 10) for n in range(JOB_MAX_ATTEMPTS + 1)]
+        client = await queue._client()
+        pending = await client.xpending("test:jobs:crash", job_queue.JOB_GROUP)
+        dead = await client.xrange("test:jobs:crash:dead")
+        return claims, await queue.get_status("job-crash"), pending, dead
+
+    claims, job, pending, dead = asyncio.run(run())
+    assert [len(jobs) for jobs in claims] == [1] * JOB_MAX_ATTEMPTS + [0]
+    assert job["status"] == "failed" and job["error"].startswith("Abandoned")
+    assert pending["pending"] == 0
+    assert [fields[b"job_id"] for _, fields in dead] == [b"job-crash"]
@@ -0,0 +1,57 @@
+import json
+import random
+
+from fastapi.testclient import TestClient
+
+from app.agents.json_agent import parse_json, validate_json_stream
+from app.benchmarks.corpus import make_invoice, make_rfq
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_non_object_items_are_anomalies_not_crashes():
+    invoice = make_invoice(random.Random(1), 3)
+    invoice["items"].append("free text line")
+    result = parse_json(invoice)
+    assert result["anomalies"] == ["1 item(s) are not objects"]
+    assert result["items_summary"]["count"] == 4
+
+    invoice["items"].append({"amount": "12.50"})
+    assert "1 item(s) have a non-numeric amount" in parse_json(invoice)["anomalies"]
+    assert parse_json([1, 2])["anomalies"] == ["Payload is not a JSON object"]
+
+
+def test_compiled_validator_reports_like_before():
+    result = parse_json({"invoice_number": 7, "date": "2024-01-01", "customer": {}})
+    assert result["missing_fields"] == ["amount"]
+    assert result["type_errors"] == ["invoice_number: expected <class 'str'>, got <class 'int'>"]
+    assert not result["valid"]
+
+
+def test_stream_matches_full_parse():
+    rng = random.Random(2)
+    for document in (make_invoice(rng, 50), make_rfq(rng, 20), {"reference": "C-1"}, {}):
+        full, streamed = parse_json(document), validate_json_stream(json.dumps(document, indent=1))
+        for key in ("valid", "document_type", "missing_fields", "type_errors", "anomalies", "items_summary"):
+            assert full.get(key) == streamed.get(key)
+        # Streamed analyses keep the header fields but not the line items
+        assert "items" not in streamed["processed_data"]
+
+    bad = make_invoice(rng, 5)
+    bad["total"] += 1
+    assert validate_json_stream(json.dumps(bad).encode())["anomalies"] == ["Total amount doesn't match sum of items"]
+
+
+def test_array_of_documents_in_one_request():
+    rng = random.Random(3)
+    documents = [make_invoice(rng, 5), make_rfq(rng, 2), {"invoice_number": "X"}]
+    response = client.post("/process/", json={"id": "test_json_array", "content": json.dumps(documents), "content_type": "json"})
+    assert response.status_code == 200
+    analysis = response.json()["json_analysis"]
+    assert analysis["document_type"] == "batch" and analysis["count"] == 3
+    assert [document["document_type"] for document in analysis["documents"]] == ["invoice", "rfq", "invoice"]
+    assert analysis["valid"] is False
+
+    response = client.post("/process/", json={"id": "test_json_array_bad", "content": "[{\"a\": 1}, ", "content_type": "json"})
+    assert response.status_code == 400
@@ -0,0 +1,19 @@
+from app.agents.keywords import KeywordMatcher, MATCHER, scan
+
+
+def test_overlapping_and_prefix_keywords():
+    matcher = KeywordMatcher(["total amount", "amount due", "quote", "quotation", "bill", "billing"])
+    hits = matcher.scan("TOTAL AMOUNT DUE on the billing quotation, quote again")
+
+    assert hits.offsets["total amount"] == [0]
+    assert hits.offsets["amount due"] == [6]
+    assert hits.count("bill") == 1 and hits.count("billing") == 1
+    assert hits.count("quotation") == 1
+    assert hits.offsets["quote"] == [43]
+
+
+def test_matches_substring_semantics():
+    text = "Re: Request for Quote - the policy on data protection law, see attachment"
+    hits = scan(text)
+    for keyword in MATCHER.keywords:
+        assert hits.any([keyword]) == (keyword in text.lower())
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.agents.llm_classifier as llm
+from app.agents.classifier_agent import classify_input
+from app.agents.llm_classifier import StubBackend, refine_classification, set_backend
+from app.main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def stub():
+    backend = StubBackend(lambda text: {"intent": "Complaint", "confidence": 0.95})
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+
+
+def test_later_rules_do_not_overwrite_earlier_intents():
+    result = classify_input("Please send a request for quote (RFQ) for 10 units, payment on delivery.")
+    assert result["intent"] == "RFQ"
+    assert result["metadata"]["intent_candidates"] == {"RFQ": 0.9, "Invoice": 0.9}
+    # Competing evidence lowers the confidence
+    assert result["metadata"]["confidence_score"] < 0.9
+
+
+def test_low_confidence_documents_are_batched(stub):
+    async def run():
+        texts = [f"note {n}" for n in range(5)] + ["note 0"]
+        return await asyncio.gather(*(refine_classification(text, classify_input(text)) for text in texts))
+
+    results = asyncio.run(run())
+    # One prompt for the five distinct documents; the duplicate shared its slot
+    assert stub.batches == [[f"note {n}" for n in range(5)]]
+    assert {result["intent"] for result in results} == {"Complaint"}
+    assert results[0]["metadata"]["classified_by"] == "stub"
+    assert results[0]["metadata"]["rule_intent"] == "unknown"
+
+    # Answers are cached by content hash
+    asyncio.run(refine_classification("note 3", classify_input("note 3")))
+    assert len(stub.batches) == 1
+
+
+def test_confident_rule_results_skip_the_llm(stub):
+    result = asyncio.run(refine_classification("Invoice 7, amount due $20", classify_input("Invoice 7, amount due $20")))
+    assert result["intent"] == "Invoice"
+    assert stub.batches == []
+
+
+def test_timeout_falls_back_to_rules(monkeypatch):
+    set_backend(StubBackend(lambda text: {"intent": "RFQ", "confidence": 0.99}, latency_ms=500))
+    monkeypatch.setattr(llm, "LLM_TIMEOUT", 0.01)
+    try:
+        result = asyncio.run(refine_classification("hello", classify_input("hello")))
+    finally:
+        set_backend(None)
+    assert result["intent"] == "unknown"
+    assert result["metadata"]["llm_fallback"] is True
+
+
+def test_process_uses_llm_tier(stub):
+    response = client.post("/process/", json={"id": "test_llm_tier", "content": "Some unclear text", "content_type": "text"})
+    assert response.status_code == 200
+    assert response.json()["classification"]["intent"] == "Complaint"
+    assert "llm_classify" in response.headers["server-timing"]
+    assert client.get("/classifier/stats").json()["backend"] == "stub"
@@ -0,0 +1,45 @@
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.metrics import Histogram, STAGE_SECONDS
+
+client = TestClient(app)
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("demo_seconds", "Demo", ("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(("parse",), value)
+    assert histogram.render() == [
+        "# HELP demo_seconds Demo",
+        "# TYPE demo_seconds histogram",
+        'demo_seconds_bucket{stage="parse",le="0.1"} 2',
+        'demo_seconds_bucket{stage="parse",le="1.0"} 3',
+        'demo_seconds_bucket{stage="parse",le="+Inf"} 4',
+        'demo_seconds_sum{stage="parse"} 5.65',
+        'demo_seconds_count{stage="parse"} 4',
+    ]
+
+
+def test_process_reports_stage_timings():
+    response = client.post("/process/", json={
+        "id": "test_metrics_email",
+        "content": "From: a@example.com\nSubject: Invoice\n\nPlease pay invoice 7 {\"invoice_number\": \"7\"}",
+        "content_type": "email",
+    })
+    assert response.status_code == 200
+    timing = dict(entry.split(";dur=") for entry in response.headers["server-timing"].split(", "))
+    assert {"cache_lookup", "persist", "storage_store_document", "total"} <= set(timing)
+    assert all(float(duration) >= 0 for duration in timing.values())
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200
+    assert metrics.headers["content-type"].startswith("text/plain")
+    assert 'document_stage_seconds_count{content_type="email",stage="persist"}' in metrics.text
+    assert 'storage_operation_seconds_bucket{operation="store_document",le="+Inf"}' in metrics.text
+
+
+def test_client_content_types_do_not_create_label_values():
+    client.post("/process/", json={"id": "test_metrics_other", "content": "hello", "content_type": "x" * 40})
+    assert STAGE_SECONDS.samples(("other", "classify"))["count"] >= 1
+    assert STAGE_SECONDS.samples(("x" * 40, "classify")) is None
@@ -0,0 +1,75 @@
+import base64
+import random
+
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.agents.llm_classifier import StubBackend, set_backend
+from app.benchmarks.corpus import filler, make_pdf
+from app.main import app
+from app.memory.near_duplicates import minhash, similarity
+
+client = TestClient(app)
+
+TEMPLATE = (
+    "From: billing@supplier.example\nSubject: Your invoice\n\n"
+    "Dear customer, please find invoice {number} for the delivery of {units} units of part WIDGET-A "
+    "shipped from our Rotterdam warehouse last week. Payment is due within thirty days of the invoice "
+    "date. Please reference the number above on your remittance and contact our billing team with any "
+    "questions about this statement. Thank you for your continued business with us."
+)
+
+
+def test_signatures_estimate_similarity():
+    first = minhash(TEMPLATE.format(number=1001, units=40))
+    second = minhash(TEMPLATE.format(number=1002, units=40))
+    other = minhash(filler(random.Random(1), 80))
+    assert similarity(first, first) == 1.0
+    assert similarity(first, second) > 0.6
+    assert similarity(first, other) < 0.2
+    assert minhash("") == minhash("")
+
+
+def test_process_reports_near_duplicates_and_can_skip_stages(monkeypatch):
+    payload = {"content_type": "email"}
+    first = client.post("/process/", json={**payload, "id": "test_near_1", "content": TEMPLATE.format(number=2001, units=40)})
+    assert "near_duplicate_of" not in first.json()
+
+    second = client.post("/process/", json={**payload, "id": "test_near_2", "content": TEMPLATE.format(number=2002, units=40)})
+    match = second.json()["near_duplicate_of"]
+    assert match["id"] == "test_near_1" and match["similarity"] >= 0.8
+
+    # Above the skip threshold the neighbour's classification is reused; the LLM tier is not asked
+    backend = StubBackend()
+    set_backend(backend)
+    monkeypatch.setattr(main, "NEAR_DUPLICATE_SKIP_THRESHOLD", 0.8)
+    try:
+        third = client.post("/process/", json={**payload, "id": "test_near_3", "content": TEMPLATE.format(number=2003, units=40)})
+    finally:
+        set_backend(None)
+    classification = third.json()["classification"]
+    assert classification["metadata"]["reused_from"] in {"test_near_1", "test_near_2"}
+    assert classification["intent"] == first.json()["classification"]["intent"]
+    assert backend.batches == []
+
+
+def test_pdf_duplicate_skips_full_extraction(monkeypatch):
+    rng = random.Random(7)
+    pages = ["\n".join(filler(rng, 10) for _ in range(30)) for _ in range(6)]
+
+    def upload(doc_id, first_line):
+        document = make_pdf([first_line + "\n" + pages[0], *pages[1:]])
+        return client.post("/process/", json={
+            "id": doc_id, "content": base64.b64encode(document).decode(), "content_type": "pdf_base64",
+        }).json()
+
+    original = upload("test_near_pdf_1", "Invoice 500 for 12 units")
+    assert original["pdf_analysis"]["metadata"]["extraction"]["pages_extracted"] == 6
+
+    monkeypatch.setattr(main, "NEAR_DUPLICATE_SKIP_THRESHOLD", 0.8)
+    duplicate = upload("test_near_pdf_2", "Invoice 501 for 12 units")
+    assert duplicate["near_duplicate_of"]["id"] == "test_near_pdf_1"
+    extraction = duplicate["pdf_analysis"]["metadata"]["extraction"]
+    assert extraction["skipped"] == "near_duplicate"
+    assert extraction["pages_extracted"] == 2
+    assert duplicate["classification"]["metadata"]["reused_from"] == "test_near_pdf_1"
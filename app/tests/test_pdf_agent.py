@@ -0,0 +1,107 @@
+import asyncio
+import base64
+import pathlib
+
+from fastapi.testclient import TestClient
+
+from app import executor
+from app.agents.pdf_agent import extract_text_from_pdf, extract_text_paged, count_pdf_pages
+from app.benchmarks.corpus import make_pdf
+from app.main import app
+
+client = TestClient(app)
+
+
+def test_extract_from_bytes_and_path(tmp_path):
+    pdf = make_pdf(["Invoice 42 amount due"])
+    assert "Invoice 42" in extract_text_from_pdf(pdf)["text"]
+
+    path = tmp_path / "invoice.pdf"
+    path.write_bytes(pdf)
+    assert "Invoice 42" in extract_text_from_pdf(pathlib.Path(path))["text"]
+
+
+def test_upload_pdf_without_base64(monkeypatch):
+    # Force the spooled-file path as well as the in-memory one
+    for threshold in (10 ** 9, 0):
+        monkeypatch.setattr("app.main.UPLOAD_SPOOL_THRESHOLD", threshold)
+        pdf = make_pdf([f"Quotation request {threshold}"])
+        response = client.post(
+            "/process/file",
+            data={"id": f"test_upload_{threshold}"},
+            files={"file": ("rfq.pdf", pdf, "application/pdf")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["pdf_analysis"]["document_type"] == "rfq"
+        assert data["classification"]["format"] == "PDF"
+
+
+def test_upload_rejects_unsupported_type():
+    response = client.post(
+        "/process/file",
+        data={"id": "test_upload_txt"},
+        files={"file": ("notes.txt", b"hello", "text/plain")},
+    )
+    assert response.status_code == 400
+
+
+def test_parallel_extraction_keeps_page_order(monkeypatch):
+    monkeypatch.setattr("app.agents.pdf_agent.PDF_PARALLEL_MIN_BYTES", 0)
+    monkeypatch.setattr("app.agents.pdf_agent.PDF_PAGES_PER_TASK", 2)
+    monkeypatch.setattr("app.agents.pdf_agent.PDF_POOL_SIZE", 2)
+    pdf = make_pdf([f"Page number {n}" for n in range(7)])
+    assert count_pdf_pages(pdf) == 7
+
+    result = asyncio.run(extract_text_paged(pdf))
+    assert result["success"]
+    pages = [page.strip() for page in result["text"].split("\f") if page.strip()]
+    assert pages == [f"Page number {n}" for n in range(7)]
+    assert result["extraction"]["pages_extracted"] == 7
+    assert not result["extraction"]["truncated"]
+
+
+def test_classify_first_stops_early(monkeypatch):
+    monkeypatch.setattr("app.agents.pdf_agent.PDF_CLASSIFY_FIRST_PAGES", 2)
+    pdf = make_pdf(["Cover page", "Invoice total amount", "Filler", "Filler", "Filler", "Filler"])
+
+    result = asyncio.run(extract_text_paged(pdf, mode="classify_first"))
+    assert "Invoice" in result["text"]
+    assert result["extraction"]["pages_extracted"] == 2
+    assert result["extraction"]["truncated"]
+
+
+def test_page_budget(monkeypatch):
+    monkeypatch.setattr("app.agents.pdf_agent.PDF_MAX_PAGES", 3)
+    result = asyncio.run(extract_text_paged(make_pdf([f"Page {n}" for n in range(5)])))
+    assert result["extraction"]["pages_extracted"] == 3
+    assert result["extraction"]["truncated"]
+
+
+def test_worker_timeout_answers_504(monkeypatch):
+    # The worker's own alarm interrupts pdfminer; it must not come back as a bad PDF (400)
+    monkeypatch.setattr(executor, "PDF_TASK_TIMEOUT", 0.05)
+    pdf = make_pdf([f"Timeout page {n} " + "filler text " * 200 for n in range(40)])
+    response = client.post("/process/", json={
+        "id": "test_pdf_timeout", "content": base64.b64encode(pdf).decode(), "content_type": "pdf_base64",
+    })
+    assert response.status_code == 504
+    assert "timed out" in response.json()["detail"]
+
+
+def test_classify_first_spools_the_source_once(monkeypatch):
+    monkeypatch.setattr("app.agents.pdf_agent.PDF_CLASSIFY_FIRST_PAGES", 1)
+    sources = []
+
+    async def record(func, pdf_content, *args, **kwargs):
+        sources.append(pdf_content)
+        return func(pdf_content, *args, **kwargs)
+
+    monkeypatch.setattr("app.agents.pdf_agent.run_cpu_bound", record)
+    pdf = make_pdf(["Cover page", "Filler", "Invoice total amount", "Filler"])
+    result = asyncio.run(extract_text_paged(base64.b64encode(pdf).decode(), mode="classify_first"))
+    assert result["extraction"]["pages_extracted"] == 3
+    # Every step read the same temp file, which is gone afterwards
+    assert len(sources) == 3 and len(set(sources)) == 1
+    assert isinstance(sources[0], pathlib.Path) and not sources[0].exists()
+    assert not asyncio.run(extract_text_paged("not base64!", mode="classify_first"))["success"]
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+from app.agents.registry import get_handler, registered_types, warm_up, warmup_types
+from app.benchmarks.startup import HEAVY_MODULES
+import app.main  # noqa: F401  registers the handlers
+
+
+def test_import_is_light_and_needs_no_api_key():
+    env = {key: value for key, value in os.environ.items() if key != "GOOGLE_API_KEY"}
+    code = (
+        "import sys, app.main; "
+        f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+    assert output.stdout.strip() == ""
+
+
+def test_handlers_registered_by_content_type():
+    assert set(registered_types()) == {"pdf_base64", "email", "json"}
+    assert get_handler("text") is None
+    timings = warm_up(["email"])
+    assert {"app.agents.email_agent", "bs4"} <= set(timings)
+    assert "bs4" in sys.modules
+
+
+def test_warmup_setting():
+    assert warmup_types("") == ()
+    assert warmup_types("all") is None
+    assert warmup_types("pdf_base64, email") == ("pdf_base64", "email")
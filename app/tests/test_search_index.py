@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.memory import search_index
+from app.memory.search_index import decode_postings, encode_postings, tokenize
+from app.memory.shared_memory import get_async_redis, get_redis
+
+client = TestClient(app)
+
+
+def _process(doc_id: str, body: str) -> None:
+    payload = {"id": doc_id, "content": f"From: a@example.com\nSubject: Order\n\n{body}", "content_type": "email"}
+    assert client.post("/process/", json=payload).status_code == 200
+
+
+def _search(q: str, **params):
+    response = client.get("/search", params={"q": q, **params})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_tokenize_and_postings_round_trip():
+    assert tokenize("Part WIDGET-A, widget-a and v1.2 for the order") == {"part": 1, "widget-a": 2, "v1.2": 1, "order": 1}
+    postings = [(3, 1, 10), (4, 2, 7), (900, 1, 300), (100000, 5, 2)]
+    data = encode_postings(postings)
+    # One-byte deltas for nearby documents
+    assert len(data) < 3 * len(postings) * 2
+    assert list(decode_postings(data)) == postings
+
+
+def test_search_ranks_and_paginates():
+    _process("test_search_gizmo_1", "We need 40 units of part GIZMO-X7 and GIZMO-X7 spares.")
+    _process("test_search_gizmo_2", "Quote for GIZMO-X7 along with a long list of other gadgets, cogwheels, bolts and nuts.")
+    _process("test_search_cogwheel", "Please quote 10 cogwheels.")
+
+    results = _search("gizmo-x7")["results"]
+    assert [result["id"] for result in results] == ["test_search_gizmo_1", "test_search_gizmo_2"]
+    assert results[0]["score"] > results[1]["score"]
+
+    first = _search("gizmo-x7 cogwheels", limit=1)
+    second = _search("gizmo-x7 cogwheels", limit=1, cursor=first["next_cursor"])
+    third = _search("gizmo-x7 cogwheels", limit=1, cursor=second["next_cursor"])
+    ids = [page["results"][0]["id"] for page in (first, second, third)]
+    assert sorted(ids) == ["test_search_cogwheel", "test_search_gizmo_1", "test_search_gizmo_2"]
+    assert third["next_cursor"] is None
+
+
+def test_reindex_and_delete_leave_the_results():
+    _process("test_search_moving", "Shipment of sprocket-z delayed.")
+    _process("test_search_moving", "Shipment of flange-q delayed.")
+    assert _search("sprocket-z")["results"] == []
+    assert [result["id"] for result in _search("flange-q")["results"]] == ["test_search_moving"]
+
+    client.delete("/document/test_search_moving")
+    assert _search("flange-q")["results"] == []
+
+
+@pytest.mark.redis
+def test_expiry_and_compaction_of_the_redis_postings():
+    _process("test_search_expiring", "Bearing-k is out of stock.")
+    get_redis().zadd(search_index.EXPIRY_KEY, {"test_search_expiring": time.time() - 1})
+    assert _search("bearing-k")["results"] == []
+
+    async def compact():
+        return await search_index.compact(get_async_redis())
+
+    # The replaced, deleted and expired documents of this module
+    assert asyncio.run(compact()) >= 3
+    assert get_redis().get(search_index.postings_key("sprocket-z")) is None
+    assert get_redis().scard(search_index.TOMBSTONES_KEY) == 0
+    assert [result["id"] for result in _search("gizmo-x7")["results"]][:1] == ["test_search_gizmo_1"]
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.main import app
+from app.memory.migrate import migrate_all, fold_document
+from app.memory.shared_memory import (
+    get_redis, get_storage_backend, get_document_data, store_data, store_many, get_many, get_data, update_data, retention_ttl,
+)
+from app.memory.storage_format import encode_record, decode_record, blob_refs, STORAGE_BLOB_MIN_BYTES
+
+client = TestClient(app)
+
+
+def test_large_bodies_become_shared_blobs():
+    text = "Invoice line item\n" * (STORAGE_BLOB_MIN_BYTES // 10)
+    payload = {"invoice_number": "INV-1", "notes": text}
+    record, blobs = encode_record({"content": text, "processed_data": payload}, "pdf_agent")
+
+    assert len(record) < 300
+    assert len(blobs) == 2
+    assert all(len(blob) < len(text) for blob in blobs.values())
+    assert len(blob_refs(decode_record(record)["data"])) == 2
+
+
+def test_round_trip_and_dedup_across_documents():
+    text = "Shared email body. " * STORAGE_BLOB_MIN_BYTES
+    entries = [
+        (f"test_storage_{n}_email", {"content": {"text": text, "html": False}}, "email_agent")
+        for n in range(2)
+    ]
+
+    async def run():
+        await store_many(entries)
+        return await get_many([key for key, _, _ in entries])
+
+    records = asyncio.run(run())
+    for key, data, source in entries:
+        assert records[key]["data"] == data
+        assert records[key]["metadata"]["source"] == source
+    # Both documents reference a single blob
+    first, second = get_storage_backend().read(["test_storage_0_email", "test_storage_1_email"])
+    assert json.loads(first)["d"] == json.loads(second)["d"]
+
+
+def test_dollar_keys_in_data_are_not_blob_references():
+    text = "Long description. " * STORAGE_BLOB_MIN_BYTES
+    data = {"$blob": "x", "nested": [{"$blob": "y", "$json": 1}], "$$price": 5, "content": text}
+    record, blobs = encode_record(data, "json_agent")
+    assert len(blobs) == 1
+    store_data("test_storage_dollar_keys", data, "json_agent")
+    assert get_data("test_storage_dollar_keys")["data"] == data
+    # Without any blob to inflate
+    store_data("test_storage_dollar_keys_small", {"$blob": "x"}, "json_agent")
+    assert get_data("test_storage_dollar_keys_small")["data"] == {"$blob": "x"}
+
+
+def test_parsed_payloads_are_stored_as_their_text():
+    import hashlib
+    import zlib
+    from app.memory.storage_format import blob_key
+
+    payload = {"rfq_number": "RFQ-raw", "date": "2024-03-01", "notes": "Deliver to dock 4. " * STORAGE_BLOB_MIN_BYTES}
+    text = json.dumps(payload, indent=2)
+    email = f"From: a@example.com\nSubject: RFQ\n\nQuote attached:\n{text}\nThanks"
+    for doc_id, content, content_type, field, key in (
+        ("test_raw_json", text, "json", "json_analysis", "processed_data"),
+        ("test_raw_embedded_json", email, "email", "email_analysis", "embedded_json"),
+    ):
+        response = client.post("/process/", json={"id": doc_id, "content": content, "content_type": content_type})
+        assert response.status_code == 200
+        # The blob holds the posted text itself, not a re-serialization of the parsed payload
+        [blob] = get_storage_backend().read([blob_key(hashlib.sha256(text.encode()).hexdigest())])
+        assert zlib.decompress(blob) == text.encode()
+        assert client.get(f"/document/{doc_id}").json()[field][key] == payload
+
+
+@pytest.mark.redis
+def test_reads_legacy_records():
+    legacy = {
+        "data": {"document_type": "invoice", "content": "x" * STORAGE_BLOB_MIN_BYTES},
+        "metadata": {"timestamp": "2025-01-01T00:00:00", "source": "pdf_agent", "version": "1.0"},
+    }
+    get_redis().set("test_storage_legacy_pdf", json.dumps(legacy))
+    assert get_data("test_storage_legacy_pdf") == legacy
+
+
+@pytest.mark.redis
+def test_document_is_one_hash_with_retention_ttl():
+    client.post(
+        "/process/",
+        json={"id": "test_hash_1", "content": "We have a complaint about a broken unit.", "content_type": "text"},
+    )
+    assert get_redis().exists("test_hash_1_classification") == 0
+    assert get_redis().type("doc:test_hash_1") == b"hash"
+    assert retention_ttl("Complaint") - 5 <= get_redis().ttl("doc:test_hash_1") <= retention_ttl("Complaint")
+
+    assert client.get("/document/test_hash_1").json()["classification"]["intent"] == "Complaint"
+    assert client.delete("/document/test_hash_1").status_code == 200
+    assert client.get("/document/test_hash_1").status_code == 404
+
+
+@pytest.mark.redis
+def test_fold_legacy_document_keys():
+    legacy = {"data": {"intent": "RFQ"}, "metadata": {"timestamp": "2025-01-01T00:00:00", "source": "classifier_agent"}}
+    get_redis().set("test_fold_1_classification", json.dumps(legacy))
+    get_redis().set("test_fold_1_metadata", json.dumps({"data": {"source": "test"}, "metadata": legacy["metadata"]}))
+
+    assert fold_document("test_fold_1")
+    assert get_redis().exists("test_fold_1_classification", "test_fold_1_metadata") == 0
+    document = client.get("/document/test_fold_1").json()
+    assert document["classification"] == {"intent": "RFQ"}
+    assert document["metadata"] == {"source": "test"}
+
+
+@pytest.mark.redis
+def test_migrate_all_folds_embedded_json_into_its_document():
+    legacy = {"data": {"invoice": 7}, "metadata": {"timestamp": "2025-01-01T00:00:00", "source": "email_agent"}}
+    get_redis().set("test_fold_2_embedded_json", json.dumps(legacy))
+    get_redis().set("test_fold_2_json", json.dumps({**legacy, "data": {"invoice": 8}}))
+
+    migrate_all()
+    assert get_redis().exists("doc:test_fold_2_embedded") == 0
+    records = asyncio.run(get_document_data("test_fold_2"))
+    assert records["embedded_json"]["data"] == {"invoice": 7}
+    assert records["json"]["data"] == {"invoice": 8}
+
+
+def test_history_is_appended_and_paginated():
+    doc_id = "test_history_stream"
+    payload = {"id": doc_id, "content": "From: a@example.com\nSubject: Invoice\n\nPlease pay the invoice.", "content_type": "email"}
+    for _ in range(3):
+        assert client.post("/process/", json=payload).status_code == 200
+
+    events, cursor = [], None
+    while True:
+        page = client.get(f"/document/{doc_id}/history", params={"limit": 4, "cursor": cursor}).json()
+        assert len(page["events"]) <= 4
+        events += page["events"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    # Three runs of metadata, signature, classification and email, oldest first
+    assert [event["field"] for event in events] == ["metadata", "minhash", "classification", "email"] * 3
+    assert events[-1]["source"] == "email_agent"
+
+    latest = client.get(f"/document/{doc_id}/history", params={"limit": 1, "order": "desc"}).json()
+    assert latest["events"][0] == events[-1]
+
+    client.delete(f"/document/{doc_id}")
+    assert client.get(f"/document/{doc_id}/history", params={"order": "desc"}).json()["events"][0]["event"] == "deleted"
+    assert client.get("/document/test_history_missing/history").status_code == 404
+    assert client.get(f"/document/{doc_id}/history", params={"cursor": "not-a-cursor"}).status_code == 400
+
+
+def test_concurrent_updates_are_not_lost():
+    from concurrent.futures import ThreadPoolExecutor
+
+    key = f"test_update_counter_{time.time_ns()}"
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda n: update_data(key, {f"field_{n}": n}, "test"), range(40)))
+    assert get_data(key)["data"] == {f"field_{n}": n for n in range(40)}